@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    db_concurrency
+
+    Benchmark how many requests a single process serves while queries are in
+    flight, with the database calls made on the IOLoop (db_threads=0) and on
+    the database threads.
+
+    Every request runs one query which takes about --query_ms on the server
+    (a `$where` sleep), so it needs a local mongod:
+
+        python bench/db_concurrency.py --requests=200 --concurrency=20
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import time
+
+import tornado.web
+from tornado import gen, ioloop, httpclient, netutil, httpserver
+from tornado.options import define, options, parse_command_line
+from mongoengine import connect
+
+from titan.projects.models import Organisation
+from titan.projects.views import BaseHandler
+
+
+define('requests', default=200, type=int, help="Requests per run")
+define('concurrency', default=20, type=int, help="Requests in flight")
+define('query_ms', default=20, type=int, help="Server side query time")
+define('threads', default=8, type=int, help="db_threads of the second run")
+
+
+class SlowQueryHandler(BaseHandler):
+    """
+    Run one slow query per request
+    """
+    def get_current_user(self):
+        return None
+
+    @gen.coroutine
+    def get(self):
+        query = Organisation.objects(
+            __raw__={'$where': 'sleep(%d) || true' % options.query_ms}
+        )
+        yield self.run_db(query.first)
+        self.write('ok')
+
+
+@gen.coroutine
+def run(port):
+    """
+    Fire the requests with the configured concurrency and return the time
+    taken.
+    """
+    client = httpclient.AsyncHTTPClient(max_clients=options.concurrency)
+    url = 'http://127.0.0.1:%d/' % port
+    start = time.time()
+    pending = options.requests
+    while pending:
+        batch = min(pending, options.concurrency)
+        yield [client.fetch(url) for i in range(batch)]
+        pending -= batch
+    raise gen.Return(time.time() - start)
+
+
+def main():
+    parse_command_line()
+    connect('titan_bench')
+    Organisation.drop_collection()
+    Organisation(name="Bench", slug="bench").save()
+
+    # One server serves both runs, stopping it would close the sockets
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    application = tornado.web.Application([(r'/', SlowQueryHandler)])
+    server = httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    for threads in (0, options.threads):
+        application.settings['db_threads'] = threads
+        elapsed = ioloop.IOLoop.current().run_sync(lambda: run(port))
+        sys.stdout.write(
+            "db_threads=%-3d %6d requests in %6.2fs  %8.1f req/s\n" % (
+                threads, options.requests, elapsed,
+                options.requests / elapsed
+            )
+        )
+    server.stop()
+    Organisation.drop_collection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    attachments
+
+    Store the attachments of follow ups and the images of organisations
+    in GridFS.
+
+    Files can be hundreds of megabytes, so they are never held in memory as
+    a whole. An upload is written to GridFS and hashed a chunk at a time as
+    the request body arrives and a download is read a chunk at a time as
+    the response is sent, see `FileHandler`.
+
+    Identical files are stored once: when an upload completes, its
+    SHA-256 is looked up and the file is dropped in favour of the stored
+    one if the content is already stored, see `Blob`. A client which
+    knows the SHA-256 of a file can also reference a stored file without
+    uploading it again. The blobs are reference counted and the files
+    which are no longer referenced are deleted by :func:`collect`.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import logging
+from datetime import datetime, timedelta
+
+import gridfs
+from bson import ObjectId
+from mongoengine.connection import get_db
+from mongoengine.fields import GridFSProxy
+
+from .models import Organisation, FollowUpBucket, Blob
+
+
+#: The GridFS collection of `FollowUp.attachments`, which is the default
+#: collection of FileField
+COLLECTION = 'fs'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def grid_fs():
+    """
+    Returns the GridFS the attachments are stored in. Creating it may make
+    database calls.
+    """
+    return gridfs.GridFS(get_db(), collection=COLLECTION)
+
+
+def proxy(file_id):
+    """
+    Returns the value of a FileField for a file stored in GridFS
+
+    :param file_id: The id of the file
+    """
+    return GridFSProxy(grid_id=file_id, collection_name=COLLECTION)
+
+
+def delete(file_id):
+    """
+    Delete a file along with its chunks. A file which is still being
+    written only has chunks, which are deleted all the same.
+
+    :param file_id: The id of the file
+    """
+    grid_fs().delete(file_id)
+
+
+def parse_range(header, size):
+    """
+    Returns the (first, last) byte positions, both inclusive, requested by
+    the Range header of a request for a file, or None if the whole file is
+    to be sent.
+
+    Only a single range of bytes is supported. Other ranges, like several
+    ranges at once, are ignored and the whole file is sent, which HTTP
+    allows. Raises ValueError if the range is not satisfiable.
+
+    :param header: The value of the Range header, may be None
+    :param size: The size of the file in bytes
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # The last bytes of the file
+        length = int(last)
+        if not length or not size:
+            raise ValueError("Unsatisfiable range %s" % header)
+        return max(size - length, 0), size - 1
+    first = int(first)
+    if last and first > int(last):
+        return None
+    if first >= size:
+        raise ValueError("Unsatisfiable range %s" % header)
+    last = int(last) if last else size - 1
+    return first, min(last, size - 1)
+
+
+def _batches(cursor, key, size=1000):
+    """
+    Generate the values of a key of the documents of a cursor in batches
+    """
+    batch = []
+    for son in cursor:
+        batch.append(son[key])
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _referenced(file_ids):
+    """
+    Returns the ids among file_ids which are referenced by an attachment or
+    an organisation image
+    """
+    file_ids = set(file_ids)
+    referenced = set()
+    for bucket in FollowUpBucket._get_collection().find(
+            {'follow_ups.attachments': {'$in': list(file_ids)}},
+            {'follow_ups.attachments': 1}):
+        for follow_up in bucket.get('follow_ups') or []:
+            referenced.update(follow_up.get('attachments') or [])
+    for organisation in Organisation._get_collection().find(
+            {'image': {'$in': list(file_ids)}}, {'image': 1}):
+        referenced.add(organisation['image'])
+    return referenced & file_ids
+
+
+def collect(min_age=timedelta(days=1)):
+    """
+    Delete the files which are no longer needed and returns the number of
+    files deleted. These are
+
+    * the files of the blobs which are no longer referenced
+    * the uploaded files older than min_age which are neither blobs nor
+      referenced, left behind by an upload which stopped before the file
+      was attached. Only the files with the `uploaded_by` of the uploads
+      are considered, the other files in GridFS are left alone.
+    * the chunks older than min_age of a file which was never completed,
+      left behind by an upload which was interrupted
+
+    Uploads in progress are younger than min_age and are left alone.
+
+    :param min_age: A timedelta, the age of the oldest upload in progress
+    """
+    fs, db = grid_fs(), get_db()
+    files, chunks = db['%s.files' % COLLECTION], db['%s.chunks' % COLLECTION]
+    blobs = Blob._get_collection()
+    deleted = 0
+
+    for son in list(blobs.find({'refcount': {'$lte': 0}}, {'_id': 1})):
+        # The blob is only removed if it was not referenced again meanwhile
+        blob = blobs.find_and_modify(
+            query={'_id': son['_id'], 'refcount': {'$lte': 0}}, remove=True
+        )
+        if blob is not None:
+            fs.delete(blob['file_id'])
+            deleted += 1
+
+    cutoff = datetime.utcnow() - min_age
+    for file_ids in _batches(files.find(
+            {'uploadDate': {'$lt': cutoff}, 'uploaded_by': {'$exists': True}},
+            {'_id': 1}), '_id'):
+        blob_ids = set(
+            son['file_id'] for son in blobs.find(
+                {'file_id': {'$in': file_ids}}, {'file_id': 1}
+            )
+        )
+        candidates = set(file_ids) - blob_ids
+        for file_id in candidates - _referenced(candidates):
+            logging.info("Deleting unreferenced file %s", file_id)
+            fs.delete(file_id)
+            deleted += 1
+
+    # Every file has a first chunk, so the incomplete files are found from
+    # the first chunks without a file
+    for file_ids in _batches(chunks.find(
+            {'n': 0, 'files_id': {'$lt': ObjectId.from_datetime(cutoff)}},
+            {'files_id': 1}), 'files_id'):
+        complete = set(
+            son['_id'] for son in files.find(
+                {'_id': {'$in': file_ids}}, {'_id': 1}
+            )
+        )
+        incomplete = [
+            file_id for file_id in file_ids if file_id not in complete
+        ]
+        if incomplete:
+            chunks.remove({'files_id': {'$in': incomplete}})
+            deleted += len(incomplete)
+    return deleted
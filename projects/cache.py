@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+    In-process caches with version based invalidation.
+
+    Cached values are keyed along with the versions of the data they were
+    computed from, which are the `version` counters of the user, the
+    organisation or the project, see `models.touch`. The versions are
+    stored with the documents and incremented whenever something within
+    them changes, by whichever process makes the change, so a lookup with
+    the current version never sees a stale value. Entries of older
+    versions are never read again and simply age out.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    A bounded mapping whose entries expire after a time to live. When the
+    cache is full the oldest entries are evicted first.
+
+    The cache may be used from the database threads, see :mod:`executor`.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key or default if it is missing or expired
+        """
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.time():
+                self._data.pop(key, None)
+                return default
+            return value
+
+    def set(self, key, value, ttl):
+        """
+        Set the value for the key
+
+        :param ttl: Seconds after which the value expires
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all the entries
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+#: Cache of the navigation column context shared by the handlers
+NAVIGATION_CACHE = TTLCache()
+
+#: Cache of the rendered HTML fragments of the navigation column
+FRAGMENT_CACHE = TTLCache()
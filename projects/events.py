@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    events
+
+    Push the changes of tasks to the browsers looking at them.
+
+    Handlers :func:`publish` an event on the topic of the project whenever
+    a task is created or commented on. The :class:`EventBus` fans the
+    event out to the callbacks subscribed to the topic, which are the
+    websockets of the project pages open on this process, see
+    `ProjectEventsHandler`.
+
+    The websockets of a project may be open on any of the titand worker
+    processes, so the events are passed between them by the
+    :class:`EventFeed`: the events are inserted in a capped collection,
+    which every process tails to publish them on its own bus. Without a
+    running feed, like in the tests and titan-admin, the events are
+    published on the bus of the process only.
+
+    The events are kept only until the capped collection wraps around, so
+    a browser which is not connected when an event is published misses it
+    and sees the change on the next page load.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import logging
+import threading
+
+from pymongo.errors import CollectionInvalid
+from tornado.ioloop import IOLoop
+from mongoengine.connection import get_db
+
+try:
+    from pymongo import CursorType
+    TAILABLE = {'cursor_type': CursorType.TAILABLE_AWAIT}
+except ImportError:
+    # Older pymongo
+    TAILABLE = {'tailable': True, 'await_data': True}
+
+from .models import reference_id
+
+
+class EventBus(object):
+    """
+    An in-process publish/subscribe of events by topic.
+
+    The bus is not thread safe and is used from the IOLoop only.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, topic, callback):
+        """
+        Call the callback with every event published on the topic
+
+        :param topic: A tuple identifying the topic, like ('project', id)
+        :param callback: Function called with the event
+        """
+        self._subscribers.setdefault(topic, set()).add(callback)
+
+    def unsubscribe(self, topic, callback):
+        """
+        Stop calling the callback with the events of the topic
+        """
+        callbacks = self._subscribers.get(topic)
+        if callbacks is None:
+            return
+        callbacks.discard(callback)
+        if not callbacks:
+            del self._subscribers[topic]
+
+    def publish(self, topic, event):
+        """
+        Call every callback subscribed to the topic with the event. Returns
+        the number of subscribers called.
+
+        :param topic: A tuple identifying the topic, like ('project', id)
+        :param event: A dictionary which can be serialized to JSON
+        """
+        callbacks = list(self._subscribers.get(topic, ()))
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                logging.exception("Error delivering event on %s", topic)
+        return len(callbacks)
+
+    def subscribers(self, topic):
+        """
+        Returns the number of callbacks subscribed to the topic
+        """
+        return len(self._subscribers.get(topic, ()))
+
+
+#: The bus of the process
+EVENTS = EventBus()
+
+
+class EventFeed(object):
+    """
+    Pass the events between processes through a capped collection. Every
+    process tails the collection on a thread and publishes the events on
+    its bus from the IOLoop, including the events it inserted itself. It is
+    started and stopped like the background workers, see `server.serve`.
+
+    :param bus: The EventBus the events are published on
+    :param collection: The name of the capped collection
+    :param size: The size of the capped collection in bytes
+    """
+
+    def __init__(self, bus, collection='events', size=16 * 1024 ** 2):
+        self.bus = bus
+        self.collection = collection
+        self.size = size
+        self.running = False
+        self._thread = None
+        self._io_loop = None
+
+    def _collection(self):
+        """
+        Returns the capped collection, creating it if it does not exist
+        """
+        db = get_db()
+        try:
+            return db.create_collection(
+                self.collection, capped=True, size=self.size
+            )
+        except CollectionInvalid:
+            # Already created
+            return db[self.collection]
+
+    def start(self):
+        """
+        Start tailing the feed. Only the events inserted from now on are
+        published.
+        """
+        self._io_loop = IOLoop.current()
+        self.running = True
+        self._thread = threading.Thread(
+            target=self._tail, args=(self._collection(),),
+            name="event-feed"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop tailing the feed. The events published afterwards are only
+        published on the bus of the process.
+        """
+        self.running = False
+
+    def append(self, topic, event):
+        """
+        Insert an event in the feed
+
+        :param topic: A tuple identifying the topic, like ('project', id)
+        :param event: A dictionary which can be serialized to JSON
+        """
+        get_db()[self.collection].insert(
+            {'topic': list(topic), 'event': event}
+        )
+
+    def _tail(self, collection):
+        last = collection.find_one({}, {'_id': 1}, sort=[('$natural', -1)])
+        last_id = last['_id'] if last else None
+        while self.running:
+            query = {'_id': {'$gt': last_id}} if last_id else {}
+            try:
+                for son in collection.find(query, **TAILABLE):
+                    if not self.running:
+                        return
+                    last_id = son['_id']
+                    self._io_loop.add_callback(
+                        self.bus.publish, tuple(son['topic']), son['event']
+                    )
+            except Exception:
+                logging.exception("Error tailing the event feed")
+            # The cursor of an empty collection dies at once, as does the
+            # cursor which fell behind the end of the collection
+            time.sleep(1)
+
+
+#: The feed between the processes serving the application, started by
+#: titand
+FEED = EventFeed(EVENTS)
+
+
+def make_event(task, event_type, **data):
+    """
+    Returns the topic of the project of a task and an event about the task
+
+    :param task: The Task
+    :param event_type: One of task-created, comment-added or status-changed
+    :param data: Other fields of the event
+    """
+    tasklist = task.task_list
+    event = {
+        'type': event_type,
+        'task': {
+            'sequence': task.sequence,
+            'title': task.title,
+            'status': task.status,
+            'task_list': tasklist.sequence,
+        },
+    }
+    event.update(data)
+    return ('project', reference_id(tasklist, 'project')), event
+
+
+def publish(task, event_type, **data):
+    """
+    Publish an event about a task on the topic of its project, see
+    :func:`make_event` for the arguments. It makes blocking database calls
+    and calls the subscribers, so coroutines use
+    `BaseHandler.publish_event` instead.
+
+    Returns the number of subscribers called on this process, or None if
+    the event was appended to the running feed.
+    """
+    topic, event = make_event(task, event_type, **data)
+    if FEED.running:
+        FEED.append(topic, event)
+        return None
+    return EVENTS.publish(topic, event)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    executor
+
+    Run blocking database calls off the IOLoop thread.
+
+    mongoengine (and pymongo under it) blocks the calling thread for the
+    duration of a query. Handlers hand such calls to a bounded pool of
+    database threads and yield the returned future, so that the IOLoop
+    keeps serving other requests while the query is in flight.
+
+    The size of the pool is the `db_threads` application setting. When it
+    is 0 the calls run inline and an already resolved future is returned,
+    which is what the tests use.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import Future
+from tornado.ioloop import PeriodicCallback
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor(max_workers):
+    """
+    Returns the process wide pool of database threads, creating it with
+    max_workers threads on first use.
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers)
+    return _EXECUTOR
+
+
+def run(max_workers, function, *args, **kwargs):
+    """
+    Call function with the arguments on a database thread and return a
+    future of the result.
+
+    :param max_workers: Size of the pool, 0 to call function inline
+    """
+    if not max_workers:
+        future = Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        return future
+    return get_executor(max_workers).submit(function, *args, **kwargs)
+
+
+class PeriodicWorker(object):
+    """
+    Base class of the background workers of a titand process, which call
+    :meth:`run` every interval seconds on the database threads. A run is
+    skipped while the previous one is still in progress.
+
+    :param interval: Seconds between the runs
+    :param db_threads: Size of the pool of database threads
+    """
+
+    def __init__(self, interval, db_threads=0):
+        self.interval = interval
+        self.db_threads = db_threads
+        self._running = False
+        self._callback = None
+
+    def run(self):
+        """
+        Do one round of work, implemented by the subclasses
+        """
+        raise NotImplementedError
+
+    def start(self):
+        """
+        Start the runs on the current IOLoop
+        """
+        self._callback = PeriodicCallback(self.drain, self.interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        """
+        Stop the runs
+        """
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def drain(self):
+        """
+        Call :meth:`run` on the database threads unless the previous run is
+        still in progress.
+        """
+        if self._running:
+            return
+        self._running = True
+        run(self.db_threads, self.run).add_done_callback(self._finished)
+
+    def _finished(self, future):
+        self._running = False
+        if future.exception() is not None:
+            logging.error(
+                "%s run failed: %s", self.__class__.__name__,
+                future.exception()
+            )
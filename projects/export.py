@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    export
+
+    Export the projects of an organisation as newline delimited JSON.
+
+    Every line is a JSON object with a `type` of project, tasklist, task
+    or follow_up and the fields of the document, references being given by
+    id. Projects come first, then the tasklists and then the tasks, each
+    task being followed by its follow ups.
+
+    The records are generated from database cursors, the tasks being read
+    in batches along with the follow ups of the batch, so the memory used
+    does not grow with the size of the organisation.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+from datetime import datetime
+
+from bson import ObjectId, DBRef
+
+from .models import Project, TaskList, Task, FollowUpBucket
+
+
+#: Keys mongoengine stores for its own use
+INTERNAL_KEYS = ('_cls', '_types')
+
+
+def _default(value):
+    """
+    Serialize the values json does not know
+    """
+    if isinstance(value, ObjectId):
+        return unicode(value)
+    if isinstance(value, DBRef):
+        return unicode(value.id)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def _record(record_type, son, **extra):
+    """
+    Returns the record of a document as stored in the database
+    """
+    record = {'type': record_type}
+    for key, value in son.items():
+        if key in INTERNAL_KEYS:
+            continue
+        record['id' if key == '_id' else key] = value
+    record.update(extra)
+    return record
+
+
+def records(organisation, team_ids=None, batch_size=500):
+    """
+    Generate the records of the organisation
+
+    :param organisation: The Organisation
+    :param team_ids: If given, only the projects visible to these teams
+                     are exported, see `Project.visible_to`
+    :param batch_size: Tasks read at once along with their follow ups
+    """
+    if team_ids is None:
+        projects = Project.objects(organisation=organisation)
+    else:
+        projects = Project.visible_to(team_ids, organisation)
+    project_ids = []
+    for son in Project._get_collection().find(projects._query):
+        project_ids.append(son['_id'])
+        yield _record('project', son)
+    if not project_ids:
+        return
+
+    tasklist_ids = []
+    for son in TaskList._get_collection().find(
+            TaskList.objects(project__in=project_ids)._query).sort(
+                [('project', 1), ('sequence', 1)]):
+        tasklist_ids.append(son['_id'])
+        yield _record('tasklist', son)
+    if not tasklist_ids:
+        return
+
+    tasks = Task._get_collection().find(
+        Task.objects(task_list__in=tasklist_ids)._query
+    ).sort('_id', 1).batch_size(batch_size)
+    batch = []
+    for son in tasks:
+        batch.append(son)
+        if len(batch) == batch_size:
+            for record in _task_records(batch):
+                yield record
+            batch = []
+    for record in _task_records(batch):
+        yield record
+
+
+def _task_records(tasks):
+    """
+    Generate the records of a batch of tasks with their follow ups
+    """
+    if not tasks:
+        return
+    follow_ups = dict((son['_id'], []) for son in tasks)
+    for bucket in FollowUpBucket._get_collection().find(
+            FollowUpBucket.objects(task__in=follow_ups.keys())._query).sort(
+                [('task', 1), ('page', 1)]):
+        task_id = getattr(bucket['task'], 'id', bucket['task'])
+        follow_ups[task_id].extend(bucket.get('follow_ups') or [])
+    for son in tasks:
+        # Tasks which are not migrated still embed their follow ups
+        embedded = son.pop('follow_ups', None) or []
+        yield _record('task', son)
+        for follow_up in embedded + follow_ups[son['_id']]:
+            yield _record('follow_up', follow_up, task=son['_id'])
+
+
+def ndjson(organisation, team_ids=None, chunk_size=64 * 1024):
+    """
+    Generate the export of the organisation as chunks of newline delimited
+    JSON of about chunk_size bytes.
+
+    :param organisation: The Organisation
+    :param team_ids: If given, only the projects visible to these teams
+                     are exported
+    :param chunk_size: Bytes after which a chunk is yielded
+    """
+    lines, size = [], 0
+    for record in records(organisation, team_ids):
+        line = json.dumps(record, default=_default) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(lines)
+            lines, size = [], 0
+    if lines:
+        yield ''.join(lines)
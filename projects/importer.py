@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+    importer
+
+    Import tasks in bulk into a project.
+
+    The rows come from CSV with a header line or from newline delimited
+    JSON and have the fields
+
+    * `tasklist`: Name of the tasklist, which is created if the project
+      has no tasklist of that name
+    * `title`: Title of the task
+    * `status`: One of the task statuses, `new` if not given
+    * `assigned_to`: Email of the assignee, optional
+    * `due_date`: The due date as YYYY-MM-DD, optional
+
+    Rows are validated as they are read and the valid ones are inserted in
+    batches, every batch reserving the sequences of its tasks at once.
+    Invalid rows are reported with their line number and skipped.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import csv
+import json
+from datetime import datetime
+from collections import Counter
+
+from mongoengine import ValidationError
+
+from .models import User, TaskList, Task, STATUS_CHOICES
+from .sequences import SEQUENCES
+
+
+#: The formats rows are read from
+FORMATS = ('csv', 'ndjson')
+
+STATUSES = [status for status, name in STATUS_CHOICES]
+
+#: The fields of a row, which are all strings
+FIELDS = ('tasklist', 'title', 'status', 'assigned_to', 'due_date')
+
+
+class RowError(Exception):
+    """
+    A row which cannot be imported
+    """
+
+
+def read_csv(lines):
+    """
+    Generate the (line number, row) of CSV lines with a header line. Rows
+    which are not valid CSV or not UTF-8 are given as a RowError.
+
+    :param lines: Iterable of lines
+    """
+    reader = csv.DictReader(lines)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as exc:
+            yield reader.line_num, RowError("Invalid CSV: %s" % exc)
+            continue
+        try:
+            row = dict(
+                (key, value.decode('utf-8') if value else value) \
+                    for key, value in row.items() if key
+            )
+        except UnicodeDecodeError:
+            row = RowError("Invalid UTF-8")
+        yield reader.line_num, row
+
+
+def read_ndjson(lines):
+    """
+    Generate the (line number, row) of newline delimited JSON. Lines which
+    are not valid JSON objects are given as a RowError.
+
+    :param lines: Iterable of lines
+    """
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = RowError("Invalid JSON")
+        else:
+            if not isinstance(row, dict):
+                row = RowError("Not a JSON object")
+        yield line_number, row
+
+
+def read(lines, format):
+    """
+    Generate the (line number, row) of lines in a format
+
+    :param lines: Iterable of lines
+    :param format: One of FORMATS
+    """
+    if format == 'csv':
+        return read_csv(lines)
+    if format == 'ndjson':
+        return read_ndjson(lines)
+    raise ValueError("Unknown format %s" % format)
+
+
+class TaskImporter(object):
+    """
+    Import tasks into a project
+
+    :param project: The Project
+    :param batch_size: Tasks inserted at once
+    :param max_errors: Errors reported at most, the rows after that are
+                       still imported
+    """
+
+    def __init__(self, project, batch_size=1000, max_errors=1000):
+        self.project = project
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.tasklists = dict(
+            (tasklist.name, tasklist) for tasklist in \
+                TaskList.objects(project=project)
+        )
+        self.users = {}
+        self.created = 0
+        self.created_tasklists = 0
+        self.errors = []
+        self._batch = []
+
+    def run(self, rows):
+        """
+        Import the rows and return a summary with the number of tasks and
+        tasklists created and the errors as a list of (line number, error)
+
+        :param rows: Iterable of (line number, row), see :func:`read`
+        """
+        for line_number, row in rows:
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                self._batch.append(self.task(row))
+            except (RowError, ValidationError) as exc:
+                if len(self.errors) < self.max_errors:
+                    self.errors.append((line_number, unicode(exc)))
+                continue
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+        self.flush()
+        if self.created or self.created_tasklists:
+            self.project.changed()
+        return {
+            'created': self.created,
+            'tasklists': self.created_tasklists,
+            'errors': self.errors,
+        }
+
+    def task(self, row):
+        """
+        Returns an unsaved task built from a row
+
+        :param row: Dictionary of the fields
+        """
+        for field in FIELDS:
+            value = row.get(field)
+            if value is not None and not isinstance(value, basestring):
+                raise RowError("%s must be a string" % field)
+        title = (row.get('title') or '').strip()
+        if not title:
+            raise RowError("A title is required")
+        status = row.get('status') or 'new'
+        if status not in STATUSES:
+            raise RowError("Invalid status %s" % status)
+        due_date = None
+        if row.get('due_date'):
+            try:
+                due_date = datetime.strptime(row['due_date'], '%Y-%m-%d')
+            except ValueError:
+                raise RowError("Invalid due date %s" % row['due_date'])
+        assignee = None
+        if row.get('assigned_to'):
+            assignee = self.user(row['assigned_to'])
+        task = Task(
+            title=title, status=status, due_date=due_date,
+            assigned_to=assignee, watchers=[assignee] if assignee else [],
+            task_list=self.tasklist(row.get('tasklist')),
+        )
+        task.update_keywords()
+        task.validate()
+        return task
+
+    def tasklist(self, name):
+        """
+        Returns the tasklist of the project with the name, creating it if
+        it does not exist
+        """
+        name = (name or '').strip()
+        if not name:
+            raise RowError("A tasklist is required")
+        if name not in self.tasklists:
+            self.tasklists[name] = TaskList(
+                name=name, project=self.project
+            ).save()
+            self.created_tasklists += 1
+        return self.tasklists[name]
+
+    def user(self, email):
+        """
+        Returns the user with the email
+        """
+        if email not in self.users:
+            self.users[email] = User.objects(email=email).first()
+        if self.users[email] is None:
+            raise RowError("No user with email %s" % email)
+        return self.users[email]
+
+    def flush(self):
+        """
+        Insert the batch of tasks, reserving the sequences and adding to
+        the status counts of the tasks of every tasklist at once
+        """
+        if not self._batch:
+            return
+        by_tasklist = {}
+        for task in self._batch:
+            by_tasklist.setdefault(task.task_list.id, []).append(task)
+        for tasklist_id, tasks in by_tasklist.items():
+            start, end = SEQUENCES.reserve(
+                len(tasks), 'task_list', tasklist_id
+            )
+            for sequence, task in zip(range(start, end + 1), tasks):
+                task.sequence = sequence
+        Task.objects.insert(self._batch, load_bulk=False)
+        for tasks in by_tasklist.values():
+            tasks[0].task_list.update_counters(
+                Counter(task.status for task in tasks), changed=True
+            )
+        self.created += len(self._batch)
+        self._batch = []
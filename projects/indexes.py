@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    indexes
+
+    Build and audit the indexes declared by the models.
+
+    The indexes are declared in the `meta` of every document. Mongoengine
+    would create them in the foreground the first time a collection is used
+    by a process, which blocks the database while a large collection is
+    indexed, so the documents turn `auto_create_index` off. The indexes
+    are built by :func:`ensure_indexes` instead, which titand runs in the
+    background on startup, and audited with :func:`report`.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import logging
+
+from pymongo.errors import OperationFailure
+from mongoengine.connection import get_db
+
+from .models import (Organisation, User, Team, Membership, Project, TaskList,
+    Task, FollowUpBucket, OutboxMessage, Notification, Blob)
+
+
+#: The documents whose indexes are managed
+DOCUMENTS = [
+    Organisation, User, Team, Membership, Project, TaskList, Task,
+    FollowUpBucket, OutboxMessage, Notification, Blob,
+]
+
+#: Index options passed on to the database
+INDEX_OPTIONS = ('unique', 'sparse', 'name', 'expireAfterSeconds')
+
+
+def _key(fields):
+    """
+    Returns a hashable index key from a list of (field, direction)
+    """
+    return tuple(
+        (name, int(direction) if isinstance(direction, float) else direction)
+        for name, direction in fields
+    )
+
+
+def _collection(document):
+    """
+    Returns the collection of the document. Unlike the collection of the
+    document class, getting it does not create the indexes.
+    """
+    return get_db()[document._get_collection_name()]
+
+
+def declared_indexes(document):
+    """
+    Returns the index specifications declared by the document, including
+    the ones of unique fields, as a list of dictionaries with the fields
+    and the options.
+
+    :param document: Document class
+    """
+    return document._meta.get('index_specs') or []
+
+
+def ensure_indexes(background=True):
+    """
+    Create the declared indexes which do not exist yet. Returns a list of
+    (collection, index name) created.
+
+    :param background: Build the indexes without blocking the collection
+    """
+    created = []
+    for document in DOCUMENTS:
+        collection = _collection(document)
+        existing = set(
+            _key(index['key'])
+            for index in collection.index_information().values()
+        )
+        for spec in declared_indexes(document):
+            if _key(spec['fields']) in existing:
+                continue
+            options = dict(
+                (name, value) for name, value in spec.items() \
+                    if name in INDEX_OPTIONS
+            )
+            name = collection.create_index(
+                spec['fields'], background=background, **options
+            )
+            logging.info("Created index %s.%s", collection.name, name)
+            created.append((collection.name, name))
+    return created
+
+
+def index_usage(collection):
+    """
+    Returns a dictionary of index name to the number of times it was used
+    since the server started, or None if the server does not track it.
+
+    :param collection: pymongo Collection
+    """
+    try:
+        result = collection.aggregate([{'$indexStats': {}}])
+    except OperationFailure:
+        return None
+    if isinstance(result, dict):
+        # Older pymongo returns the raw command response
+        result = result['result']
+    return dict(
+        (stats['name'], stats['accesses']['ops']) for stats in result
+    )
+
+
+def report():
+    """
+    Audit the indexes of every collection. Returns a list of dictionaries
+    with the collection and the names of its indexes which are
+
+    * `missing`: declared but not built
+    * `undeclared`: built but not declared by the model
+    * `unused`: built but never used since the server started. None if
+      the server does not track index usage.
+    """
+    audit = []
+    for document in DOCUMENTS:
+        collection = _collection(document)
+        existing = dict(
+            (_key(index['key']), name) for name, index in \
+                collection.index_information().items() if name != '_id_'
+        )
+        declared = dict(
+            (_key(spec['fields']), spec) for spec in declared_indexes(document)
+        )
+        usage = index_usage(collection)
+        audit.append({
+            'collection': collection.name,
+            'missing': [
+                '_'.join('%s_%s' % field for field in key) \
+                    for key in declared if key not in existing
+            ],
+            'undeclared': [
+                name for key, name in existing.items() if key not in declared
+            ],
+            'unused': None if usage is None else [
+                name for name in existing.values() if not usage.get(name)
+            ],
+        })
+    return audit
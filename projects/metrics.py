@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+
+    Measure the process for monitoring, in the Prometheus text format.
+
+    Every finished request is recorded in the latency histogram of its
+    handler, method and status, see `BaseHandler.on_finish`. The
+    histograms are only updated from the IOLoop thread, which runs one
+    callback at a time, so they need no lock. The :class:`LagMonitor`
+    measures how late the IOLoop runs its callbacks, which grows when
+    something blocks it.
+
+    The metrics are those of the process. With several workers, every
+    worker serves its own, see :mod:`server`, and they carry its pid as a
+    label so that they can be told apart.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+
+from tornado.ioloop import IOLoop
+
+
+#: The upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram(object):
+    """
+    The counts of observations in cumulative buckets, along with their
+    count and sum
+
+    :param buckets: The sorted upper bounds of the buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Record an observation
+        """
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Returns (upper bound, observations up to it) for every bucket,
+        ending with the `+Inf` bucket
+        """
+        result, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((repr(bound), total))
+        result.append(('+Inf', self.count))
+        return result
+
+
+class Latencies(object):
+    """
+    The latency histograms of the requests by handler, method and status
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+
+    def observe(self, handler, method, status, seconds):
+        """
+        Record the latency of a request
+
+        :param handler: The name of the handler class
+        :param method: The HTTP method
+        :param status: The HTTP status of the response
+        :param seconds: The time the request took
+        """
+        key = (handler, method, status)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+
+#: The latencies of the requests served by the process
+LATENCIES = Latencies()
+
+
+class LagMonitor(object):
+    """
+    Measure the lag of the IOLoop: how much later than scheduled a timeout
+    runs. It is started and stopped like the background workers, see
+    `server.serve`.
+
+    :param interval: Seconds between the measurements
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        expected = time.time() + self.interval
+        self._timeout = IOLoop.current().add_timeout(
+            expected, lambda: self._measure(expected)
+        )
+
+    def _measure(self, expected):
+        self.lag = max(time.time() - expected, 0.0)
+        self.max_lag = max(self.max_lag, self.lag)
+        self._schedule()
+
+
+#: The lag monitor of the process, started by titand
+LAG = LagMonitor()
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"'
+        )) for name, value in sorted(labels.items())
+    )
+
+
+def render(latencies=LATENCIES, lag=LAG, outbox=None):
+    """
+    Returns the metrics in the Prometheus text format
+
+    :param latencies: The request latencies
+    :param lag: The LagMonitor of the IOLoop
+    :param outbox: The messages in the outbox by status, see
+                   `outbox.queue_depth`
+    """
+    pid = os.getpid()
+    lines = [
+        '# HELP titan_request_duration_seconds Time taken by requests',
+        '# TYPE titan_request_duration_seconds histogram',
+    ]
+    for (handler, method, status), histogram in sorted(
+            latencies.histograms.items()):
+        labels = dict(
+            handler=handler, method=method, status=status, pid=pid
+        )
+        for bound, count in histogram.cumulative():
+            lines.append('titan_request_duration_seconds_bucket%s %d' % (
+                _labels(le=bound, **labels), count
+            ))
+        lines.append('titan_request_duration_seconds_sum%s %r' % (
+            _labels(**labels), histogram.sum
+        ))
+        lines.append('titan_request_duration_seconds_count%s %d' % (
+            _labels(**labels), histogram.count
+        ))
+
+    lines.extend([
+        '# HELP titan_ioloop_lag_seconds Delay of the last IOLoop timeout',
+        '# TYPE titan_ioloop_lag_seconds gauge',
+        'titan_ioloop_lag_seconds%s %r' % (_labels(pid=pid), lag.lag),
+        '# HELP titan_ioloop_lag_max_seconds Largest IOLoop delay seen',
+        '# TYPE titan_ioloop_lag_max_seconds gauge',
+        'titan_ioloop_lag_max_seconds%s %r' % (_labels(pid=pid), lag.max_lag),
+    ])
+
+    if outbox is not None:
+        lines.extend([
+            '# HELP titan_outbox_messages Emails in the outbox by status',
+            '# TYPE titan_outbox_messages gauge',
+        ])
+        for status, count in sorted(outbox.items()):
+            lines.append('titan_outbox_messages%s %d' % (
+                _labels(status=status), count
+            ))
+    return '\n'.join(lines) + '\n'
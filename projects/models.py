@@ -5,12 +5,23 @@
     :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) LTD
     :license: BSD, see LICENSE for more details.
 """
+import re
+from datetime import datetime
+from collections import Counter
+
+from pymongo.errors import DuplicateKeyError
 from mongoengine import Document, EmbeddedDocument, ValidationError
 from mongoengine import (StringField, ReferenceField, ListField, FileField,
-    DateTimeField, EmbeddedDocumentField, SequenceField)
+    DateTimeField, EmbeddedDocumentField, IntField, DictField, FloatField,
+    ObjectIdField)
 from monstor.utils.i18n import _
 from monstor.contrib.auth.models import User as MonstorUser
 
+from .sequences import SEQUENCES
+
+
+#: Roles of the project ACL, in the order of precedence
+ROLES = ['admin', 'participant', 'observer']
 
 STATUS_CHOICES = [
     ('new', 'New'),
@@ -20,6 +31,64 @@ STATUS_CHOICES = [
 ]
 
 
+def reference_id(document, field_name):
+    """
+    Return the id of the document referenced by `field_name` without
+    dereferencing it. Works whether the field currently holds a DBRef, an
+    ObjectId or an already dereferenced document.
+    """
+    value = document._data.get(field_name)
+    return getattr(value, 'id', value)
+
+
+def reference_ids(document, field_name):
+    """
+    Same as :func:`reference_id` but for a list of references
+    """
+    return [getattr(value, 'id', value) for value in \
+        document._data.get(field_name) or []]
+
+
+#: Words which are too common to be worth searching for
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if',
+    'in', 'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'so', 'such',
+    'that', 'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to',
+    'was', 'will', 'with',
+])
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def keywords(text):
+    """
+    Returns the sorted list of the distinct words of a text which tasks are
+    searched by. Words are lower cased and the stop words and single
+    characters are left out.
+
+    :param text: The text, may be None
+    """
+    if not text:
+        return []
+    return sorted(set(
+        word for word in WORD_RE.findall(text.lower()) \
+            if len(word) > 1 and word not in STOP_WORDS
+    ))
+
+
+def touch(document, document_id):
+    """
+    Increment the version of a document. The version changes whenever the
+    document or anything shown along with it changes, so the pages of the
+    document use it in their ETag.
+
+    :param document: The Document class
+    :param document_id: The id of the document
+    """
+    if document_id is not None:
+        document.objects(id=document_id).update_one(inc__version=1)
+
+
 class Organisation(Document):
     """
     Model for Organisation
@@ -36,6 +105,16 @@ class Organisation(Document):
     #: Short identifier for the organisation, used in url
     slug = StringField(verbose_name=_("Slug"), required=True, unique=True)
 
+    #: Incremented whenever the teams or projects change, see :func:`touch`
+    version = IntField(default=0)
+
+    meta = {
+        # The indexes of all the documents are built ahead by
+        # `indexes.ensure_indexes`, never in the foreground when a process
+        # first uses a collection
+        'auto_create_index': False,
+    }
+
     @property
     def teams(self):
         """
@@ -43,18 +122,93 @@ class Organisation(Document):
         """
         return Team.objects(organisation=self).all()
 
+    def set_image(self, file_id):
+        """
+        Replace the image of the organisation with a file which is already
+        referenced, see `Blob.acquire`. The reference to the previous image
+        is released.
+
+        :param file_id: The GridFS id of the image
+        """
+        previous = Organisation._get_collection().find_and_modify(
+            query={'_id': self.id}, update={'$set': {'image': file_id}},
+            fields={'image': 1}
+        )
+        if previous and previous.get('image') is not None:
+            Blob.release([previous['image']])
+        touch(Organisation, self.id)
+
 
 class User(MonstorUser):
     """
     Extend users to make it a part of Organisation
     """
 
+    #: Notifications about tasks are collected for these many minutes and
+    #: sent as a single digest email, 0 sends them as soon as possible.
+    digest_interval = IntField(
+        default=0, verbose_name=_("Digest Interval"), choices=[
+            (0, _('Immediately')),
+            (15, _('Every 15 minutes')),
+            (60, _('Hourly')),
+            (240, _('Every 4 hours')),
+            (1440, _('Daily')),
+        ]
+    )
+
+    #: Incremented whenever the memberships of the user change, which
+    #: changes the organisations and projects the user sees
+    version = IntField(default=0)
+
+    meta = {
+        'indexes': [
+            'email',
+        ],
+        'auto_create_index': False,
+    }
+
     @property
     def organisations(self):
         """
         Returns a list of organisations the user belongs to.
+
+        The organisations are looked up through the membership index instead
+        of scanning the teams of the user.
+        """
+        organisation_ids = self.organisation_ids
+        if not organisation_ids:
+            return set()
+        return set(Organisation.objects(id__in=organisation_ids))
+
+    @property
+    def organisation_ids(self):
+        """
+        Returns the ids of the organisations the user belongs to.
+        """
+        return list(set([
+            reference_id(membership, 'organisation') for membership in \
+                Membership.objects(user=self).only('organisation')
+        ]))
+
+    @property
+    def team_ids(self):
         """
-        return set([t.organisation for t in Team.objects(members=self)])
+        Returns the ids of all the teams the user is a member of.
+        """
+        return [
+            reference_id(membership, 'team') for membership in \
+                Membership.objects(user=self).only('team')
+        ]
+
+    def is_member_of(self, organisation):
+        """
+        Returns True if the user belongs to any team of the organisation.
+
+        :param organisation: Organisation document
+        """
+        return Membership.objects(
+            user=self, organisation=organisation
+        ).first() is not None
 
 
 class Team(Document):
@@ -76,6 +230,117 @@ class Team(Document):
         ReferenceField(User), verbose_name=_("Members")
     )
 
+    meta = {
+        'indexes': [
+            ('organisation', 'name'),
+            ('members', 'organisation'),
+        ],
+        'auto_create_index': False,
+    }
+
+    def save(self, *args, **kwargs):
+        """
+        Save the team and keep the membership index in sync with the
+        members of the team.
+        """
+        result = super(Team, self).save(*args, **kwargs)
+        Membership.sync(self)
+        touch(Organisation, reference_id(self, 'organisation'))
+        return result
+
+    def delete(self, *args, **kwargs):
+        """
+        Delete the team along with its entries in the membership index.
+        """
+        user_ids = [
+            reference_id(membership, 'user') for membership in \
+                Membership.objects(team=self).only('user')
+        ]
+        Membership.objects(team=self).delete()
+        if user_ids:
+            User.objects(id__in=user_ids).update(inc__version=1)
+        touch(Organisation, reference_id(self, 'organisation'))
+        return super(Team, self).delete(*args, **kwargs)
+
+
+class Membership(Document):
+    """
+    An index of user -> (organisation, team) which is maintained whenever a
+    team is saved. It answers "which organisations is this user in" without
+    scanning and dereferencing every team of the user.
+    """
+
+    #: The member
+    user = ReferenceField(User, required=True, verbose_name=_("User"))
+
+    #: The organisation of the team, denormalised from the team
+    organisation = ReferenceField(
+        Organisation, required=True, verbose_name=_("Organisation")
+    )
+
+    #: The team through which the user is a member of the organisation
+    team = ReferenceField(Team, required=True, verbose_name=_("Team"))
+
+    meta = {
+        'indexes': [
+            ('user', 'organisation'),
+            ('team', 'user'),
+        ],
+        'auto_create_index': False,
+    }
+
+    @classmethod
+    def sync(cls, team):
+        """
+        Bring the index entries of a team in line with its members.
+
+        :param team: Team document which has been saved
+        """
+        organisation_id = reference_id(team, 'organisation')
+        member_ids = set(reference_ids(team, 'members'))
+        indexed_ids = set([
+            reference_id(membership, 'user') for membership in \
+                cls.objects(team=team).only('user')
+        ])
+        stale_ids = indexed_ids - member_ids
+        if stale_ids:
+            cls.objects(team=team, user__in=list(stale_ids)).delete()
+        # The organisation of a team may change, so update the rows which
+        # are already indexed as well as inserting the new ones.
+        cls.objects(team=team).update(set__organisation=organisation_id)
+        for user_id in member_ids - indexed_ids:
+            cls(user=user_id, organisation=organisation_id, team=team).save()
+        changed_ids = stale_ids | (member_ids - indexed_ids)
+        if changed_ids:
+            User.objects(id__in=list(changed_ids)).update(inc__version=1)
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Rebuild the entire index from the existing teams. Returns the
+        number of memberships indexed.
+
+        The index stays in use while it is rebuilt, so the teams are synced
+        one at a time and the entries of the teams which no longer exist
+        are deleted afterwards, instead of dropping the index first.
+        """
+        team_ids = set()
+        for team in Team.objects.all():
+            cls.sync(team)
+            team_ids.add(team.id)
+        stale_ids = [
+            team_id for team_id in cls._get_collection().distinct('team') \
+                if getattr(team_id, 'id', team_id) not in team_ids
+        ]
+        if stale_ids:
+            user_ids = [
+                reference_id(membership, 'user') for membership in \
+                    cls.objects(team__in=stale_ids).only('user')
+            ]
+            cls.objects(team__in=stale_ids).delete()
+            User.objects(id__in=user_ids).update(inc__version=1)
+        return cls.objects.count()
+
 
 class AccessControlList(EmbeddedDocument):
     """
@@ -117,6 +382,82 @@ class Project(Document):
         Organisation, verbose_name=_("Organisation"), required=True
     )
 
+    #: Incremented whenever the project, its tasklists or its tasks change,
+    #: see :func:`touch`
+    version = IntField(default=0)
+
+    #: The number of tasks of the project in every status, see
+    #: `TaskList.update_counters`
+    status_counts = DictField()
+
+    #: The hours spent on the tasks of the project, see
+    #: `TaskList.update_counters`
+    hours = FloatField(default=0)
+
+    meta = {
+        'indexes': [
+            # Also serves the lookups by slug alone, like invitations
+            ('slug', 'organisation'),
+            ('acl.team', 'organisation'),
+        ],
+        'auto_create_index': False,
+    }
+
+    @classmethod
+    def visible_to(cls, team_ids, organisation=None):
+        """
+        Returns a queryset of the projects which have any of the given teams
+        in their ACL. The filtering is done by the database, so the teams of
+        the projects need not be dereferenced.
+
+        :param team_ids: The ids of the teams of a user, see `User.team_ids`
+        :param organisation: Optionally restrict to projects of organisation
+        """
+        projects = cls.objects(acl__team__in=list(team_ids))
+        if organisation is not None:
+            projects = projects.filter(organisation=organisation)
+        return projects
+
+    def role_of(self, team_ids):
+        """
+        Returns the highest role granted to any of the given teams by the ACL
+        of the project or None if none of the teams are in the ACL.
+
+        :param team_ids: The ids of the teams of a user, see `User.team_ids`
+        """
+        team_ids = set(team_ids)
+        roles = [
+            acl.role for acl in self.acl \
+                if reference_id(acl, 'team') in team_ids
+        ]
+        for role in ROLES:
+            if role in roles:
+                return role
+        return None
+
+    def save(self, *args, **kwargs):
+        """
+        Save the project and invalidate the cached views of it.
+        """
+        result = super(Project, self).save(*args, **kwargs)
+        self.changed()
+        return result
+
+    def delete(self, *args, **kwargs):
+        """
+        Delete the project and invalidate the cached views of it.
+        """
+        self.changed()
+        return super(Project, self).delete(*args, **kwargs)
+
+    def changed(self):
+        """
+        Invalidate the cached views of the project and its organisation
+        """
+        organisation_id = reference_id(self, 'organisation')
+        touch(Organisation, organisation_id)
+        touch(Project, self.id)
+
     def validate(self):
         """
         Whenever we create a new project or update an existing project object,
@@ -171,6 +512,9 @@ class FollowUp(EmbeddedDocument):
     #: The name of the user, who has assigned this task
     to_assignee = ReferenceField(User, verbose_name=_("To assignee"))
 
+    #: The time spent on the task since the previous follow up
+    hours = FloatField(verbose_name=_("Hours"), min_value=0)
+
 
 class TaskList(Document):
     """
@@ -183,8 +527,92 @@ class TaskList(Document):
     #: The name of the project, under which this task list exist
     project = ReferenceField(Project, required=True, verbose_name=_("Project"))
 
-    #: Sequence id for each task list
-    sequence = SequenceField(unique=True)
+    #: Sequence id of the task list within its project
+    sequence = IntField(verbose_name=_("Sequence"))
+
+    #: Incremented whenever the tasklist or its tasks change, see
+    #: :func:`touch`
+    version = IntField(default=0)
+
+    #: The number of tasks of the tasklist in every status, see
+    #: :meth:`update_counters`
+    status_counts = DictField()
+
+    #: The hours spent on the tasks of the tasklist, see
+    #: :meth:`update_counters`
+    hours = FloatField(default=0)
+
+    meta = {
+        'indexes': [
+            {'fields': ('project', 'sequence'), 'unique': True},
+        ],
+        'auto_create_index': False,
+    }
+
+    def save(self, *args, **kwargs):
+        """
+        Save the tasklist and invalidate the cached views of its project.
+        A new tasklist gets the next sequence of its project.
+        """
+        project_id = reference_id(self, 'project')
+        if self.sequence is None and project_id is not None:
+            self.sequence = SEQUENCES.next('project', project_id)
+        result = super(TaskList, self).save(*args, **kwargs)
+        self.changed()
+        return result
+
+    def delete(self, *args, **kwargs):
+        """
+        Delete the tasklist and invalidate the cached views of its project.
+        Its tasks and their hours are no longer counted by the project.
+        """
+        self.update_counters(
+            dict(
+                (status, -count) for status, count in \
+                    (self.status_counts or {}).items()
+            ),
+            -(self.hours or 0)
+        )
+        self.changed()
+        return super(TaskList, self).delete(*args, **kwargs)
+
+    def changed(self):
+        """
+        Invalidate the cached views of the tasklist and its project
+        """
+        touch(TaskList, self.id)
+        self.project.changed()
+
+    def update_counters(self, statuses=None, hours=0, changed=False):
+        """
+        Add to the status counts and the hours of the tasklist and its
+        project in a single update of each. The counters are incremented in
+        the database, so concurrent changes add up, and the counters of the
+        document are left as loaded.
+
+        :param statuses: Dictionary of status to the change in the number
+                         of tasks in the status
+        :param hours: The hours spent, negative to take them off
+        :param changed: Also increment the versions of the tasklist and its
+                        project, see :func:`touch`
+        """
+        increments = dict(
+            ('status_counts.%s' % status, delta) \
+                for status, delta in (statuses or {}).items() \
+                if status and delta
+        )
+        if hours:
+            increments['hours'] = hours
+        if changed:
+            increments['version'] = 1
+        if not increments:
+            return
+        TaskList._get_collection().update(
+            {'_id': self.id}, {'$inc': increments}
+        )
+        Project._get_collection().update(
+            {'_id': reference_id(self, 'project')}, {'$inc': increments}
+        )
 
 
 class Task(Document):
@@ -211,17 +639,667 @@ class Task(Document):
 
     #: The reference to the task list
     task_list = ReferenceField(TaskList, required=True)
-    follow_ups = ListField(EmbeddedDocumentField(FollowUp))
 
-    #: Sequence id for each task list
-    sequence = SequenceField(unique=True)
+    #: The number of follow ups, which are stored in FollowUpBucket pages
+    follow_up_count = IntField(default=0)
+
+    #: The hours spent on the task, the sum of the hours of its follow ups
+    #: which is kept up to date by :meth:`add_follow_up`
+    hours = FloatField(default=0)
+
+    #: Sequence id of the task within its task list
+    sequence = IntField(verbose_name=_("Sequence"))
+
+    #: Incremented whenever the task or its follow ups change, see
+    #: :func:`touch`
+    version = IntField(default=0)
+
+    #: The keywords of the title, which rank higher in searches
+    title_keywords = ListField(StringField())
+
+    #: The keywords of the title and of the follow up messages, see
+    #: :func:`keywords`
+    keywords = ListField(StringField())
+
+    meta = {
+        'indexes': [
+            {'fields': ('task_list', 'sequence'), 'unique': True},
+            ('keywords', 'task_list'),
+        ],
+        # Tasks which are not migrated yet still carry the follow_ups list,
+        # see FollowUpBucket.migrate
+        'strict': False,
+        'auto_create_index': False,
+    }
+
+    def save(self, *args, **kwargs):
+        """
+        Save the task and invalidate the cached views of its project. A new
+        task gets the next sequence of its task list and is counted in its
+        status, see `TaskList.update_counters`.
+        """
+        task_list_id = reference_id(self, 'task_list')
+        if self.sequence is None and task_list_id is not None:
+            self.sequence = SEQUENCES.next('task_list', task_list_id)
+        created = self.pk is None
+        status_changed = not created and 'status' in self._changed_fields
+        if status_changed:
+            previous = Task._get_collection().find_one(
+                {'_id': self.pk}, {'status': 1}
+            )
+            previous_status = previous and previous.get('status')
+        self.update_keywords()
+        result = super(Task, self).save(*args, **kwargs)
+        statuses = None
+        if created:
+            statuses = {self.status: 1}
+        elif status_changed and previous_status != self.status:
+            statuses = {previous_status: -1, self.status: 1}
+        self.changed(statuses)
+        return result
+
+    def delete(self, *args, **kwargs):
+        """
+        Delete the task along with its follow ups and invalidate the cached
+        views of its project.
+        """
+        self.changed({self.status: -1}, -(self.hours or 0))
+        Blob.release([
+            file_id for bucket in FollowUpBucket._get_collection().find(
+                FollowUpBucket.objects(task=self)._query,
+                {'follow_ups.attachments': 1}
+            ) for follow_up in bucket.get('follow_ups') or []
+            for file_id in follow_up.get('attachments') or []
+        ])
+        FollowUpBucket.objects(task=self).delete()
+        return super(Task, self).delete(*args, **kwargs)
+
+    def update_keywords(self):
+        """
+        Add the keywords of the title. The keywords of the follow ups are
+        kept and so are the ones of a previous title, until the task is
+        reindexed.
+        """
+        self.title_keywords = keywords(self.title)
+        self.keywords = sorted(
+            set(self.keywords or []) | set(self.title_keywords)
+        )
+
+    def reindex(self):
+        """
+        Rebuild the keywords of the task from its title and follow ups
+        """
+        words = set(keywords(self.title))
+        for bucket in FollowUpBucket.objects(task=self).only('follow_ups'):
+            for follow_up in bucket.follow_ups:
+                words.update(keywords(follow_up.message))
+        self.title_keywords = keywords(self.title)
+        self.keywords = sorted(words)
+        Task.objects(id=self.id).update_one(
+            set__title_keywords=self.title_keywords,
+            set__keywords=self.keywords
+        )
+
+    def changed(self, statuses=None, hours=0):
+        """
+        Invalidate the cached views of the task, its tasklist and its
+        project. Changes to the counters of the tasklist and the project
+        are made in the same update as their versions, see
+        `TaskList.update_counters`.
+
+        :param statuses: Dictionary of status to the change in the number
+                         of tasks in the status
+        :param hours: The hours added to the task, negative to take them off
+        """
+        touch(Task, self.id)
+        self.task_list.update_counters(statuses, hours, changed=True)
+
+    @classmethod
+    def summaries(cls, tasklists, limit=None):
+        """
+        Returns a dictionary with key=tasklist and values=list of tasks in
+        the tasklist ordered by sequence.
+
+        The tasks of all the tasklists are fetched with a single aggregation
+        grouped by tasklist, which projects only the title, status and
+        sequence. The returned tasks are thus partial documents meant for
+        display and must not be saved.
+
+        :param tasklists: Iterable of TaskList documents
+        :param limit: If given, at most these many tasks per tasklist
+        """
+        summaries = dict((tasklist, []) for tasklist in tasklists)
+        if not summaries:
+            return summaries
+        by_id = dict((tasklist.id, tasklist) for tasklist in summaries)
+        pipeline = [
+            {'$match': cls.objects(task_list__in=by_id.values())._query},
+            {'$sort': {'sequence': 1}},
+            {'$group': {
+                '_id': '$task_list',
+                'tasks': {'$push': {
+                    '_id': '$_id',
+                    'title': '$title',
+                    'status': '$status',
+                    'sequence': '$sequence',
+                }},
+            }},
+        ]
+        if limit is not None:
+            pipeline.append(
+                {'$project': {'tasks': {'$slice': ['$tasks', limit]}}}
+            )
+        result = cls._get_collection().aggregate(pipeline)
+        if isinstance(result, dict):
+            # Older pymongo returns the raw command response
+            result = result['result']
+        for group in result:
+            tasklist = by_id[getattr(group['_id'], 'id', group['_id'])]
+            summaries[tasklist] = [
+                cls(
+                    id=task['_id'], title=task.get('title'),
+                    status=task.get('status'), sequence=task.get('sequence'),
+                    task_list=tasklist
+                ) for task in group['tasks']
+            ]
+        return summaries
 
     @property
-    def hours(self):
+    def follow_up_pages(self):
+        """
+        The number of pages of follow ups
+        """
+        return (self.follow_up_count + FollowUpBucket.BUCKET_SIZE - 1) // \
+            FollowUpBucket.BUCKET_SIZE
+
+    def add_follow_up(self, follow_up, watchers=None):
+        """
+        Apply a follow up to the task and append it to the last page of its
+        follow ups.
+
+        This makes three writes, in order. First a single atomic update of
+        the task sets the status and assignee the follow up changes to,
+        adds the watchers and the keywords of the message, increments the
+        follow up count and the hours and returns the status and assignee
+        the follow up changed from. The count decides the page the follow
+        up goes to, so concurrent follow ups are neither lost nor overfill
+        a page. Then the follow up is pushed to its page, see
+        `FollowUpBucket.push`, and last the counters of the task list and
+        the project are updated. The writes are not a transaction: if a
+        later one fails the earlier ones are kept. The task then counts a
+        follow up its pages lack, and the hours and status counts can be
+        recomputed with `repair_counters`. The task is updated in place
+        and is never saved as a whole.
+
+        :param follow_up: The FollowUp
+        :param watchers: Users to add to the watchers of the task
+        """
+        follow_up.validate()
+        watchers = [watcher for watcher in (watchers or []) if watcher]
+        words = keywords(follow_up.message)
+        update = {'$inc': {'follow_up_count': 1, 'version': 1}}
+        if follow_up.hours:
+            update['$inc']['hours'] = follow_up.hours
+        changes = {}
+        if follow_up.to_status:
+            changes['status'] = follow_up.to_status
+        if follow_up.to_assignee:
+            changes['assigned_to'] = follow_up.to_assignee
+        if changes:
+            update['$set'] = dict(
+                (name, self._fields[name].to_mongo(value))
+                for name, value in changes.items()
+            )
+        if watchers:
+            update.setdefault('$addToSet', {})['watchers'] = {'$each': [
+                self._fields['watchers'].field.to_mongo(watcher)
+                for watcher in watchers
+            ]}
+        if words:
+            update.setdefault('$addToSet', {})['keywords'] = {'$each': words}
+        previous = self._get_collection().find_and_modify(
+            query={'_id': self.id}, update=update,
+            fields={
+                'follow_up_count': 1, 'status': 1, 'assigned_to': 1,
+                'hours': 1,
+            }
+        )
+        if previous is None:
+            raise self.DoesNotExist("Task %s does not exist" % self.id)
+
+        follow_up.from_status = previous.get('status')
+        stored = follow_up.to_mongo()
+        # The previous assignee is recorded as it is stored in the task
+        if previous.get('assigned_to') is not None:
+            stored['from_assignee'] = previous['assigned_to']
+        self.follow_up_count = previous.get('follow_up_count', 0) + 1
+        self.hours = (previous.get('hours') or 0) + (follow_up.hours or 0)
+        for name, value in changes.items():
+            setattr(self, name, value)
+        for watcher in watchers:
+            if watcher not in self.watchers:
+                self.watchers.append(watcher)
+        self.keywords = sorted(set(self.keywords or []) | set(words))
+        statuses = None
+        if 'status' in changes and previous.get('status') != self.status:
+            statuses = {previous.get('status'): -1, self.status: 1}
+
+        FollowUpBucket.push(
+            self, (self.follow_up_count - 1) // FollowUpBucket.BUCKET_SIZE,
+            [stored]
+        )
+        # The version of the task was incremented along with its counters
+        self.task_list.update_counters(
+            statuses, follow_up.hours, changed=True
+        )
+
+    def get_follow_ups(self, page=0):
+        """
+        Returns the list of follow ups on a page, oldest first
+
+        :param page: The page number starting from 0
+        """
+        bucket = FollowUpBucket.objects(task=self, page=page).first()
+        return bucket.follow_ups if bucket else []
+
+
+class FollowUpBucket(Document):
+    """
+    A page of the follow ups of a task.
+
+    Follow ups are kept out of the task so that adding one does not rewrite
+    the task, and loading tasks does not load their entire history.
+    """
+
+    #: The number of follow ups on a page
+    BUCKET_SIZE = 50
+
+    #: The task followed up
+    task = ReferenceField(Task, required=True, verbose_name=_("Task"))
+
+    #: The page number starting from 0
+    page = IntField(required=True, verbose_name=_("Page"))
+
+    #: The number of follow ups on the page
+    count = IntField(default=0)
+
+    #: The follow ups in the order they were made
+    follow_ups = ListField(EmbeddedDocumentField(FollowUp))
+
+    meta = {
+        'indexes': [
+            {'fields': ('task', 'page'), 'unique': True},
+            'follow_ups.attachments',
+        ],
+        'auto_create_index': False,
+    }
+
+    @classmethod
+    def push(cls, task, page, follow_ups):
+        """
+        Append follow ups to a page of the task, creating the page if it
+        does not exist.
+
+        :param task: The Task or its id
+        :param page: The page number
+        :param follow_ups: List of follow ups as stored in the database
+        """
+        query = cls.objects(task=task, page=page)._query
+        update = {
+            '$push': {'follow_ups': {'$each': follow_ups}},
+            '$inc': {'count': len(follow_ups)},
+        }
+        try:
+            cls._get_collection().update(query, update, upsert=True)
+        except DuplicateKeyError:
+            # A concurrent push created the page first
+            cls._get_collection().update(query, update)
+
+    @classmethod
+    def migrate(cls):
+        """
+        Move the follow ups embedded in the tasks into buckets. Tasks which
+        are already migrated are skipped, so the migration can be rerun if
+        it is interrupted. Returns the number of tasks migrated.
+
+        Follow ups made after the deploy are already in buckets, even for
+        tasks which are not migrated yet. The embedded follow ups, which are
+        older, are put in front of them and the pages are renumbered. The
+        migration of a task must not run while it is being commented on.
+        """
+        tasks = Task._get_collection()
+        buckets = cls._get_collection()
+        migrated = 0
+        for task in tasks.find(
+                {'follow_ups': {'$exists': True}}, {'follow_ups': 1}):
+            embedded = task['follow_ups'] or []
+            bucketed = []
+            for bucket in buckets.find(
+                    {'task': task['_id']}, {'follow_ups': 1}).sort('page'):
+                bucketed.extend(bucket.get('follow_ups') or [])
+            if bucketed[:len(embedded)] == embedded:
+                # Written by an interrupted run
+                bucketed = bucketed[len(embedded):]
+            follow_ups = embedded + bucketed
+            pages = 0
+            for page, start in enumerate(
+                    range(0, len(follow_ups), cls.BUCKET_SIZE)):
+                page_follow_ups = follow_ups[start:start + cls.BUCKET_SIZE]
+                buckets.update(
+                    {'task': task['_id'], 'page': page},
+                    {'$set': {
+                        'follow_ups': page_follow_ups,
+                        'count': len(page_follow_ups),
+                    }},
+                    upsert=True
+                )
+                pages = page + 1
+            buckets.remove({'task': task['_id'], 'page': {'$gte': pages}})
+            tasks.update(
+                {'_id': task['_id']},
+                {
+                    '$unset': {'follow_ups': 1},
+                    '$set': {'follow_up_count': len(follow_ups)},
+                }
+            )
+            migrated += 1
+        return migrated
+
+
+class Blob(Document):
+    """
+    A file in GridFS which is stored once however many times it is
+    uploaded, identified by the SHA-256 of its content.
+
+    Every attachment and organisation image referencing the file holds a
+    reference to it, which is counted by the blob. Blobs which are no longer
+    referenced are deleted along with their files by
+    :func:`attachments.collect`.
+    """
+
+    #: The hex SHA-256 of the content
+    sha256 = StringField(required=True, unique=True)
+
+    #: The GridFS id of the file
+    file_id = ObjectIdField(required=True)
+
+    #: The size of the file in bytes
+    length = IntField(default=0)
+
+    #: The number of references to the file
+    refcount = IntField(default=0)
+
+    meta = {
+        'indexes': [
+            'file_id',
+            'refcount',
+        ],
+        'auto_create_index': False,
+    }
+
+    @classmethod
+    def acquire(cls, sha256, file_id, length):
+        """
+        Reference the blob of a content, which is created with the file if
+        the content is new. Returns the id of the file to reference, which
+        is not file_id if the content was already stored, in which case the
+        file is a duplicate to delete.
+
+        :param sha256: The hex SHA-256 of the content
+        :param file_id: The GridFS id of a file with the content
+        :param length: The size of the file in bytes
+        """
+        try:
+            blob = cls._get_collection().find_and_modify(
+                query={'sha256': sha256},
+                update={
+                    '$inc': {'refcount': 1},
+                    '$setOnInsert': {'file_id': file_id, 'length': length},
+                },
+                upsert=True, new=True
+            )
+        except DuplicateKeyError:
+            # The same content was stored concurrently
+            return cls.reference(sha256) or cls.acquire(
+                sha256, file_id, length
+            )
+        return blob['file_id']
+
+    @classmethod
+    def reference(cls, sha256):
+        """
+        Reference the blob of a content which is already stored. Returns the
+        id of its file, or None if the content is not stored.
+
+        :param sha256: The hex SHA-256 of the content
+        """
+        blob = cls._get_collection().find_and_modify(
+            query={'sha256': sha256},
+            update={'$inc': {'refcount': 1}},
+            fields={'file_id': 1}
+        )
+        return blob and blob['file_id']
+
+    @classmethod
+    def release(cls, file_ids):
         """
-        A property to sum up all the time from every followups and return a
-        timedelta object.
+        Release references to files. Files which are not blobs, like the
+        ones stored before deduplication, are ignored.
 
-        #: TODO
+        :param file_ids: The GridFS ids of the files, once per reference
         """
-        return 0
+        for file_id, count in Counter(file_ids).items():
+            cls._get_collection().update(
+                {'file_id': file_id}, {'$inc': {'refcount': -count}}
+            )
+
+
+def migrate_sequences():
+    """
+    Move the tasklist and task sequences from the global counters to the
+    counters of their project and tasklist. The existing sequences are
+    kept and the new ones continue after the largest of each scope.
+    Returns the number of scopes seeded.
+    """
+    seeded = 0
+    for document, scope in ((TaskList, 'project'), (Task, 'task_list')):
+        collection = document._get_collection()
+        # The global unique index would reject the same sequence in two
+        # scopes
+        if 'sequence_1' in collection.index_information():
+            collection.drop_index('sequence_1')
+        result = collection.aggregate([
+            {'$group': {
+                '_id': '$' + scope, 'sequence': {'$max': '$sequence'}
+            }},
+        ])
+        if isinstance(result, dict):
+            # Older pymongo returns the raw command response
+            result = result['result']
+        for group in result:
+            if group['_id'] is None or group['sequence'] is None:
+                continue
+            SEQUENCES.seed(
+                group['sequence'], scope,
+                getattr(group['_id'], 'id', group['_id'])
+            )
+            seeded += 1
+    SEQUENCES.reset()
+    return seeded
+
+
+def _aggregate(document, pipeline):
+    """
+    Returns the results of an aggregation on the collection of a document
+    """
+    result = document._get_collection().aggregate(pipeline)
+    if isinstance(result, dict):
+        # Older pymongo returns the raw command response
+        result = result['result']
+    return result
+
+
+def repair_counters():
+    """
+    Recompute the hours of every task from its follow ups and the status
+    counts and hours of every tasklist and project from their tasks,
+    correcting counters which have drifted. Tasks changed while the repair
+    runs may be counted wrong, so it is best run when the site is quiet.
+    Returns the number of tasklists recounted.
+    """
+    Task.objects.update(set__hours=0)
+    for group in _aggregate(FollowUpBucket, [
+            {'$unwind': '$follow_ups'},
+            {'$group': {
+                '_id': '$task', 'hours': {'$sum': '$follow_ups.hours'},
+            }}]):
+        Task.objects(id=getattr(group['_id'], 'id', group['_id'])).update_one(
+            set__hours=group['hours']
+        )
+
+    tasklist_counts, tasklist_hours = {}, {}
+    for group in _aggregate(Task, [
+            {'$group': {
+                '_id': {'task_list': '$task_list', 'status': '$status'},
+                'count': {'$sum': 1},
+                'hours': {'$sum': '$hours'},
+            }}]):
+        task_list = group['_id'].get('task_list')
+        if task_list is None:
+            continue
+        task_list = getattr(task_list, 'id', task_list)
+        tasklist_hours[task_list] = \
+            tasklist_hours.get(task_list, 0) + group['hours']
+        if group['_id'].get('status') is not None:
+            tasklist_counts.setdefault(
+                task_list, {}
+            )[group['_id']['status']] = group['count']
+
+    project_counts, project_hours = {}, {}
+    recounted = 0
+    for tasklist in TaskList.objects.only('project'):
+        counts = tasklist_counts.get(tasklist.id, {})
+        hours = tasklist_hours.get(tasklist.id, 0)
+        TaskList.objects(id=tasklist.id).update_one(
+            set__status_counts=counts, set__hours=hours, inc__version=1
+        )
+        project_id = reference_id(tasklist, 'project')
+        totals = project_counts.setdefault(project_id, {})
+        for status, count in counts.items():
+            totals[status] = totals.get(status, 0) + count
+        project_hours[project_id] = project_hours.get(project_id, 0) + hours
+        recounted += 1
+    for project in Project.objects.only('id'):
+        Project.objects(id=project.id).update_one(
+            set__status_counts=project_counts.get(project.id, {}),
+            set__hours=project_hours.get(project.id, 0),
+            inc__version=1
+        )
+    return recounted
+
+
+class OutboxMessage(Document):
+    """
+    An email waiting to be delivered by the outbox worker, see
+    :mod:`outbox`
+    """
+
+    #: The envelope sender
+    sender = StringField(required=True, verbose_name=_("Sender"))
+
+    #: The envelope recipients
+    recipients = ListField(
+        StringField(), required=True, verbose_name=_("Recipients")
+    )
+
+    #: The rendered MIME message
+    message = StringField(required=True, verbose_name=_("Message"))
+
+    #: pending messages are delivered by the worker, sending messages are
+    #: claimed by a worker and dead messages have exhausted their attempts.
+    #: Messages are deleted once they are sent.
+    status = StringField(
+        required=True, default="pending", verbose_name=_("Status"),
+        choices=[
+            ('pending', 'Pending'),
+            ('sending', 'Sending'),
+            ('dead', 'Dead'),
+        ]
+    )
+
+    #: Number of failed delivery attempts
+    attempts = IntField(default=0, verbose_name=_("Attempts"))
+
+    #: The message is not retried before this time
+    next_attempt = DateTimeField(
+        default=datetime.utcnow, verbose_name=_("Next Attempt")
+    )
+
+    #: When the message was claimed by a worker
+    claimed_at = DateTimeField(verbose_name=_("Claimed At"))
+
+    #: The error of the last failed attempt
+    last_error = StringField(verbose_name=_("Last Error"))
+
+    created_at = DateTimeField(
+        default=datetime.utcnow, verbose_name=_("Created At")
+    )
+
+    meta = {
+        'indexes': [
+            ('status', 'next_attempt'),
+        ],
+        'auto_create_index': False,
+    }
+
+
+class Notification(Document):
+    """
+    An event on a task waiting to be sent to a user in a digest, see
+    :mod:`notifications`
+    """
+
+    #: The user to be notified
+    recipient = ReferenceField(
+        User, required=True, verbose_name=_("Recipient")
+    )
+
+    #: The task on which the event happened
+    task = ReferenceField(Task, required=True, verbose_name=_("Task"))
+
+    #: The title and link of the task at the time of the event, so that the
+    #: digest need not look up the task and its parents.
+    title = StringField(required=True, verbose_name=_("Title"))
+    url = StringField(required=True, verbose_name=_("URL"))
+
+    #: The kind of event
+    kind = StringField(
+        required=True, verbose_name=_("Kind"), choices=[
+            ('assigned', _('Assigned to you')),
+            ('comment', _('New comment')),
+        ]
+    )
+
+    #: The user who caused the event
+    actor = ReferenceField(User, verbose_name=_("Actor"))
+
+    #: The comment or a description of the event
+    message = StringField(verbose_name=_("Message"))
+
+    created_at = DateTimeField(
+        default=datetime.utcnow, verbose_name=_("Created At")
+    )
+
+    #: Set by the digest worker which is sending this notification
+    claim = StringField(verbose_name=_("Claim"))
+
+    #: When the notification was claimed by a digest worker
+    claimed_at = DateTimeField(verbose_name=_("Claimed At"))
+
+    meta = {
+        'indexes': [
+            ('recipient', 'created_at'),
+            'claim',
+        ],
+        'auto_create_index': False,
+    }
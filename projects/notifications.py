@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    notifications
+
+    Notify the watchers of tasks in digests.
+
+    Comments on a task :func:`notify` its watchers and assignee, which only
+    records a :class:`Notification` per recipient. The
+    :class:`DigestWorker` collects the notifications of every recipient
+    until the oldest of them is `User.digest_interval` minutes old and then
+    queues a single digest email for all of them in the outbox.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import logging
+import uuid
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+from tornado import template
+from tornado.options import options
+from monstor.utils.i18n import _
+
+from .models import User, Notification, reference_ids
+from . import executor, outbox
+
+
+def notify(task, actor, message, url, assignee=None):
+    """
+    Record an event on the task for its watchers and assignee, except the
+    user who caused it. Returns the list of notifications.
+
+    :param task: The Task
+    :param actor: The User who commented
+    :param message: The comment
+    :param url: Absolute URL of the task
+    :param assignee: The User the task is assigned to, if it changed
+    """
+    recipient_ids = set(reference_ids(task, 'watchers'))
+    assignee_id = assignee.id if assignee is not None else None
+    if assignee_id is not None:
+        recipient_ids.add(assignee_id)
+    recipient_ids.discard(actor.id)
+    notifications = [
+        Notification(
+            recipient=recipient_id, task=task, title=task.title, url=url,
+            kind='assigned' if recipient_id == assignee_id else 'comment',
+            actor=actor, message=message
+        ) for recipient_id in recipient_ids
+    ]
+    if notifications:
+        Notification.objects.insert(notifications)
+    return notifications
+
+
+class DigestWorker(executor.PeriodicWorker):
+    """
+    Send the digests which are due
+
+    :param template_path: Directory of the email templates
+    :param interval: Seconds between the runs
+    :param claim_timeout: Seconds after which notifications claimed by a
+                          worker which never sent them are sent again
+    :param db_threads: The run is made on the database threads, see
+                       :mod:`executor`
+    """
+
+    def __init__(self, template_path, interval=60, claim_timeout=600,
+            db_threads=0):
+        super(DigestWorker, self).__init__(interval, db_threads)
+        self.loader = template.Loader(template_path)
+        self.claim_timeout = claim_timeout
+
+    def run(self):
+        return self.send_due()
+
+    def send_due(self, now=None):
+        """
+        Queue the digests of all the recipients whose oldest notification
+        is older than their digest interval. Returns the number of digests.
+        """
+        # Release the notifications of workers which died while sending
+        Notification.objects(
+            claim__ne=None, claimed_at__lt=datetime.utcnow() - timedelta(
+                seconds=self.claim_timeout
+            )
+        ).update(set__claim=None, unset__claimed_at=True)
+
+        now = now or datetime.utcnow()
+        result = Notification._get_collection().aggregate([
+            {'$match': {'claim': None}},
+            {'$group': {
+                '_id': '$recipient', 'oldest': {'$min': '$created_at'}
+            }},
+        ])
+        if isinstance(result, dict):
+            # Older pymongo returns the raw command response
+            result = result['result']
+        oldest = dict(
+            (getattr(group['_id'], 'id', group['_id']), group['oldest'])
+            for group in result
+        )
+        if not oldest:
+            return 0
+        sent = 0
+        for user in User.objects(id__in=oldest.keys()):
+            window = timedelta(minutes=user.digest_interval or 0)
+            if oldest[user.id] + window > now:
+                continue
+            if self.send_digest(user, now):
+                sent += 1
+        return sent
+
+    def send_digest(self, user, now):
+        """
+        Claim the notifications of the user up to now and queue them as one
+        email. Returns False if another worker claimed them first or the
+        digest could not be queued, in which case the notifications are
+        released for the next run.
+        """
+        claim = uuid.uuid4().hex
+        Notification.objects(
+            recipient=user, claim=None, created_at__lte=now
+        ).update(set__claim=claim, set__claimed_at=datetime.utcnow())
+        notifications = list(
+            Notification.objects(claim=claim).order_by('created_at')
+        )
+        if not notifications:
+            return False
+        try:
+            outbox.enqueue(
+                options.email_sender, user.email,
+                self.render(user, notifications).as_string()
+            )
+        except Exception:
+            logging.exception("Could not queue the digest of %s", user.email)
+            Notification.objects(claim=claim).update(
+                set__claim=None, unset__claimed_at=True
+            )
+            return False
+        Notification.objects(claim=claim).delete()
+        return True
+
+    def render(self, user, notifications):
+        """
+        Returns the digest email as a MIME message
+        """
+        parts = []
+        for name, subtype in (
+                ('emails/digest-text.html', 'plain'),
+                ('emails/digest-html.html', 'html')):
+            try:
+                body = self.loader.load(name).generate(
+                    user=user, notifications=notifications
+                )
+            except IOError:
+                logging.warning('No template %s', name)
+                continue
+            parts.append(MIMEText(body, subtype, 'utf-8'))
+
+        if len(notifications) == 1 and notifications[0].kind == 'assigned':
+            subject = _("Task Assigned to you")
+        else:
+            subject = _(
+                "%(count)s updates on your tasks", count=len(notifications)
+            )
+        message = MIMEMultipart('alternative')
+        message['Subject'] = subject
+        message['From'] = options.email_sender
+        message['To'] = user.email
+        for part in parts:
+            message.attach(part)
+        return message
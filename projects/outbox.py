@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    outbox
+
+    Deliver emails in the background.
+
+    Handlers do not talk to the mail server. They :func:`enqueue` the
+    rendered message, which only inserts an :class:`OutboxMessage`, and
+    return. The :class:`OutboxWorker` of every titand process periodically
+    claims the pending messages and delivers them over a persistent SMTP
+    connection. Failed deliveries are retried with exponential backoff and
+    messages which fail `max_attempts` times are marked dead for a human to
+    look at.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import logging
+import smtplib
+from datetime import datetime, timedelta
+
+from tornado.options import options
+
+from .models import OutboxMessage
+from . import executor
+
+
+def enqueue(sender, recipients, message):
+    """
+    Queue a message for delivery and return the OutboxMessage
+
+    :param sender: The envelope sender
+    :param recipients: An email address or a list of them
+    :param message: The rendered MIME message as a string
+    """
+    if isinstance(recipients, basestring):
+        recipients = [recipients]
+    return OutboxMessage(
+        sender=sender, recipients=recipients, message=message
+    ).save()
+
+
+def queue_depth():
+    """
+    Returns the number of messages in the outbox by status, with every
+    status present
+    """
+    depth = dict((status, 0) for status, label in \
+        OutboxMessage.status.choices)
+    result = OutboxMessage._get_collection().aggregate([
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+    ])
+    if isinstance(result, dict):
+        # Older pymongo returns the raw command response
+        result = result['result']
+    for group in result:
+        depth[group['_id']] = group['count']
+    return depth
+
+
+class SMTPConnection(object):
+    """
+    A persistent connection to the mail server, which is opened on first
+    use and reopened when the server drops it.
+
+    The settings default to the smtp_* options.
+    """
+
+    def __init__(self, host=None, port=None, ssl=None, tls=None, user=None,
+            password=None):
+        self.host = host or getattr(options, 'smtp_server', 'localhost')
+        self.port = port or getattr(options, 'smtp_port', 25)
+        self.ssl = getattr(options, 'smtp_ssl', False) if ssl is None else ssl
+        self.tls = getattr(options, 'smtp_tls', False) if tls is None else tls
+        self.user = user or getattr(options, 'smtp_user', None)
+        self.password = password or getattr(options, 'smtp_password', None)
+        self._smtp = None
+
+    def connect(self):
+        """
+        Open the connection
+        """
+        if self.ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port)
+        if self.tls:
+            smtp.starttls()
+        if self.user:
+            smtp.login(self.user, self.password)
+        self._smtp = smtp
+
+    def close(self):
+        """
+        Close the connection, ignoring errors from a dead connection
+        """
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, IOError):
+                pass
+            self._smtp = None
+
+    def sendmail(self, sender, recipients, message):
+        """
+        Send a message, reconnecting once if the connection was dropped
+        """
+        if self._smtp is None:
+            self.connect()
+        try:
+            return self._smtp.sendmail(sender, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            self.connect()
+            return self._smtp.sendmail(sender, recipients, message)
+
+
+class OutboxWorker(executor.PeriodicWorker):
+    """
+    Drain the outbox periodically
+
+    :param connection: SMTPConnection used for delivery
+    :param interval: Seconds between the runs
+    :param batch_size: Messages delivered per run
+    :param max_attempts: Attempts after which a message is dead
+    :param backoff: Seconds before the first retry, doubled every attempt
+    :param claim_timeout: Seconds after which a message claimed by a
+                          worker which never finished it is retried
+    :param db_threads: The run is made on the database threads, see
+                       :mod:`executor`
+    """
+
+    def __init__(self, connection=None, interval=5, batch_size=50,
+            max_attempts=8, backoff=60, claim_timeout=600, db_threads=0):
+        super(OutboxWorker, self).__init__(interval, db_threads)
+        self.connection = connection or SMTPConnection()
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.claim_timeout = claim_timeout
+
+    def run(self):
+        return self.deliver_pending()
+
+    def stop(self):
+        """
+        Stop draining the outbox
+        """
+        super(OutboxWorker, self).stop()
+        self.connection.close()
+
+    def deliver_pending(self):
+        """
+        Deliver a batch of due messages and return the number delivered
+        """
+        now = datetime.utcnow()
+        # Release the messages of workers which died while sending
+        OutboxMessage.objects(
+            status='sending',
+            claimed_at__lt=now - timedelta(seconds=self.claim_timeout)
+        ).update(set__status='pending')
+
+        delivered = 0
+        due = OutboxMessage.objects(
+            status='pending', next_attempt__lte=now
+        ).order_by('next_attempt').limit(self.batch_size)
+        for message in due:
+            claimed = OutboxMessage.objects(
+                id=message.id, status='pending'
+            ).update_one(set__status='sending', set__claimed_at=now)
+            if not claimed:
+                # Another worker got it first
+                continue
+            if self.deliver(message):
+                delivered += 1
+        return delivered
+
+    def deliver(self, message):
+        """
+        Deliver a claimed message. On success the message is deleted, else
+        it is scheduled for a retry or marked dead. Returns True on success.
+
+        Any error counts as a failed attempt, not only those of the mail
+        server, so that a message which can never be sent, like one which
+        does not encode, ends up dead instead of being claimed forever.
+        """
+        try:
+            self.connection.sendmail(
+                message.sender, message.recipients, message.message
+            )
+        except Exception as exc:
+            if not isinstance(exc, (smtplib.SMTPException, IOError)):
+                logging.exception(
+                    "Unexpected error delivering outbox message %s",
+                    message.id
+                )
+            self.connection.close()
+            attempts = message.attempts + 1
+            if attempts >= self.max_attempts:
+                logging.error(
+                    "Giving up on outbox message %s: %s", message.id, exc
+                )
+                status = 'dead'
+            else:
+                status = 'pending'
+            OutboxMessage.objects(id=message.id).update_one(
+                set__status=status,
+                set__attempts=attempts,
+                set__last_error=unicode(exc),
+                set__next_attempt=datetime.utcnow() + timedelta(
+                    seconds=self.backoff * 2 ** (attempts - 1)
+                )
+            )
+            return False
+        message.delete()
+        return True
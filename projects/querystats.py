@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+    querystats
+
+    Count and time the database commands made for each request.
+
+    A pymongo command listener, see :func:`install`, records every command
+    against the :class:`QueryStats` of the request it is made for. The
+    handlers carry their stats in a stack context, which makes them
+    :func:`active` on the IOLoop thread whenever the request runs, and
+    :func:`bind` them to the calls they hand to the database threads, see
+    `BaseHandler.run_db`. Commands made while no request is active, like
+    the ones of the background workers, are counted as unattributed.
+
+    Commands are grouped by their shape, which is the command with every
+    value replaced by a placeholder, so that the same query made for
+    different documents has the same shape. A shape repeated more than a
+    threshold in one request is the mark of an N+1 query, a query made in
+    a loop instead of once for all the documents.
+
+    Command monitoring needs pymongo 3.1 or later. With older versions
+    :func:`install` returns False and nothing is recorded.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import heapq
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    from pymongo import monitoring
+except ImportError:
+    monitoring = None
+
+
+#: The keys of a command which do not change its shape, like the session
+#: and the options of the cursor
+IGNORED_KEYS = frozenset([
+    'lsid', '$db', '$clusterTime', '$readPreference', 'batchSize', 'cursor',
+    'getMore', 'limit', 'skip', 'singleBatch', 'maxTimeMS', 'ordered',
+    'writeConcern', 'txnNumber', 'comment',
+])
+
+_local = threading.local()
+
+
+def shape(command_name, command):
+    """
+    Returns the shape of a command as a string: the command and its
+    collection followed by the structure of its arguments with every value
+    replaced by `?`.
+
+    :param command_name: The name of the command, like `find`
+    :param command: The command document
+    """
+    arguments = ', '.join(
+        '%s: %s' % (key, _shape(value)) for key, value in command.items() \
+            if key != command_name and key not in IGNORED_KEYS
+    )
+    return '%s %s {%s}' % (command_name, command.get(command_name), arguments)
+
+
+def _shape(value):
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(
+            '%s: %s' % (key, _shape(item)) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        # A list of documents has the shape of its first document, a list
+        # of values is a value whatever its length
+        if value and isinstance(value[0], dict):
+            return '[%s]' % _shape(value[0])
+        return '[?]'
+    return '?'
+
+
+class QueryStats(object):
+    """
+    The database commands made for a request
+
+    :param slowest: The slowest commands kept
+    """
+
+    def __init__(self, slowest=3):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+        self._slowest = []
+        self._keep = slowest
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def record(self, shape, seconds):
+        """
+        Record a command
+
+        :param shape: The shape of the command, see :func:`shape`
+        :param seconds: The time the command took
+        """
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+            self.shapes[shape] += 1
+            if len(self._slowest) < self._keep:
+                heapq.heappush(self._slowest, (seconds, shape))
+            else:
+                heapq.heappushpop(self._slowest, (seconds, shape))
+
+    @property
+    def slowest(self):
+        """
+        The slowest commands as (seconds, shape) tuples, slowest first
+        """
+        with self._lock:
+            return sorted(self._slowest, reverse=True)
+
+    def repeated(self, threshold):
+        """
+        Returns the shapes made more than threshold times, with their
+        counts, most repeated first. These are likely N+1 queries.
+
+        :param threshold: The repetitions allowed
+        """
+        with self._lock:
+            return [
+                (shape, count) for shape, count in self.shapes.most_common() \
+                    if count > threshold
+            ]
+
+    def as_dict(self, threshold):
+        """
+        Returns the stats as a dictionary which can be logged as JSON
+
+        :param threshold: The repetitions allowed, see :meth:`repeated`
+        """
+        return {
+            'queries': self.count,
+            'db_ms': round(self.seconds * 1000, 2),
+            'slowest': [
+                {'ms': round(seconds * 1000, 2), 'shape': shape}
+                for seconds, shape in self.slowest
+            ],
+            'repeated': [
+                {'count': count, 'shape': shape}
+                for shape, count in self.repeated(threshold)
+            ],
+        }
+
+
+#: The commands made while no request was active
+UNATTRIBUTED = QueryStats()
+
+
+def current():
+    """
+    Returns the stats active on this thread, or None
+    """
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def active(stats):
+    """
+    Record the commands made on this thread against stats in the block,
+    restoring the previous stats after it
+    """
+    previous = current()
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+def bind(stats, function):
+    """
+    Returns a wrapper of function which records the commands it makes, on
+    whichever thread it is called, against stats
+
+    :param stats: A QueryStats
+    :param function: The function to wrap
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with active(stats):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class _Listener(monitoring.CommandListener if monitoring else object):
+    """
+    Record the commands against the stats active on the thread making them
+    """
+
+    def started(self, event):
+        stats = current() or UNATTRIBUTED
+        stats._pending[(event.connection_id, event.request_id)] = shape(
+            event.command_name, event.command
+        )
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        stats = current() or UNATTRIBUTED
+        command_shape = stats._pending.pop(
+            (event.connection_id, event.request_id), event.command_name
+        )
+        stats.record(command_shape, event.duration_micros / 1e6)
+
+
+_INSTALLED = []
+
+
+def install():
+    """
+    Register the command listener. It must be called before the database
+    connection is made, as the listeners are registered with the clients
+    when they are created. Returns False if command monitoring is not
+    supported by the installed pymongo.
+    """
+    if monitoring is None:
+        logging.warning("pymongo has no command monitoring, not recorded")
+        return False
+    if not _INSTALLED:
+        listener = _Listener()
+        monitoring.register(listener)
+        _INSTALLED.append(listener)
+    return True
+
+
+def log(stats, threshold, **context):
+    """
+    Log the stats of a request as a line of JSON, along with the context
+    of the request. Requests with repeated queries are logged as warnings.
+
+    :param stats: The QueryStats of the request
+    :param threshold: The repetitions allowed, see `QueryStats.repeated`
+    :param context: Items describing the request, like the path
+    """
+    record = dict(context)
+    record.update(stats.as_dict(threshold))
+    level = logging.WARNING if record['repeated'] else logging.INFO
+    logging.getLogger('titan.queries').log(
+        level, json.dumps(record, sort_keys=True)
+    )
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    search
+
+    Search the tasks of the projects a user can see.
+
+    Every task carries the :func:`keywords` of its title and follow up
+    messages, which are added as the task is saved and followed up, see
+    `Task.update_keywords`. A search finds the tasks having any of the
+    keywords of the query and ranks them by the number of keywords they
+    match, a keyword of the title counting twice. The matching and ranking
+    is done by the database.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from bson.son import SON
+
+from .models import (Organisation, Project, TaskList, Task, keywords,
+    reference_id)
+
+
+def search(query, team_ids, offset=0, limit=20):
+    """
+    Returns the ranked tasks matching the query, as a list of dictionaries
+    with the task, its score, its tasklist and its project, and whether
+    there are more results after them.
+
+    :param query: The text searched for
+    :param team_ids: The teams of the user, only the projects visible to
+                     them are searched, see `Project.visible_to`
+    :param offset: The results skipped
+    :param limit: The results returned at most
+    """
+    words = keywords(query)
+    if not words:
+        return [], False
+    projects = dict(
+        (project.id, project) for project in \
+            Project.visible_to(team_ids).only('name', 'slug', 'organisation')
+    )
+    if not projects:
+        return [], False
+    tasklist_ids = [
+        tasklist.id for tasklist in \
+            TaskList.objects(project__in=projects.keys()).only('id')
+    ]
+    if not tasklist_ids:
+        return [], False
+
+    def matched(field):
+        return {'$size': {'$setIntersection': [
+            {'$ifNull': ['$' + field, []]}, words
+        ]}}
+
+    result = Task._get_collection().aggregate([
+        {'$match': Task.objects(
+            keywords__in=words, task_list__in=tasklist_ids
+        )._query},
+        {'$project': {
+            'title': 1, 'status': 1, 'sequence': 1, 'task_list': 1,
+            'score': {'$add': [
+                {'$multiply': [2, matched('title_keywords')]},
+                matched('keywords'),
+            ]},
+        }},
+        {'$sort': SON([('score', -1), ('_id', -1)])},
+        {'$skip': offset},
+        {'$limit': limit + 1},
+    ])
+    if isinstance(result, dict):
+        # Older pymongo returns the raw command response
+        result = result['result']
+    tasks = list(result)
+    more = len(tasks) > limit
+    tasks = tasks[:limit]
+
+    tasklists = dict(
+        (tasklist.id, tasklist) for tasklist in TaskList.objects(
+            id__in=[getattr(t['task_list'], 'id', t['task_list']) \
+                for t in tasks]
+        ).only('name', 'sequence', 'project')
+    )
+    organisations = dict(
+        (organisation.id, organisation) for organisation in \
+            Organisation.objects(id__in=list(set(
+                reference_id(project, 'organisation') for project in \
+                    projects.values()
+            ))).only('name', 'slug')
+    )
+    results = []
+    for task in tasks:
+        tasklist = tasklists.get(
+            getattr(task['task_list'], 'id', task['task_list'])
+        )
+        if tasklist is None:
+            continue
+        project = projects[reference_id(tasklist, 'project')]
+        organisation = organisations.get(reference_id(project, 'organisation'))
+        if organisation is None:
+            continue
+        results.append({
+            'task': task,
+            'score': task['score'],
+            'tasklist': tasklist,
+            'project': project,
+            'organisation': organisation,
+        })
+    return results, more
+
+
+def reindex():
+    """
+    Rebuild the keywords of every task, see `Task.reindex`. Returns the
+    number of tasks reindexed.
+    """
+    count = 0
+    for task in Task.objects.only('title').timeout(False):
+        task.reindex()
+        count += 1
+    return count
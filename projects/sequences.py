@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    sequences
+
+    Sequence numbers scoped to a parent document.
+
+    Tasklists are numbered within their project and tasks within their
+    tasklist, each scope having its own counter document. A process does
+    not go to the database for every number. It reserves a block of
+    numbers from the counter at once and hands them out from memory, so
+    the numbers within a scope are unique but numbers of a block which a
+    process does not use before it exits are skipped.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+
+from mongoengine.connection import get_db
+
+
+class SequenceAllocator(object):
+    """
+    Hand out the sequence numbers of scopes in blocks
+
+    :param collection: Name of the collection of the counters
+    :param block_size: Numbers reserved from a counter at once
+    """
+
+    def __init__(self, collection='sequences', block_size=10):
+        self.collection = collection
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def key(self, *scope):
+        """
+        Returns the id of the counter document of the scope
+
+        :param scope: A tuple identifying the scope, like ('project', id)
+        """
+        return ':'.join(unicode(part) for part in scope)
+
+    def next(self, *scope):
+        """
+        Returns the next number of the scope
+
+        :param scope: A tuple identifying the scope, like ('project', id)
+        """
+        with self._lock:
+            start, end = self._blocks.get(scope, (1, 0))
+            if start > end:
+                start, end = self.reserve(self.block_size, *scope)
+            if start < end:
+                self._blocks[scope] = (start + 1, end)
+            else:
+                # The block is used up, the next number reserves another
+                self._blocks.pop(scope, None)
+            return start
+
+    def reserve(self, count, *scope):
+        """
+        Reserve a block of numbers from the counter of the scope, bypassing
+        the block held by the process. Returns the first and last number of
+        the block.
+
+        :param count: The number of numbers to reserve
+        :param scope: A tuple identifying the scope, like ('project', id)
+        """
+        counter = get_db()[self.collection].find_and_modify(
+            query={'_id': self.key(*scope)},
+            update={'$inc': {'value': count}},
+            upsert=True, new=True
+        )
+        return counter['value'] - count + 1, counter['value']
+
+    def seed(self, value, *scope):
+        """
+        Make sure the numbers of the scope handed out from now on are
+        greater than value
+
+        :param value: The largest number already in use
+        :param scope: A tuple identifying the scope, like ('project', id)
+        """
+        get_db()[self.collection].update(
+            {'_id': self.key(*scope)}, {'$max': {'value': value}},
+            upsert=True
+        )
+
+    def reset(self):
+        """
+        Forget the blocks held by the process
+        """
+        with self._lock:
+            self._blocks.clear()
+
+
+#: Allocator of the tasklist and task sequences
+SEQUENCES = SequenceAllocator()
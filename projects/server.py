@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+    server
+
+    Serve the application from several processes.
+
+    The :class:`Supervisor` binds nothing itself. The daemon binds the
+    listening sockets, then the supervisor forks the workers which share
+    them, and restarts any worker which dies. On SIGTERM or SIGINT the
+    supervisor passes SIGTERM on to the workers and waits for them to
+    exit.
+
+    A worker :func:`serve` s the application until it gets SIGTERM, when it
+    stops accepting connections and drains: the requests in progress are
+    given `drain_timeout` seconds to finish before the worker exits.
+
+    The database connection must only be made in the workers, after the
+    fork, as the connections cannot be shared by processes.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import errno
+import signal
+import logging
+import weakref
+
+from tornado import ioloop, httpserver
+
+
+class RequestTracker(object):
+    """
+    The requests in progress in the process, which are tracked by the
+    handlers from `prepare` to `on_finish`.
+    """
+
+    def __init__(self):
+        self._handlers = weakref.WeakSet()
+
+    def started(self, handler):
+        self._handlers.add(handler)
+
+    def finished(self, handler):
+        self._handlers.discard(handler)
+
+    def __len__(self):
+        return len(self._handlers)
+
+
+#: The requests in progress in the process
+REQUESTS = RequestTracker()
+
+
+def serve(application, sockets, background=(), drain_timeout=30,
+        on_shutdown=()):
+    """
+    Serve the application on the sockets until SIGTERM or SIGINT and then
+    drain the requests in progress.
+
+    :param application: The tornado Application
+    :param sockets: Listening sockets, see `tornado.netutil.bind_sockets`
+    :param background: Workers to start and stop along with the server,
+                       see `executor.PeriodicWorker`
+    :param drain_timeout: Seconds the requests in progress are given to
+                          finish on shutdown
+    :param on_shutdown: Functions called on shutdown, to close long lived
+                        connections like websockets
+    """
+    io_loop = ioloop.IOLoop.instance()
+    http_server = httpserver.HTTPServer(application)
+    http_server.add_sockets(sockets)
+    for worker in background:
+        worker.start()
+
+    state = {'stopping': False}
+
+    def shutdown():
+        if state['stopping']:
+            return
+        state['stopping'] = True
+        logging.info(
+            "Process %d draining %d requests", os.getpid(), len(REQUESTS)
+        )
+        http_server.stop()
+        for worker in background:
+            worker.stop()
+        for callback in on_shutdown:
+            callback()
+        deadline = time.time() + drain_timeout
+
+        def wait():
+            if not len(REQUESTS) or time.time() > deadline:
+                io_loop.stop()
+            else:
+                io_loop.add_timeout(time.time() + 0.1, wait)
+        wait()
+
+    def on_signal(signum, frame):
+        io_loop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    io_loop.start()
+
+
+class Supervisor(object):
+    """
+    Fork the worker processes and restart them when they die
+
+    :param workers: The number of worker processes
+    :param max_restarts: Restarts after which the supervisor gives up
+    """
+
+    def __init__(self, workers, max_restarts=100):
+        self.workers = workers
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.stopping = False
+        self.children = {}
+
+    def run(self, target):
+        """
+        Run target(task_id) in every worker process, task_id being the
+        number of the worker starting from 0, and wait until all of them
+        have exited.
+
+        A worker which exits with a status other than 0 or is killed is
+        restarted with the same task_id, unless the supervisor is stopping.
+
+        :param target: Function which serves until the worker has to exit
+        """
+        previous = dict(
+            (signum, signal.signal(signum, self.terminate)) \
+                for signum in (signal.SIGTERM, signal.SIGINT)
+        )
+        try:
+            self.supervise(target)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def supervise(self, target):
+        """
+        Start the workers and restart them until they have all exited
+        """
+        for task_id in range(self.workers):
+            self.spawn(target, task_id)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            task_id = self.children.pop(pid, None)
+            if task_id is None or self.stopping:
+                continue
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                logging.info("Worker %d (pid %d) exited", task_id, pid)
+                continue
+            logging.warning(
+                "Worker %d (pid %d) died with status %d, restarting",
+                task_id, pid, status
+            )
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                self.terminate()
+                raise RuntimeError("Too many worker restarts, giving up")
+            self.spawn(target, task_id)
+
+    def spawn(self, target, task_id):
+        """
+        Fork a worker running target(task_id)
+        """
+        pid = os.fork()
+        if pid == 0:
+            # The worker handles the signals itself, see :func:`serve`
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                target(task_id)
+            except Exception:
+                logging.exception("Worker %d failed", task_id)
+                status = 1
+            os._exit(status)
+        self.children[pid] = task_id
+
+    def terminate(self, signum=None, frame=None):
+        """
+        Stop the workers by sending them SIGTERM
+        """
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
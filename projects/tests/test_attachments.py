@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    test_attachments
+
+    Test the byte ranges of attachment downloads and the deduplication of
+    the stored files
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import timedelta
+
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import Blob
+from titan.projects.attachments import parse_range, grid_fs, collect
+
+
+class TestAttachments(unittest.TestCase):
+    """
+    Test parsing the Range header
+    """
+
+    def test_0010_ranges(self):
+        """
+        Single byte ranges are parsed and clipped to the file
+        """
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=900-2000', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-2000', 1000), (0, 999))
+
+    def test_0020_whole_file(self):
+        """
+        Missing, invalid and multiple ranges send the whole file
+        """
+        self.assertEqual(parse_range(None, 1000), None)
+        self.assertEqual(parse_range('bytes=-', 1000), None)
+        self.assertEqual(parse_range('bytes=99-0', 1000), None)
+        self.assertEqual(parse_range('bytes=0-1,5-6', 1000), None)
+        self.assertEqual(parse_range('items=0-1', 1000), None)
+
+    def test_0030_unsatisfiable(self):
+        """
+        Ranges after the end of the file cannot be satisfied
+        """
+        self.assertRaises(ValueError, parse_range, 'bytes=1000-', 1000)
+        self.assertRaises(ValueError, parse_range, 'bytes=-0', 1000)
+        self.assertRaises(ValueError, parse_range, 'bytes=0-', 0)
+
+
+class TestBlobs(unittest.TestCase):
+    """
+    Test the reference counting and collection of stored files
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_attachments")
+
+    def tearDown(self):
+        connection = _get_connection()
+        connection.drop_database('test_attachments')
+
+    def upload(self, content):
+        return grid_fs().put(content, filename="notes.txt", uploaded_by=1)
+
+    def test_0010_dedupe(self):
+        """
+        The same content is stored once and referenced by hash
+        """
+        first, second = self.upload("notes"), self.upload("notes")
+        self.assertEqual(Blob.acquire('abc', first, 5), first)
+        self.assertEqual(Blob.acquire('abc', second, 5), first)
+        self.assertEqual(Blob.reference('abc'), first)
+        self.assertEqual(Blob.reference('def'), None)
+        self.assertEqual(Blob.objects.get(sha256='abc').refcount, 3)
+
+    def test_0020_collect(self):
+        """
+        Released blobs and old unreferenced uploads are deleted, referenced
+        blobs and uploads in progress are kept
+        """
+        kept, released = self.upload("kept"), self.upload("released")
+        pending = self.upload("pending")
+        Blob.acquire('kept', kept, 4)
+        Blob.acquire('released', released, 8)
+        Blob.release([released])
+
+        self.assertEqual(collect(), 1)
+        self.assertFalse(grid_fs().exists(released))
+        self.assertTrue(grid_fs().exists(pending))
+        self.assertEqual(Blob.objects.count(), 1)
+
+        self.assertEqual(collect(timedelta(0)), 1)
+        self.assertFalse(grid_fs().exists(pending))
+        self.assertTrue(grid_fs().exists(kept))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    test_cache
+
+    Test the in-process caches
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest2 as unittest
+
+from titan.projects.cache import TTLCache
+
+
+class TestCache(unittest.TestCase):
+    """
+    Test the TTL cache and scope versions
+    """
+
+    def test_0010_get_set(self):
+        """
+        Values are returned until they expire
+        """
+        cache = TTLCache()
+        self.assertEqual(cache.get('key'), None)
+        cache.set('key', 'value', 60)
+        self.assertEqual(cache.get('key'), 'value')
+        cache.set('expired', 'value', -1)
+        self.assertEqual(cache.get('expired', 'default'), 'default')
+        self.assertEqual(len(cache), 1)
+
+    def test_0020_maxsize(self):
+        """
+        The oldest entries are evicted first once the cache is full
+        """
+        cache = TTLCache(maxsize=2)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key, 60)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('c'), 'c')
+        self.assertEqual(len(cache), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    test_events
+
+    Test the event bus and the feed between processes
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+
+import unittest2 as unittest
+from tornado import gen
+from tornado.ioloop import IOLoop
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.events import EventBus, EventFeed
+
+
+class TestEvents(unittest.TestCase):
+    """
+    Test publishing and subscribing to events
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_events")
+
+    def test_0010_publish(self):
+        """
+        Events go to the subscribers of their topic only
+        """
+        bus = EventBus()
+        received = []
+        bus.subscribe(('project', 1), received.append)
+        self.assertEqual(bus.publish(('project', 1), {'type': 'one'}), 1)
+        self.assertEqual(bus.publish(('project', 2), {'type': 'two'}), 0)
+        self.assertEqual(received, [{'type': 'one'}])
+
+        bus.unsubscribe(('project', 1), received.append)
+        self.assertEqual(bus.subscribers(('project', 1)), 0)
+        self.assertEqual(bus.publish(('project', 1), {'type': 'three'}), 0)
+
+    def test_0020_failing_subscriber(self):
+        """
+        A failing subscriber does not stop the others
+        """
+        bus = EventBus()
+        received = []
+
+        def fail(event):
+            raise ValueError(event)
+        bus.subscribe(('project', 1), fail)
+        bus.subscribe(('project', 1), received.append)
+        self.assertEqual(bus.publish(('project', 1), {'type': 'one'}), 2)
+        self.assertEqual(received, [{'type': 'one'}])
+
+    def test_0030_feed(self):
+        """
+        Events appended to the feed are published on the bus of every
+        process tailing it
+        """
+        bus = EventBus()
+        received = []
+        bus.subscribe(('project', 1), received.append)
+        feed = EventFeed(bus)
+        io_loop = IOLoop.current()
+        feed.start()
+        try:
+            feed.append(('project', 1), {'type': 'one'})
+            deadline = time.time() + 5
+            while not received and time.time() < deadline:
+                io_loop.run_sync(lambda: gen.sleep(0.1))
+        finally:
+            feed.stop()
+        self.assertEqual(received, [{'type': 'one'}])
+
+    @classmethod
+    def tearDownClass(cls):
+        connection = _get_connection()
+        connection.drop_database('test_events')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    test_export
+
+    Test the export of organisations
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (User, Organisation, Team, Project,
+    AccessControlList, TaskList, Task, FollowUp)
+from titan.projects import export
+
+
+class TestExport(unittest.TestCase):
+    """
+    Test the NDJSON export
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_export")
+
+    def setUp(self):
+        self.user = User(name="Test User", email="test@example.com").save()
+        self.organisation = Organisation(
+            name="open labs", slug="open-labs"
+        ).save()
+        self.team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        others = Team(name="Others", organisation=self.organisation).save()
+        for slug, team in (('titan', self.team), ('secret', others)):
+            project = Project(
+                name=slug, organisation=self.organisation, slug=slug,
+                acl=[AccessControlList(team=team, role="admin")]
+            ).save()
+            tasklist = TaskList(name="Version 0.1", project=project).save()
+            for title in ("Design", "Release"):
+                task = Task(
+                    title=title, status="new", task_list=tasklist
+                ).save()
+                task.add_follow_up(FollowUp(message="%s it" % title))
+
+    def tearDown(self):
+        connection = _get_connection()
+        connection.drop_database('test_export')
+
+    def test_0010_records(self):
+        """
+        Projects, tasklists, tasks and follow ups are exported in order
+        """
+        lines = ''.join(export.ndjson(self.organisation, chunk_size=1))
+        records = [json.loads(line) for line in lines.splitlines()]
+        self.assertEqual(
+            [record['type'] for record in records],
+            ['project'] * 2 + ['tasklist'] * 2 +
+            ['task', 'follow_up'] * 4
+        )
+        self.assertEqual(records[4]['title'], "Design")
+        self.assertEqual(records[5]['message'], "Design it")
+        self.assertEqual(records[5]['task'], records[4]['id'])
+
+    def test_0020_visible_projects(self):
+        """
+        Only the projects visible to the teams are exported
+        """
+        records = list(export.records(self.organisation, [self.team.id]))
+        self.assertEqual(
+            [record['slug'] for record in records \
+                if record['type'] == 'project'],
+            ['titan']
+        )
+        self.assertEqual(len(records), 1 + 1 + 2 * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
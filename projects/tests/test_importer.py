@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+    test_importer
+
+    Test the bulk import of tasks
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (User, Organisation, Team, Project,
+    AccessControlList, TaskList, Task)
+from titan.projects.sequences import SEQUENCES
+from titan.projects import importer
+
+
+class TestImporter(unittest.TestCase):
+    """
+    Test importing tasks from CSV and NDJSON
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_importer")
+
+    def setUp(self):
+        self.user = User(name="Test User", email="test@example.com").save()
+        organisation = Organisation(name="open labs", slug="open-labs").save()
+        team = Team(
+            name="Developers", organisation=organisation, members=[self.user]
+        ).save()
+        self.project = Project(
+            name="titan", organisation=organisation, slug="titan",
+            acl=[AccessControlList(team=team, role="admin")]
+        ).save()
+        self.tasklist = TaskList(
+            name="Version 0.1", project=self.project
+        ).save()
+        Task(title="Existing", status="new", task_list=self.tasklist).save()
+
+    def tearDown(self):
+        connection = _get_connection()
+        connection.drop_database('test_importer')
+        SEQUENCES.reset()
+
+    def test_0010_csv(self):
+        """
+        Valid rows are imported and invalid ones reported by line
+        """
+        lines = [
+            "tasklist,title,status,assigned_to,due_date\n",
+            "Version 0.1,Design,new,test@example.com,2012-12-01\n",
+            "Version 0.1,,new,,\n",
+            "Version 0.2,Release,done,,\n",
+            "Version 0.2,Release,resolved,nobody@example.com,\n",
+            "Version 0.2,Release,resolved,,\n",
+        ]
+        result = importer.TaskImporter(self.project, batch_size=1).run(
+            importer.read(lines, 'csv')
+        )
+        self.assertEqual(result['created'], 2)
+        self.assertEqual(result['tasklists'], 1)
+        self.assertEqual(
+            [line for line, error in result['errors']], [3, 4, 5]
+        )
+
+        design = Task.objects(title="Design").first()
+        self.assertEqual(design.assigned_to, self.user)
+        self.assertEqual(design.task_list, self.tasklist)
+        # Sequences continue after the tasks of the tasklist
+        existing = Task.objects(title="Existing").first()
+        self.assertTrue(design.sequence > existing.sequence)
+        release = Task.objects(title="Release").first()
+        self.assertEqual(release.task_list.name, "Version 0.2")
+        self.assertEqual(release.sequence, 1)
+
+    def test_0020_ndjson(self):
+        """
+        Rows are read from newline delimited JSON
+        """
+        lines = [
+            '{"tasklist": "Version 0.1", "title": "Design"}\n',
+            '\n',
+            'not json\n',
+            '{"tasklist": "Version 0.1", "title": "Release"}\n',
+        ]
+        result = importer.TaskImporter(self.project).run(
+            importer.read(lines, 'ndjson')
+        )
+        self.assertEqual(result['created'], 2)
+        self.assertEqual(result['errors'], [(3, "Invalid JSON")])
+        self.assertEqual(
+            [task.title for task in Task.objects(
+                task_list=self.tasklist).order_by('sequence')],
+            ["Existing", "Design", "Release"]
+        )
+
+    def test_0030_invalid_bytes(self):
+        """
+        Rows which are not UTF-8 or contain a NUL byte are reported and the
+        rows around them are imported
+        """
+        lines = [
+            "tasklist,title\n",
+            "Version 0.1,Design\n",
+            "Version 0.1,Caf\xe9\n",
+            "Version 0.1,Rel\x00ease\n",
+            "Version 0.1,Release\n",
+        ]
+        result = importer.TaskImporter(self.project).run(
+            importer.read(lines, 'csv')
+        )
+        self.assertEqual(result['created'], 2)
+        self.assertEqual(
+            [line for line, error in result['errors']], [3, 4]
+        )
+        self.assertEqual(result['errors'][0][1], "Invalid UTF-8")
+
+    def test_0040_ndjson_types(self):
+        """
+        Rows with values which are not strings are reported
+        """
+        lines = [
+            '{"tasklist": "Version 0.1", "title": 5}\n',
+            '{"tasklist": 1, "title": "Design"}\n',
+            '{"tasklist": "Version 0.1", "title": "Design", '
+            '"due_date": 20121201}\n',
+            '{"tasklist": "Version 0.1", "title": "Design", '
+            '"assigned_to": ["test@example.com"]}\n',
+            '{"tasklist": "Version 0.1", "title": "Release"}\n',
+        ]
+        result = importer.TaskImporter(self.project).run(
+            importer.read(lines, 'ndjson')
+        )
+        self.assertEqual(result['created'], 1)
+        self.assertEqual(
+            result['errors'], [
+                (1, "title must be a string"),
+                (2, "tasklist must be a string"),
+                (3, "due_date must be a string"),
+                (4, "assigned_to must be a string"),
+            ]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
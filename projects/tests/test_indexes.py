@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    test_indexes
+
+    Test building and auditing the indexes
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects import indexes
+from titan.projects.models import Team
+
+
+class TestIndexes(unittest.TestCase):
+    """
+    Test the index plan
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_indexes")
+
+    def audit(self, collection):
+        for audit in indexes.report():
+            if audit['collection'] == collection:
+                return audit
+
+    def test_0010_ensure_indexes(self):
+        """
+        Declared indexes are built once and reported until they are
+        """
+        collection = indexes._collection(Team)
+        collection.drop()
+        self.assertTrue(self.audit(collection.name)['missing'])
+
+        created = indexes.ensure_indexes()
+        self.assertTrue((collection.name, 'organisation_1_name_1') in created)
+        self.assertEqual(self.audit(collection.name)['missing'], [])
+        self.assertEqual(indexes.ensure_indexes(), [])
+
+        # Indexes the model does not declare are reported
+        collection.create_index('name')
+        self.assertEqual(
+            self.audit(collection.name)['undeclared'], ['name_1']
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        connection = _get_connection()
+        connection.drop_database('test_indexes')
+
+
+if __name__ == '__main__':
+    unittest.main()
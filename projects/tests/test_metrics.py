@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+    test_metrics
+
+    Test the latency histograms and their Prometheus text format
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+
+import unittest2 as unittest
+
+from titan.projects.metrics import Histogram, Latencies, LagMonitor, render
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Test the histograms and the rendering of the metrics
+    """
+
+    def test_0010_histogram(self):
+        """
+        The buckets are cumulative and end with +Inf
+        """
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        self.assertEqual(
+            histogram.cumulative(), [('0.1', 2), ('1.0', 3), ('+Inf', 4)]
+        )
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 3.65)
+
+    def test_0020_render(self):
+        """
+        The latencies are labelled by handler, method, status and pid and
+        the outbox depth by status
+        """
+        latencies = Latencies(buckets=(0.1,))
+        latencies.observe('TaskHandler', 'GET', 200, 0.05)
+        latencies.observe('TaskHandler', 'GET', 200, 0.2)
+        latencies.observe('TaskHandler', 'POST', 302, 0.05)
+        text = render(
+            latencies, LagMonitor(), outbox={'pending': 3, 'dead': 1}
+        )
+        labels = 'handler="TaskHandler",le="0.1",method="GET",pid="%d",' \
+            'status="200"' % os.getpid()
+        self.assertTrue(
+            'titan_request_duration_seconds_bucket{%s} 1' % labels in text
+        )
+        self.assertTrue(
+            'titan_request_duration_seconds_count{handler="TaskHandler",'
+            'method="POST",pid="%d",status="302"} 1' % os.getpid() in text
+        )
+        self.assertTrue('titan_outbox_messages{status="pending"} 3' in text)
+        self.assertTrue('titan_ioloop_lag_seconds{' in text)
+        self.assertFalse('titan_outbox' in render(latencies, LagMonitor()))
+
+
+if __name__ == '__main__':
+    unittest.main()
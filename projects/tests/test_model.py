@@ -7,12 +7,18 @@
     :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import threading
+
 import unittest2 as unittest
+from bson import ObjectId
 from mongoengine import connect, ValidationError, OperationError
-from mongoengine.connection import _get_connection
+from mongoengine.connection import _get_connection, get_db
 
 from titan.projects.models import(Team, Organisation, User, Project,
-    AccessControlList, FollowUp, TaskList, Task)
+    AccessControlList, FollowUp, TaskList, Task, Membership, FollowUpBucket,
+    repair_counters)
+from titan.projects.sequences import SEQUENCES, SequenceAllocator
+from titan.projects.indexes import ensure_indexes
 from monstor.utils.web import slugify
 
 
@@ -53,6 +59,9 @@ class TestModel(unittest.TestCase):
         connect("test_model")
 
     def setUp(self):
+        # The collections are dropped after every test and the unique
+        # indexes are not created by the models
+        ensure_indexes(background=False)
         new_user = User(
             name="Anoop sm",
             email="anoop.sm@openlabs.co.in",
@@ -68,9 +77,13 @@ class TestModel(unittest.TestCase):
         User.drop_collection()
         Organisation.drop_collection()
         Team.drop_collection()
+        Membership.drop_collection()
         Project.drop_collection()
         Task.drop_collection()
         TaskList.drop_collection()
+        FollowUpBucket.drop_collection()
+        get_db()[SEQUENCES.collection].drop()
+        SEQUENCES.reset()
 
     def test_0010_create_organisation(self):
         """
@@ -307,11 +320,13 @@ class TestModel(unittest.TestCase):
         # Create Task
         task = Task(
             title="Create model design", status ="resolved",
-            assigned_to=self.user, watchers=[self.user], task_list=task_list,
-            follow_ups=[follow_up]
+            assigned_to=self.user, watchers=[self.user], task_list=task_list
         )
         task.save()
         self.assertEqual(Task.objects().count(), 1)
+        task.add_follow_up(follow_up)
+        self.assertEqual(Task.objects.first().follow_up_count, 1)
+        self.assertEqual(task.get_follow_ups()[0].message, "Any message")
 
     def test_0140_task_required_fields(self):
         """
@@ -327,19 +342,17 @@ class TestModel(unittest.TestCase):
         project.save()
         task_list = TaskList(name="Version 0.1", project=project)
         task_list.save()
-        follow_up = FollowUp(message="Any message", from_status="resolved")
-
         #"title"  is a required field        
         task = Task(
             status ="resolved", assigned_to=self.user, watchers=[self.user],
-            task_list=task_list, follow_ups=[follow_up]
+            task_list=task_list
         )
         self.assertRaises(ValidationError, task.save)
 
         # "Status" is a required Field
         task = Task(
             title="Create model design", assigned_to=self.user,
-            watchers=[self.user], task_list=task_list, follow_ups=[follow_up]
+            watchers=[self.user], task_list=task_list
         )
         self.assertRaises(ValidationError, task.save)
 
@@ -385,6 +398,435 @@ class TestModel(unittest.TestCase):
         self.assertEqual(len(self.user.organisations), 2)
         self.assertEqual(len(user_2.organisations), 1)
 
+    def test_0160_membership_index(self):
+        """
+        The membership index follows the members of the teams
+        """
+        user_2 = User(name="test-user", email="test@sample.com")
+        user_2.set_password("openlabs")
+        user_2.save()
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user, user_2]
+        )
+        team.save()
+        self.assertEqual(Membership.objects(team=team).count(), 2)
+        self.assertTrue(user_2.is_member_of(organisation))
+
+        # Removing a member from the team removes the index entry
+        team.members = [self.user]
+        team.save()
+        self.assertEqual(Membership.objects(team=team).count(), 1)
+        self.assertFalse(user_2.is_member_of(organisation))
+        self.assertEqual(user_2.organisations, set())
+
+        # Deleting the team removes all its entries
+        team.delete()
+        self.assertEqual(Membership.objects.count(), 0)
+        self.assertFalse(self.user.is_member_of(organisation))
+
+        # Rebuild indexes the existing teams again and drops the entries
+        # of the teams which no longer exist
+        Team(
+            name="Developers", organisation=organisation, members=[user_2]
+        ).save()
+        Membership.drop_collection()
+        Membership._get_collection().insert({
+            'user': self.user.id, 'organisation': organisation.id,
+            'team': ObjectId(),
+        })
+        self.assertEqual(Membership.rebuild(), 1)
+        self.assertTrue(user_2.is_member_of(organisation))
+        self.assertFalse(self.user.is_member_of(organisation))
+
+    def test_0170_project_visibility(self):
+        """
+        Projects are resolved by the teams of the user in the project ACL
+        """
+        user_2 = User(name="test-user", email="test@sample.com")
+        user_2.set_password("openlabs")
+        user_2.save()
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, "Titan", "titan project", organisation
+        )
+        project.save()
+
+        team_ids = self.user.team_ids
+        self.assertEqual(len(team_ids), 2)
+        self.assertEqual(
+            list(Project.visible_to(team_ids, organisation)), [project]
+        )
+        self.assertEqual(project.role_of(team_ids), "admin")
+
+        # A user in none of the teams can neither see nor have a role
+        self.assertEqual(Project.visible_to(user_2.team_ids).count(), 0)
+        self.assertEqual(project.role_of(user_2.team_ids), None)
+
+        # An observer team gives read only access
+        observers = Team(
+            name="Observers", organisation=organisation, members=[user_2]
+        ).save()
+        project.acl.append(AccessControlList(team=observers, role="observer"))
+        project.save()
+        self.assertEqual(project.role_of(user_2.team_ids), "observer")
+
+    def test_0180_task_summaries(self):
+        """
+        Tasks of tasklists are grouped by tasklist in sequence order
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        version_1 = TaskList(name="Version 0.1", project=project).save()
+        version_2 = TaskList(name="Version 0.2", project=project).save()
+        for title in ("Design", "Implement", "Release"):
+            Task(title=title, status="new", task_list=version_1).save()
+
+        summaries = Task.summaries([version_1, version_2])
+        self.assertEqual(
+            [task.title for task in summaries[version_1]],
+            ["Design", "Implement", "Release"]
+        )
+        self.assertEqual(summaries[version_2], [])
+
+        # Limit the number of tasks per tasklist
+        summaries = Task.summaries([version_1, version_2], limit=2)
+        self.assertEqual(len(summaries[version_1]), 2)
+
+    def test_0190_follow_up_buckets(self):
+        """
+        Follow ups are stored in pages outside the task
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project).save()
+        task = Task(title="Design", status="new", task_list=task_list).save()
+
+        bucket_size = FollowUpBucket.BUCKET_SIZE
+        FollowUpBucket.BUCKET_SIZE = 2
+        try:
+            for index in range(5):
+                task.add_follow_up(FollowUp(message="Comment %d" % index))
+            self.assertEqual(task.follow_up_pages, 3)
+        finally:
+            FollowUpBucket.BUCKET_SIZE = bucket_size
+        self.assertEqual(FollowUpBucket.objects(task=task).count(), 3)
+        self.assertEqual(
+            [follow_up.message for follow_up in task.get_follow_ups(1)],
+            ["Comment 2", "Comment 3"]
+        )
+        self.assertEqual(task.get_follow_ups(3), [])
+
+        # The follow ups go away with the task
+        task.delete()
+        self.assertEqual(FollowUpBucket.objects.count(), 0)
+
+    def test_0200_migrate_follow_ups(self):
+        """
+        Follow ups embedded in tasks are moved to buckets
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project).save()
+        task = Task(title="Design", status="new", task_list=task_list).save()
+        Task._get_collection().update(
+            {'_id': task.id},
+            {'$set': {'follow_ups': [
+                FollowUp(message="Comment %d" % index).to_mongo()
+                for index in range(3)
+            ]}}
+        )
+
+        self.assertEqual(FollowUpBucket.migrate(), 1)
+        task = Task.objects.with_id(task.id)
+        self.assertEqual(task.follow_up_count, 3)
+        self.assertEqual(
+            [follow_up.message for follow_up in task.get_follow_ups()],
+            ["Comment 0", "Comment 1", "Comment 2"]
+        )
+        self.assertFalse(
+            'follow_ups' in Task._get_collection().find_one({'_id': task.id})
+        )
+        # Migrated tasks are skipped
+        self.assertEqual(FollowUpBucket.migrate(), 0)
+
+    def test_0210_concurrent_follow_ups(self):
+        """
+        Follow ups update the task atomically and are never lost
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        user_2 = User(name="test-user", email="test@example.com").save()
+        task_list = TaskList(name="Version 0.1", project=project).save()
+        Task(
+            title="Design", status="new", task_list=task_list,
+            watchers=[self.user]
+        ).save()
+
+        # Two requests working on their own copy of the task
+        task_1 = Task.objects.first()
+        task_2 = Task.objects.first()
+        task_1.add_follow_up(
+            FollowUp(message="Started", to_status="in-progress"),
+            watchers=[self.user]
+        )
+        task_2.add_follow_up(
+            FollowUp(
+                message="Take over", to_status="hold", to_assignee=user_2
+            ),
+            watchers=[user_2]
+        )
+
+        task = Task.objects.first()
+        self.assertEqual(task.follow_up_count, 2)
+        self.assertEqual(task.status, "hold")
+        self.assertEqual(task.assigned_to, user_2)
+        self.assertEqual(task.watchers, [self.user, user_2])
+        follow_ups = task.get_follow_ups()
+        self.assertEqual(
+            [follow_up.message for follow_up in follow_ups],
+            ["Started", "Take over"]
+        )
+        self.assertEqual(follow_ups[1].from_status, "in-progress")
+
+    def test_0220_scoped_sequences(self):
+        """
+        Tasklists are numbered per project and tasks per tasklist
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project_1 = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        ).save()
+        project_2 = create_project(
+            self.user, 'Monstor', 'monstor project', organisation
+        ).save()
+        version_1 = TaskList(name="Version 0.1", project=project_1).save()
+        version_2 = TaskList(name="Version 0.2", project=project_1).save()
+        other = TaskList(name="Version 0.1", project=project_2).save()
+        self.assertEqual((version_1.sequence, version_2.sequence), (1, 2))
+        self.assertEqual(other.sequence, 1)
+
+        task_1 = Task(title="Design", status="new", task_list=version_1).save()
+        task_2 = Task(title="Design", status="new", task_list=version_2).save()
+        self.assertEqual((task_1.sequence, task_2.sequence), (1, 1))
+
+        # Sequences are unique within the scope
+        self.assertRaises(
+            OperationError, Task(
+                title="Release", status="new", task_list=version_1,
+                sequence=1
+            ).save
+        )
+
+    def test_0230_status_counts(self):
+        """
+        Tasklists and projects count their tasks in every status
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        ).save()
+        tasklist = TaskList(name="Version 0.1", project=project).save()
+        design = Task(title="Design", status="new", task_list=tasklist).save()
+        Task(title="Release", status="new", task_list=tasklist).save()
+        tasklist.reload()
+        self.assertEqual(tasklist.status_counts, {'new': 2})
+
+        # Saving a task without changing its status does not count it again
+        design.title = "Design the API"
+        design.save()
+        tasklist.reload()
+        self.assertEqual(tasklist.status_counts, {'new': 2})
+
+        design.add_follow_up(FollowUp(message="Done", to_status="resolved"))
+        # A follow up which does not change the status is not counted
+        design.add_follow_up(FollowUp(message="Again", to_status="resolved"))
+        tasklist.reload()
+        project.reload()
+        self.assertEqual(tasklist.status_counts, {'new': 1, 'resolved': 1})
+        self.assertEqual(project.status_counts, {'new': 1, 'resolved': 1})
+
+        design.delete()
+        project.reload()
+        self.assertEqual(project.status_counts, {'new': 1, 'resolved': 0})
+
+        # Drifted counts are repaired from the tasks
+        TaskList.objects(id=tasklist.id).update_one(
+            set__status_counts={'new': 5}
+        )
+        self.assertEqual(repair_counters(), 1)
+        tasklist.reload()
+        project.reload()
+        self.assertEqual(tasklist.status_counts, {'new': 1})
+        self.assertEqual(project.status_counts, {'new': 1})
+
+    def test_0240_hours(self):
+        """
+        The hours of follow ups add up on the task, tasklist and project
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        ).save()
+        tasklist = TaskList(name="Version 0.1", project=project).save()
+        design = Task(title="Design", status="new", task_list=tasklist).save()
+        release = Task(
+            title="Release", status="new", task_list=tasklist
+        ).save()
+        design.add_follow_up(FollowUp(message="Sketch", hours=1.5))
+        design.add_follow_up(FollowUp(message="Review"))
+        release.add_follow_up(FollowUp(message="Tag", hours=0.5))
+        self.assertEqual(design.hours, 1.5)
+        self.assertRaises(
+            ValidationError, design.add_follow_up,
+            FollowUp(message="Undo", hours=-1)
+        )
+        design.reload()
+        tasklist.reload()
+        project.reload()
+        self.assertEqual(design.hours, 1.5)
+        self.assertEqual(tasklist.hours, 2)
+        self.assertEqual(project.hours, 2)
+
+        release.delete()
+        project.reload()
+        self.assertEqual(project.hours, 1.5)
+
+        # Drifted hours are repaired from the follow ups
+        Task.objects(id=design.id).update_one(set__hours=10)
+        Project.objects(id=project.id).update_one(set__hours=10)
+        repair_counters()
+        design.reload()
+        project.reload()
+        self.assertEqual(design.hours, 1.5)
+        self.assertEqual(project.hours, 1.5)
+
+    def test_0250_migrate_after_follow_ups(self):
+        """
+        Follow ups made before the migration are kept after the embedded
+        ones
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project).save()
+        task = Task(title="Design", status="new", task_list=task_list).save()
+        Task._get_collection().update(
+            {'_id': task.id},
+            {'$set': {'follow_ups': [
+                FollowUp(message="Comment %d" % index).to_mongo()
+                for index in range(3)
+            ]}}
+        )
+
+        bucket_size = FollowUpBucket.BUCKET_SIZE
+        FollowUpBucket.BUCKET_SIZE = 2
+        try:
+            task.add_follow_up(FollowUp(message="Comment 3"))
+            self.assertEqual(FollowUpBucket.migrate(), 1)
+        finally:
+            FollowUpBucket.BUCKET_SIZE = bucket_size
+        task = Task.objects.with_id(task.id)
+        self.assertEqual(task.follow_up_count, 4)
+        self.assertEqual(
+            [follow_up.message for follow_up in task.get_follow_ups(0)],
+            ["Comment 0", "Comment 1"]
+        )
+        self.assertEqual(
+            [follow_up.message for follow_up in task.get_follow_ups(1)],
+            ["Comment 2", "Comment 3"]
+        )
+
+    def test_0260_concurrent_new_page(self):
+        """
+        Concurrent pushes to a page which does not exist yet are all kept
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        project = create_project(
+            self.user, 'Titan', 'titan project', organisation
+        )
+        project.save()
+        task_list = TaskList(name="Version 0.1", project=project).save()
+        task = Task(title="Design", status="new", task_list=task_list).save()
+
+        threads = [
+            threading.Thread(target=FollowUpBucket.push, args=(
+                task.id, 0, [FollowUp(message="Comment %d" % index).to_mongo()]
+            )) for index in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(FollowUpBucket.objects(task=task).count(), 1)
+        bucket = FollowUpBucket.objects(task=task, page=0).first()
+        self.assertEqual(bucket.count, 10)
+        self.assertEqual(
+            sorted(follow_up.message for follow_up in bucket.follow_ups),
+            sorted("Comment %d" % index for index in range(10))
+        )
+
+    def test_0270_sequence_blocks(self):
+        """
+        Used up blocks of numbers are not kept in memory
+        """
+        allocator = SequenceAllocator('test_sequences', block_size=2)
+        self.assertEqual(allocator.next('project', 1), 1)
+        self.assertEqual(len(allocator._blocks), 1)
+        self.assertEqual(allocator.next('project', 1), 2)
+        self.assertEqual(allocator._blocks, {})
+        self.assertEqual(allocator.next('project', 1), 3)
+        self.assertEqual(allocator.next('project', 2), 1)
+        self.assertEqual(len(allocator._blocks), 2)
 
     @classmethod
     def tearDownClass(cls):
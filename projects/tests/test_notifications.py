@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    test_notifications
+
+    Test the notification digests
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import datetime, timedelta
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (User, Organisation, Team, Project,
+    AccessControlList, TaskList, Task, Notification, OutboxMessage,
+    Membership)
+from titan.projects.notifications import notify, DigestWorker
+from titan.settings import SETTINGS
+
+
+class TestNotifications(unittest.TestCase):
+    """
+    Test the notifications of task watchers
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_notifications")
+
+    def setUp(self):
+        self.users = []
+        for index, interval in enumerate((0, 60, 0)):
+            user = User(
+                name="User %d" % index, email="user%d@example.com" % index,
+                digest_interval=interval
+            )
+            user.set_password("password")
+            self.users.append(user.save())
+        organisation = Organisation(name="open labs", slug="open-labs").save()
+        team = Team(
+            name="Developers", organisation=organisation, members=self.users
+        ).save()
+        project = Project(
+            name="titan", organisation=organisation, slug="titan",
+            acl=[AccessControlList(team=team, role="admin")]
+        ).save()
+        tasklist = TaskList(name="Version 0.1", project=project).save()
+        self.task = Task(
+            title="Release", status="new", task_list=tasklist,
+            watchers=self.users
+        ).save()
+        self.worker = DigestWorker(SETTINGS['template_path'])
+
+    def tearDown(self):
+        for document in (User, Organisation, Team, Membership, Project,
+                TaskList, Task, Notification, OutboxMessage):
+            document.drop_collection()
+
+    def test_0010_notify(self):
+        """
+        Watchers and the assignee except the actor are notified
+        """
+        notifications = notify(
+            self.task, self.users[0], "Done?", "http://titan/task",
+            self.users[1]
+        )
+        self.assertEqual(len(notifications), 2)
+        self.assertEqual(Notification.objects(recipient=self.users[0]).count(), 0)
+        self.assertEqual(
+            Notification.objects(recipient=self.users[1]).first().kind,
+            'assigned'
+        )
+        self.assertEqual(
+            Notification.objects(recipient=self.users[2]).first().kind,
+            'comment'
+        )
+
+    def test_0020_digest(self):
+        """
+        Notifications are coalesced per recipient after their interval
+        """
+        for message in ("One", "Two", "Three"):
+            notify(self.task, self.users[0], message, "http://titan/task")
+
+        # The user with a 60 minute interval has to wait
+        self.assertEqual(self.worker.send_due(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        self.assertEqual(
+            OutboxMessage.objects.first().recipients, [self.users[2].email]
+        )
+        self.assertEqual(Notification.objects.count(), 3)
+
+        self.assertEqual(
+            self.worker.send_due(datetime.utcnow() + timedelta(minutes=61)), 1
+        )
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(self.worker.send_due(), 0)
+
+    def test_0030_release_claims(self):
+        """
+        Notifications whose digest failed or whose worker died are sent
+        in a later run
+        """
+        notify(self.task, self.users[0], "One", "http://titan/task")
+
+        def broken(user, notifications):
+            raise ValueError("Broken template")
+
+        self.worker.render = broken
+        self.assertEqual(self.worker.send_due(), 0)
+        self.assertEqual(Notification.objects(claim__ne=None).count(), 0)
+        del self.worker.render
+
+        # A worker which died after claiming the notifications
+        Notification.objects(recipient=self.users[2]).update(
+            set__claim="dead",
+            set__claimed_at=datetime.utcnow() - timedelta(minutes=5)
+        )
+        self.assertEqual(self.worker.send_due(), 0)
+        self.worker.claim_timeout = 60
+        self.assertEqual(self.worker.send_due(), 1)
+        self.assertEqual(
+            OutboxMessage.objects.first().recipients, [self.users[2].email]
+        )
+        self.assertEqual(
+            Notification.objects(recipient=self.users[2]).count(), 0
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        connection = _get_connection()
+        connection.drop_database('test_notifications')
+
+
+if __name__ == '__main__':
+    unittest.main()
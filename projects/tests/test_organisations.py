@@ -13,7 +13,7 @@ from urllib import urlencode
 
 from tornado import testing, options
 from monstor.app import make_app
-from titan.projects.models import User, Organisation
+from titan.projects.models import User, Organisation, Team
 from titan.settings import SETTINGS
 from monstor.utils.web import slugify
 
@@ -188,6 +188,45 @@ class TestOrganisations(testing.AsyncHTTPTestCase):
         )
         self.assertEqual(response.code, 200)
 
+    def test_0100_organisations_pages(self):
+        """
+        The JSON list of organisations is paged with a cursor
+        """
+        user = User.objects(email="test@example.com").first()
+        for index in range(3):
+            organisation = Organisation(
+                name="Org %d" % index, slug="org-%d" % index
+            ).save()
+            Team(
+                name="Developers", organisation=organisation, members=[user]
+            ).save()
+        headers = {
+            'X-Requested-With': 'XMLHTTPRequest',
+            'Cookie': self.get_login_cookie(),
+        }
+
+        response = self.fetch(
+            '/my-organisations/?limit=2', headers=headers,
+            follow_redirects=False
+        )
+        page = json.loads(response.body)
+        self.assertEqual(
+            [o['name'] for o in page['result']], ["Org 0", "Org 1"]
+        )
+        response = self.fetch(
+            '/my-organisations/?limit=2&after=%s' % page['next'],
+            headers=headers, follow_redirects=False
+        )
+        page = json.loads(response.body)
+        self.assertEqual([o['name'] for o in page['result']], ["Org 2"])
+        self.assertEqual(page['next'], None)
+
+        response = self.fetch(
+            '/my-organisations/?after=invalid', headers=headers,
+            follow_redirects=False
+        )
+        self.assertEqual(response.code, 400)
+
     def tearDown(self):
         """
         Drop the database after every test
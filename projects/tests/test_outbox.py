@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    test_outbox
+
+    Test the delivery of queued emails against a local SMTP sink
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import asyncore
+import smtpd
+import socket
+import threading
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import OutboxMessage
+from titan.projects.outbox import enqueue, OutboxWorker, SMTPConnection
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    An SMTP server which collects the messages it receives
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.thread = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.1}
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+def unused_port():
+    """
+    Return a port on which nothing is listening
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestOutbox(unittest.TestCase):
+    """
+    Test the outbox worker
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_outbox")
+
+    def setUp(self):
+        self.sink = SMTPSink()
+
+    def tearDown(self):
+        self.sink.close()
+        OutboxMessage.drop_collection()
+
+    def test_0010_deliver(self):
+        """
+        Queued messages are delivered and removed from the outbox
+        """
+        enqueue("titan@example.com", "test@example.com", "Subject: 1\n\nHi")
+        enqueue("titan@example.com", ["a@example.com", "b@example.com"], "Hi")
+        self.assertEqual(self.sink.messages, [])
+
+        worker = OutboxWorker(
+            SMTPConnection(host='127.0.0.1', port=self.sink.port)
+        )
+        self.assertEqual(worker.deliver_pending(), 2)
+        worker.stop()
+        self.sink.thread.join(0.5)
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+
+    def test_0020_retry_and_dead_letter(self):
+        """
+        Failed deliveries are retried later and eventually given up
+        """
+        message = enqueue("titan@example.com", "test@example.com", "Hi")
+        worker = OutboxWorker(
+            SMTPConnection(host='127.0.0.1', port=unused_port()),
+            max_attempts=2, backoff=0
+        )
+        self.assertEqual(worker.deliver_pending(), 0)
+        message.reload()
+        self.assertEqual(message.status, 'pending')
+        self.assertEqual(message.attempts, 1)
+
+        self.assertEqual(worker.deliver_pending(), 0)
+        message.reload()
+        self.assertEqual(message.status, 'dead')
+        self.assertEqual(message.attempts, 2)
+
+        # Dead messages are not retried
+        self.assertEqual(worker.deliver_pending(), 0)
+
+    def test_0030_unexpected_error(self):
+        """
+        Errors other than those of the mail server are retried and given
+        up like them
+        """
+        class BrokenConnection(SMTPConnection):
+            def sendmail(self, sender, recipients, message):
+                raise ValueError("Broken message")
+
+        message = enqueue("titan@example.com", "test@example.com", "Hi")
+        worker = OutboxWorker(BrokenConnection(), max_attempts=2, backoff=0)
+        self.assertEqual(worker.deliver_pending(), 0)
+        message.reload()
+        self.assertEqual(message.status, 'pending')
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(message.last_error, "Broken message")
+
+        self.assertEqual(worker.deliver_pending(), 0)
+        message.reload()
+        self.assertEqual(message.status, 'dead')
+        self.assertEqual(message.attempts, 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        connection = _get_connection()
+        connection.drop_database('test_outbox')
+
+
+if __name__ == '__main__':
+    unittest.main()
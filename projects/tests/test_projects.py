@@ -14,7 +14,7 @@ from urllib import urlencode
 from tornado import testing, options
 from monstor.app import make_app
 from titan.projects.models import (User, Project, Organisation, Team,
-    AccessControlList)
+    AccessControlList, TaskList)
 from titan.settings import SETTINGS
 from monstor.utils.web import slugify
 
@@ -251,6 +251,78 @@ class TestProjects(testing.AsyncHTTPTestCase):
         )
         self.assertEqual(response.code, 404)
 
+    def test_0090_navigation_fragments(self):
+        """
+        The cached navigation links change along with the tasklists
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        acl = AccessControlList(team=team, role="admin")
+        project = Project(
+            name="titan", organisation=organisation, acl=[acl],
+            slug=slugify('titan project')
+        )
+        project.save()
+        TaskList(name="Version 0.1", project=project).save()
+        cookie = self.get_login_cookie()
+        response = self.fetch(
+            '/%s/%s' % (organisation.slug, project.slug),
+            headers={'Cookie': cookie}
+        )
+        self.assertTrue("Version 0.1" in response.body)
+        self.assertFalse("Version 0.2" in response.body)
+
+        TaskList(name="Version 0.2", project=project).save()
+        response = self.fetch(
+            '/%s/%s' % (organisation.slug, project.slug),
+            headers={'Cookie': cookie}
+        )
+        self.assertTrue("Version 0.2" in response.body)
+
+    def test_0100_conditional_get(self):
+        """
+        The project page is not sent again until the project changes
+        """
+        organisation = Organisation(
+            name="open labs", slug=slugify("open labs")
+        )
+        organisation.save()
+        team = Team(
+            name="Developers", organisation=organisation,
+            members=[self.user]
+        )
+        team.save()
+        acl = AccessControlList(team=team, role="admin")
+        project = Project(
+            name="titan", organisation=organisation, acl=[acl],
+            slug=slugify('titan project')
+        )
+        project.save()
+        cookie = self.get_login_cookie()
+        url = '/%s/%s' % (organisation.slug, project.slug)
+        response = self.fetch(url, headers={'Cookie': cookie})
+        self.assertEqual(response.code, 200)
+        etag = response.headers['Etag']
+
+        response = self.fetch(
+            url, headers={'Cookie': cookie, 'If-None-Match': etag}
+        )
+        self.assertEqual(response.code, 304)
+
+        TaskList(name="Version 0.1", project=project).save()
+        response = self.fetch(
+            url, headers={'Cookie': cookie, 'If-None-Match': etag}
+        )
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
     def tearDown(self):
         """
         Drop the database after every test
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    test_querystats
+
+    Test the recording of the database commands of requests
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+
+import unittest2 as unittest
+from bson.son import SON
+
+from titan.projects import querystats
+from titan.projects.querystats import QueryStats, shape
+
+
+class TestQueryStats(unittest.TestCase):
+    """
+    Test the shapes, the stats and their binding to threads
+    """
+
+    def test_0010_shape(self):
+        """
+        Commands differing only by their values have the same shape
+        """
+        first = shape('find', SON([
+            ('find', 'task'), ('filter', {'task_list': 1}),
+            ('lsid', {'id': 1}), ('limit', 1),
+        ]))
+        second = shape('find', SON([
+            ('find', 'task'), ('filter', {'task_list': 2}), ('limit', 5),
+        ]))
+        self.assertEqual(first, second)
+        self.assertEqual(first, 'find task {filter: {task_list: ?}}')
+        self.assertEqual(
+            shape('find', {'find': 'task', 'filter': {'_id': {'$in': [1]}}}),
+            shape('find', {'find': 'task', 'filter': {'_id': {'$in': [2, 3]}}})
+        )
+        self.assertNotEqual(
+            first, shape('find', {'find': 'task', 'filter': {'title': 'a'}})
+        )
+
+    def test_0020_stats(self):
+        """
+        The stats keep the slowest commands and flag the repeated ones
+        """
+        stats = QueryStats(slowest=2)
+        for seconds in (0.001, 0.004, 0.002):
+            stats.record('find tasklist {}', seconds)
+        stats.record('find project {}', 0.003)
+        self.assertEqual(stats.count, 4)
+        self.assertAlmostEqual(stats.seconds, 0.010)
+        self.assertEqual(stats.slowest, [
+            (0.004, 'find tasklist {}'), (0.003, 'find project {}')
+        ])
+        self.assertEqual(stats.repeated(2), [('find tasklist {}', 3)])
+        self.assertEqual(stats.repeated(3), [])
+        self.assertEqual(stats.as_dict(2)['queries'], 4)
+        self.assertEqual(stats.as_dict(2)['repeated'], [
+            {'count': 3, 'shape': 'find tasklist {}'}
+        ])
+
+    def test_0030_bind(self):
+        """
+        A bound function records against the stats on any thread
+        """
+        stats = QueryStats()
+        seen = []
+        function = querystats.bind(
+            stats, lambda: seen.append(querystats.current())
+        )
+        thread = threading.Thread(target=function)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [stats])
+        self.assertEqual(querystats.current(), None)
+
+    def test_0040_active(self):
+        """
+        Nested stats are restored when their block is left
+        """
+        outer, inner = QueryStats(), QueryStats()
+        with querystats.active(outer):
+            with querystats.active(inner):
+                self.assertEqual(querystats.current(), inner)
+            self.assertEqual(querystats.current(), outer)
+        self.assertEqual(querystats.current(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    test_search
+
+    Test the search of tasks
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest2 as unittest
+from mongoengine import connect
+from mongoengine.connection import _get_connection
+
+from titan.projects.models import (User, Organisation, Team, Project,
+    AccessControlList, TaskList, Task, FollowUp, keywords)
+from titan.projects.sequences import SEQUENCES
+from titan.projects import search
+
+
+class TestSearch(unittest.TestCase):
+    """
+    Test the keywords of tasks and the ranked search
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        connect("test_search")
+
+    def setUp(self):
+        self.user = User(name="Test User", email="test@example.com").save()
+        self.organisation = Organisation(
+            name="open labs", slug="open-labs"
+        ).save()
+        self.team = Team(
+            name="Developers", organisation=self.organisation,
+            members=[self.user]
+        ).save()
+        others = Team(name="Others", organisation=self.organisation).save()
+        self.tasklists = {}
+        for slug, team in (('titan', self.team), ('secret', others)):
+            project = Project(
+                name=slug, organisation=self.organisation, slug=slug,
+                acl=[AccessControlList(team=team, role="admin")]
+            ).save()
+            self.tasklists[slug] = TaskList(
+                name="Version 0.1", project=project
+            ).save()
+
+    def tearDown(self):
+        connection = _get_connection()
+        connection.drop_database('test_search')
+        SEQUENCES.reset()
+
+    def test_0010_keywords(self):
+        """
+        Keywords are the distinct lower cased words less the stop words
+        """
+        self.assertEqual(
+            keywords(u"Fix the Login page, the login page is broken!"),
+            [u'broken', u'fix', u'login', u'page']
+        )
+        self.assertEqual(keywords(None), [])
+
+    def test_0020_maintained(self):
+        """
+        Keywords are added as tasks are saved and followed up
+        """
+        task = Task(
+            title="Login page", status="new",
+            task_list=self.tasklists['titan']
+        ).save()
+        task.add_follow_up(FollowUp(message="Broken in Firefox"))
+        task.reload()
+        self.assertEqual(task.title_keywords, ['login', 'page'])
+        self.assertEqual(
+            task.keywords, ['broken', 'firefox', 'login', 'page']
+        )
+
+        # A new title keeps the old keywords until the task is reindexed
+        task.title = "Sign in page"
+        task.save()
+        self.assertTrue('login' in task.keywords)
+        self.assertEqual(search.reindex(), 1)
+        task.reload()
+        self.assertEqual(
+            task.keywords, ['broken', 'firefox', 'page', 'sign']
+        )
+
+    def test_0030_ranked(self):
+        """
+        Tasks matching more keywords, in the title first, rank higher and
+        only the projects visible to the teams are searched
+        """
+        comment = Task(
+            title="Release notes", status="new",
+            task_list=self.tasklists['titan']
+        ).save()
+        comment.add_follow_up(FollowUp(message="The login page is broken"))
+        title = Task(
+            title="Login page broken", status="new",
+            task_list=self.tasklists['titan']
+        ).save()
+        Task(
+            title="Login page", status="new",
+            task_list=self.tasklists['secret']
+        ).save()
+
+        results, more = search.search(
+            "broken login page", [self.team.id]
+        )
+        self.assertFalse(more)
+        self.assertEqual(
+            [result['task']['_id'] for result in results],
+            [title.id, comment.id]
+        )
+        self.assertEqual(results[0]['project'].slug, 'titan')
+        self.assertEqual(results[0]['organisation'].slug, 'open-labs')
+
+        results, more = search.search(
+            "broken login page", [self.team.id], limit=1
+        )
+        self.assertTrue(more)
+        self.assertEqual(len(results), 1)
+
+        self.assertEqual(search.search("the", [self.team.id]), ([], False))
+        self.assertEqual(search.search("login", []), ([], False))
+
+
+if __name__ == '__main__':
+    unittest.main()
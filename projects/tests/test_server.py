@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    test_server
+
+    Test the supervision of the worker processes
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import shutil
+import tempfile
+import unittest2 as unittest
+
+from titan.projects.server import Supervisor, RequestTracker
+
+
+class Handler(object):
+    """
+    Stands in for a request handler
+    """
+
+
+class TestServer(unittest.TestCase):
+    """
+    Test the supervisor and the request tracker
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_0010_track_requests(self):
+        """
+        Requests are tracked until they finish
+        """
+        tracker = RequestTracker()
+        handler = Handler()
+        tracker.started(handler)
+        self.assertEqual(len(tracker), 1)
+        tracker.finished(handler)
+        tracker.finished(handler)
+        self.assertEqual(len(tracker), 0)
+
+    def test_0020_restart_workers(self):
+        """
+        Workers which die are restarted, the ones which exit are not
+        """
+        directory = self.directory
+
+        def target(task_id):
+            runs = os.path.join(directory, str(task_id))
+            with open(runs, 'a') as runs_file:
+                runs_file.write('x')
+            if task_id == 1 and os.path.getsize(runs) < 3:
+                os._exit(1)
+
+        supervisor = Supervisor(2)
+        supervisor.run(target)
+        self.assertEqual(supervisor.restarts, 2)
+        self.assertEqual(
+            open(os.path.join(directory, '0')).read(), 'x'
+        )
+        self.assertEqual(
+            open(os.path.join(directory, '1')).read(), 'xxx'
+        )
+
+    def test_0030_give_up(self):
+        """
+        The supervisor gives up on workers which keep dying
+        """
+        def target(task_id):
+            os._exit(1)
+
+        supervisor = Supervisor(1, max_restarts=2)
+        self.assertRaises(RuntimeError, supervisor.run, target)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,9 @@
 """
 import tornado.web
 
+from .cache import FRAGMENT_CACHE
+from .models import STATUS_CHOICES
+
 # pylint: disable=W0221
 # -- Arguments number different overridden method
 
@@ -35,6 +38,88 @@ class FormField(tornado.web.UIModule):
         )
 
 
+class NavigationList(tornado.web.UIModule):
+    """
+    The links of a list in the navigation column.
+
+    The rendered links are cached across requests along with the versions
+    of the scopes they are made from, so they are rendered again only when
+    the memberships of the user, the projects of the organisation or the
+    tasklists of the project change, or when the `navigation_cache_ttl`
+    setting expires.
+    """
+
+    def render(self, kind, items, organisation=None, project=None):
+        """
+        :param kind: One of organisations, projects or tasklists
+        :param items: The organisations, projects or tasklists
+        :param organisation: The organisation of the projects and tasklists
+        :param project: The project of the tasklists
+        """
+        key = self.cache_key(kind, organisation, project)
+        html = FRAGMENT_CACHE.get(key)
+        if html is None:
+            html = self.render_string(
+                "ui_modules/navigation-list.html", kind=kind, items=items,
+                organisation=organisation, project=project
+            )
+            FRAGMENT_CACHE.set(
+                key, html,
+                self.handler.settings.get('navigation_cache_ttl', 60)
+            )
+        return html
+
+    def cache_key(self, kind, organisation=None, project=None):
+        """
+        Returns the key of the fragment in the cache. The organisations and
+        projects depend on the user, while the tasklists are the same for
+        every user who can see the project.
+        """
+        user_id = self.current_user.id
+        if kind == 'organisations':
+            return (kind, user_id, self.handler.user_version())
+        if kind == 'projects':
+            return (
+                kind, user_id, organisation.id, self.handler.user_version(),
+                organisation.version
+            )
+        return (kind, project.id, project.version)
+
+
+class StatusProgress(tornado.web.UIModule):
+    """
+    A progress bar of the tasks in every status, drawn from the status
+    counts of a tasklist or project so that the tasks are not loaded.
+    """
+
+    #: The bootstrap class of the bar of every status
+    BAR_CLASSES = {
+        'new': 'bar-info',
+        'in-progress': 'bar-warning',
+        'hold': 'bar-danger',
+        'resolved': 'bar-success',
+    }
+
+    def render(self, status_counts):
+        """
+        :param status_counts: Dictionary of status to the number of tasks
+        """
+        status_counts = status_counts or {}
+        total = sum(status_counts.values())
+        bars = [
+            (
+                name, status_counts.get(status, 0),
+                self.BAR_CLASSES.get(status, ''),
+                100.0 * status_counts.get(status, 0) / total if total else 0
+            ) for status, name in STATUS_CHOICES
+        ]
+        return self.render_string(
+            "ui_modules/status-progress.html", bars=bars, total=total
+        )
+
+
 UI_MODULES = {
     'FormField': FormField,
+    'NavigationList': NavigationList,
+    'StatusProgress': StatusProgress,
 }
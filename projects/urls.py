@@ -13,7 +13,11 @@ from .views import (OrganisationHandler, OrganisationsHandler, HomePageHandler,
     ProjectSlugVerificationHandler, TaskListsHandler, TaskListHandler,
     TaskHandler, TasksHandler, ProjectInvitationHandler, CommentHandler,
     CommentMailHandler, OrganisationInviteHandler,
-    OrganisationUserRemoveHandler, GetingStartedHandler)
+    OrganisationUserRemoveHandler, GetingStartedHandler,
+    NotificationSettingsHandler, OrganisationExportHandler,
+    TaskImportHandler, ProjectEventsHandler, SearchHandler,
+    AttachmentUploadHandler, AttachmentHandler, OrganisationImageHandler,
+    MetricsHandler)
 
 U = tornado.web.URLSpec
 
@@ -23,10 +27,18 @@ HANDLERS = [
         name="projects.organisations"),
     U(r'/getting-started/', GetingStartedHandler,
         name="projects.welcome"),
+    U(r'/\+notifications', NotificationSettingsHandler,
+        name="projects.notification-settings"),
+    U(r'/search/', SearchHandler, name="projects.search"),
+    U(r'/\+metrics', MetricsHandler, name="projects.metrics"),
     U(r'/([a-zA-Z0-9_-]+)', OrganisationHandler,
         name="projects.organisation"),
     U(r'/\+slug-check', SlugVerificationHandler,
         name="projects.organisations.slug-check"),
+    U(r'/([a-zA-Z0-9_-]+)/\+export', OrganisationExportHandler,
+        name="projects.organisations.export"),
+    U(r'/([a-zA-Z0-9_-]+)/\+image', OrganisationImageHandler,
+        name="projects.organisations.image"),
     U(r'/([a-zA-Z0-9_-]+)/invitation', OrganisationInviteHandler,
         name="projects.organisations.invitation"),
     U(r'/([a-zA-Z0-9_-]+)/remove', OrganisationUserRemoveHandler,
@@ -35,6 +47,10 @@ HANDLERS = [
         name="projects.projects"),
     U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)', ProjectHandler,
         name="projects.project"),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/\+import', TaskImportHandler,
+        name="projects.project.import"),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/\+events', ProjectEventsHandler,
+        name="projects.project.events"),
     U(r'/([a-zA-Z0-9-_]+)/\+slug-check',
         ProjectSlugVerificationHandler,
         name="projects.project.slug-check"),
@@ -53,6 +69,11 @@ HANDLERS = [
         TaskHandler, name='projects.task.new'),
     U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/(\d+)/tasks/(\d+)/comment',
         CommentHandler, name='projects.task.comment'),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/(\d+)/tasks/(\d+)/\+attachments',
+        AttachmentUploadHandler, name='projects.task.attachments'),
+    U(r'/([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)/(\d+)/tasks/(\d+)/\+attachments/'
+        r'([0-9a-f]{24})',
+        AttachmentHandler, name='projects.task.attachment'),
     U(r'/comment/mail/([a-zA-Z0-9\.-_]+)/([a-zA-Z0-9\.-_]+)/(\d+)/(\d+)',
         CommentMailHandler, name="projects.task.comment-email")
 ]
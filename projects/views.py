@@ -5,23 +5,34 @@
     :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import urllib
 import logging
+import hashlib
+import functools
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 import tornado
+import tornado.websocket
+from tornado import gen, stack_context
 from tornado.options import options
 from wtforms import (Form, TextField, StringField, SelectField,
-    TextAreaField)
+    TextAreaField, FloatField, validators)
 from monstor.utils.wtforms import (REQUIRED_VALIDATOR, TornadoMultiDict,
     EMAIL_VALIDATOR)
 from monstor.utils.web import BaseHandler as MonstorBaseHandler
 from monstor.utils.i18n import _
 from raven.contrib.tornado import SentryMixin
 from itsdangerous import URLSafeSerializer
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs.errors import NoFile
 
 from .models import (User, Organisation, Team, Project, AccessControlList,
-    TaskList, Task, FollowUp)
+    TaskList, Task, FollowUp, FollowUpBucket, Blob, ROLES, reference_id)
+from .cache import NAVIGATION_CACHE
+from . import (executor, outbox, notifications, export, importer, events,
+    server, search, attachments, querystats, metrics)
 
 
 class OrganisationMixin(object):
@@ -33,15 +44,21 @@ class OrganisationMixin(object):
         Returns a dictionary with key=organisation and values=list of projects
         the user participated under the organisation.
         """
-        organisations = {}
-        current_user = User.objects.with_id(self.current_user.id)
-        for organisation in self.current_user.organisations:
-            all_projects = Project.objects(organisation=organisation).all()
-            projects = [
-                project for project in all_projects for team in\
-                    project.acl if current_user in team.team.members
-            ]
-            organisations[organisation] = projects
+        organisations = dict(
+            (organisation, []) for organisation in \
+                self.current_user.organisations
+        )
+        by_id = dict(
+            (organisation.id, organisation) for organisation in organisations
+        )
+        if not by_id:
+            return organisations
+        projects = Project.visible_to(self.current_user.team_ids).filter(
+            organisation__in=by_id.values()
+        )
+        for project in projects:
+            organisation = by_id[reference_id(project, 'organisation')]
+            organisations[organisation].append(project)
         return organisations
 
     def find_projects(self, organisation):
@@ -49,39 +66,102 @@ class OrganisationMixin(object):
         Returns a dictionary with key=user participated project and
         values=list of tasklists under the project
         """
-        projects = {}
-        current_user = User.objects.with_id(self.current_user.id)
-        all_projects = Project.objects(organisation=organisation).all()
-        user_projects = [
-            project for project in all_projects for team in project.acl\
-                if current_user in team.team.members
-        ]
-        for project in user_projects:
-            projects[project] = TaskList.objects(project=project).all()
+        projects = dict(
+            (project, []) for project in Project.visible_to(
+                self.current_user.team_ids, organisation
+            )
+        )
+        if not projects:
+            return projects
+        by_id = dict((project.id, project) for project in projects)
+        for tasklist in TaskList.objects(project__in=by_id.values()):
+            projects[by_id[reference_id(tasklist, 'project')]].append(tasklist)
         return projects
 
-    def find_tasklists(self, organisation, project_slug):
+    def navigation(self, organisation=None, project=None):
         """
-        Returns a dictionary with key=tasklist and values=list of tasks
+        Returns the context required to render the navigation column as a
+        dictionary with the keys organisations, projects and tasklists. The
+        projects are empty unless organisation is given and the tasklists
+        are empty unless project is given.
+
+        The context is memoized for the request and cached across requests
+        until either the TTL (`navigation_cache_ttl` setting) expires or the
+        underlying teams, projects, tasklists or tasks change, which is
+        told by the versions of the user, the organisation and the project.
         """
-        tasklists = {}
-        project = Project.objects(
-            organisation=organisation, slug=project_slug
-        ).first()
-        user_tasklists = TaskList.objects(project=project).all()
-        for tasklist in user_tasklists:
-            tasklists[tasklist] = Task.objects(task_list=tasklist).all()
-        return tasklists
+        user_id = self.current_user.id
+        user_version = self.user_version()
+        context = {
+            'organisations': self._navigation_lookup(
+                ('organisations', user_id, user_version),
+                lambda: self.current_user.organisations
+            ),
+            'projects': {},
+            'tasklists': {},
+        }
+        if organisation is not None:
+            context['projects'] = self._navigation_lookup(
+                (
+                    'projects', user_id, organisation.id, user_version,
+                    organisation.version
+                ),
+                lambda: self.find_projects(organisation)
+            )
+        if project is not None:
+            context['tasklists'] = self._navigation_lookup(
+                ('tasklists', project.id, project.version),
+                lambda: Task.summaries(TaskList.objects(project=project))
+            )
+        return context
+
+    def user_version(self):
+        """
+        Returns the version of the current user, which changes with the
+        memberships of the user. It is looked up once per request.
+        """
+        if '_user_version' not in self.__dict__:
+            self._user_version = User.objects(
+                id=self.current_user.id
+            ).scalar('version').first() or 0
+        return self._user_version
+
+    def _navigation_lookup(self, key, compute):
+        """
+        Look up the key in the request memo, then in the navigation cache and
+        finally compute the value.
+        """
+        memo = self.__dict__.setdefault('_navigation_memo', {})
+        if key not in memo:
+            value = NAVIGATION_CACHE.get(key)
+            if value is None:
+                value = compute()
+                NAVIGATION_CACHE.set(
+                    key, value,
+                    self.settings.get('navigation_cache_ttl', 60)
+                )
+            memo[key] = value
+        return memo[key]
+
+    def assignee_choices(self, project):
+        """
+        Returns the choices for assigning tasks of the project, which are
+        the members of the first team in the ACL of the project.
+        """
+        team = [
+            team.team if team.role == "admin" else ''\
+                for team in project.acl
+        ][0]
+        return [(unicode(user.id), user.name) for user in team.members]
 
     def security_check(self, organisation_slug):
         """
         Verify that organisation is existing or not. if it is not existing
         raise HTTPError(404), else return 'organisation'
         """
-        for organisation in self.current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
+        organisation = Organisation.objects(slug=organisation_slug).first()
+        if organisation is None or \
+                not self.current_user.is_member_of(organisation):
             raise tornado.web.HTTPError(404)
         return organisation
 
@@ -90,10 +170,186 @@ class BaseHandler(MonstorBaseHandler, SentryMixin):
     """
     Base handler for titan
     """
-    pass
 
+    #: Items on a page of the JSON lists, unless a limit is given
+    page_size = 50
+
+    #: The largest limit accepted for a page of the JSON lists
+    max_page_size = 500
 
-class GetingStartedHandler(BaseHandler):
+    #: The database commands made for the request, see :mod:`querystats`
+    query_stats = None
+
+    #: Whether the database commands of the requests are recorded
+    record_queries = True
+
+    def _execute(self, transforms, *args, **kwargs):
+        """
+        Record the database commands made on the IOLoop thread for the
+        request, see :mod:`querystats`. The stats are carried by a stack
+        context, which makes them active whenever the request runs again
+        after a `yield`, and only then, so that the requests interleaving
+        on the IOLoop thread are not charged for each other's commands.
+        """
+        if not self.record_queries:
+            return super(BaseHandler, self)._execute(
+                transforms, *args, **kwargs
+            )
+        self.query_stats = querystats.QueryStats()
+        with stack_context.StackContext(
+                functools.partial(querystats.active, self.query_stats)):
+            return super(BaseHandler, self)._execute(
+                transforms, *args, **kwargs
+            )
+
+    def prepare(self):
+        """
+        Track the request until it finishes, so that a process shutting
+        down drains it, see :mod:`server`
+        """
+        server.REQUESTS.started(self)
+        super(BaseHandler, self).prepare()
+
+    def flush(self, *args, **kwargs):
+        """
+        In debug mode, send the database commands made so far as headers of
+        the response: their count, their total time, the slowest one and
+        the most repeated one if it looks like an N+1 query.
+        """
+        if self.settings.get('debug') and self.query_stats is not None:
+            stats = self.query_stats
+            self.set_header('X-Query-Count', stats.count)
+            self.set_header('X-Query-Time', '%.2f' % (stats.seconds * 1000))
+            slowest = stats.slowest
+            if slowest:
+                self.set_header(
+                    'X-Query-Slowest', '%.2f %s' % (
+                        slowest[0][0] * 1000, slowest[0][1]
+                    )
+                )
+            repeated = stats.repeated(self.query_repeat_threshold)
+            if repeated:
+                self.set_header(
+                    'X-Query-Repeated', '%d %s' % (
+                        repeated[0][1], repeated[0][0]
+                    )
+                )
+        return super(BaseHandler, self).flush(*args, **kwargs)
+
+    @property
+    def query_repeat_threshold(self):
+        """
+        The times a query can be repeated in a request before it is flagged
+        as an N+1 query, the `query_repeat_threshold` setting
+        """
+        return self.settings.get('query_repeat_threshold', 10)
+
+    def on_finish(self):
+        server.REQUESTS.finished(self)
+        metrics.LATENCIES.observe(
+            self.__class__.__name__, self.request.method, self.get_status(),
+            self.request.request_time()
+        )
+        if self.query_stats is not None:
+            querystats.log(
+                self.query_stats, self.query_repeat_threshold,
+                method=self.request.method, path=self.request.path,
+                status=self.get_status(), handler=self.__class__.__name__,
+                request_ms=round(self.request.request_time() * 1000, 2),
+            )
+        super(BaseHandler, self).on_finish()
+
+    def run_db(self, function, *args, **kwargs):
+        """
+        Call a function making blocking database calls on the database
+        threads and return a future of its result, see :mod:`executor`.
+        Handlers decorated with `gen.coroutine` yield the future.
+        """
+        if self.query_stats is not None:
+            function = querystats.bind(self.query_stats, function)
+        return executor.run(
+            self.settings.get('db_threads', 0), function, *args, **kwargs
+        )
+
+    @gen.coroutine
+    def publish_event(self, task, event_type, **data):
+        """
+        Publish an event about a task like `events.publish`, making the
+        database calls on the database threads and calling the subscribers
+        of this process on the IOLoop. Returns a future.
+        """
+        topic, event = yield self.run_db(
+            events.make_event, task, event_type, **data
+        )
+        if events.FEED.running:
+            yield self.run_db(events.FEED.append, topic, event)
+        else:
+            events.EVENTS.publish(topic, event)
+
+    def not_modified(self, *versions):
+        """
+        Set the ETag of the page from the versions of everything it shows
+        and return True if the client already has the page with that ETag.
+        The handler then finishes with a 304 instead of rendering the page.
+
+        The ETag also covers the URL, the cookies, which identify the user
+        and carry the flash messages, and whether the JSON is asked for.
+
+        :param versions: The versions the page depends on
+        """
+        etag = hashlib.sha1(repr((
+            self.request.uri, self.request.headers.get('Cookie'),
+            self.is_xhr, versions
+        ))).hexdigest()
+        self.set_header('Etag', '"%s"' % etag)
+        self.set_header('Vary', 'Cookie')
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    def paginate(self, queryset, key='id', fields=None):
+        """
+        Return a future of a page of the queryset and the cursor of the next
+        page, which is None on the last page.
+
+        The documents are ordered by key and the page starts after the
+        `after` argument, which is the cursor of the previous page, and has
+        at most `limit` documents. The key must be unique within the
+        queryset, like the id or the sequence.
+
+        :param queryset: The documents to page through
+        :param key: The field to order by, `id` or an integer field
+        :param fields: Only load these fields of the documents
+        """
+        try:
+            limit = int(self.get_argument('limit', self.page_size))
+            after = self.get_argument('after', None)
+            if after is not None:
+                after = ObjectId(after) if key == 'id' else int(after)
+        except (ValueError, InvalidId):
+            raise tornado.web.HTTPError(400)
+        if limit < 1:
+            raise tornado.web.HTTPError(400)
+        limit = min(limit, self.max_page_size)
+
+        if after is not None:
+            queryset = queryset.filter(**{'%s__gt' % key: after})
+        queryset = queryset.order_by(key).limit(limit + 1)
+        if fields:
+            queryset = queryset.only(*fields)
+
+        def fetch():
+            documents = list(queryset)
+            cursor = None
+            if len(documents) > limit:
+                documents = documents[:limit]
+                cursor = unicode(getattr(documents[-1], key))
+            return documents, cursor
+        return self.run_db(fetch)
+
+
+class GetingStartedHandler(BaseHandler, OrganisationMixin):
     """
     Handle welcome page
     """
@@ -101,18 +357,18 @@ class GetingStartedHandler(BaseHandler):
         """
         render getting started page
         """
-        user_orgs = self.current_user.organisations
-        self.render('user/gettingstarted.html', organisations=user_orgs)
+        self.render('user/gettingstarted.html', **self.navigation())
 
 
 class HomePageHandler(BaseHandler, OrganisationMixin):
     """
     A home page handler
     """
+    @gen.coroutine
     def get(self):
         organisations = {}
         if self.current_user:
-            organisations = self.find_organisations()
+            organisations = yield self.run_db(self.find_organisations)
         self.render('user/home.html', organisations=organisations)
 
 
@@ -160,22 +416,29 @@ class OrganisationsHandler(BaseHandler, OrganisationMixin):
 
     @tornado.web.authenticated
     @tornado.web.addslash
+    @gen.coroutine
     def get(self):
         """
         The organisations of the current user
         """
-        if self.current_user:
-            organisations = self.find_organisations()
         if self.is_xhr:
+            organisation_ids = yield self.run_db(
+                lambda: self.current_user.organisation_ids
+            )
+            organisations, cursor = yield self.paginate(
+                Organisation.objects(id__in=organisation_ids), fields=['name']
+            )
             self.write({
                 'result': [
                     {
-                        'id': o.id,
+                        'id': unicode(o.id),
                         'name': o.name,
                     } for o in organisations
-                ]
+                ],
+                'next': cursor,
             })
         else:
+            organisations = yield self.run_db(self.find_organisations)
             self.render(
                 'projects/organisations.html',
                 organisations=organisations,
@@ -255,6 +518,7 @@ class OrganisationHandler(BaseHandler, OrganisationMixin):
 
     @tornado.web.authenticated
     @tornado.web.removeslash
+    @gen.coroutine
     def get(self, organisation_slug):
         """
         Render organisation page.
@@ -262,23 +526,23 @@ class OrganisationHandler(BaseHandler, OrganisationMixin):
         :param organisation_slug: Slug of organisation. It is used to select
         the exact organisation from 'organisation' collection.
         """
-        organisation = self.security_check(organisation_slug)
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
         if self.is_xhr:
             self.write({
                 'id': organisation.id,
                 'name': organisation.name,
             })
         else:
-            organisations = self.current_user.organisations
-            projects = self.find_projects(organisation)
+            navigation = yield self.run_db(self.navigation, organisation)
             self.render(
                 'projects/organisation.html',
                 organisation=organisation,
-                organisations=organisations,
-                projects=projects,
                 form=TeamForm(),
                 invite_form=InvitationForm(),
-                remove_form=RemoveForm()
+                remove_form=RemoveForm(),
+                **navigation
             )
         return
 
@@ -291,11 +555,7 @@ class OrganisationHandler(BaseHandler, OrganisationMixin):
         the exact organisation from 'organisation' collection.
         """
         current_user = User.objects.with_id(self.current_user.id)
-        for organisation in current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
-            raise tornado.web.HTTPError(404)
+        organisation = self.security_check(organisation_slug)
 
         form = TeamForm(TornadoMultiDict(self))
         admin_team = Team.objects(
@@ -326,16 +586,13 @@ class OrganisationHandler(BaseHandler, OrganisationMixin):
                 _("You have no permission for creating a team under this\
                  organisation.")
             )
-        organisations = self.current_user.organisations
-        projects = self.find_projects(organisation)
         self.render(
             'projects/organisation.html',
             organisation=organisation,
-            organisations=organisations,
-            projects=projects,
             form=TeamForm(),
             invite_form=InvitationForm(),
-            remove_form=RemoveForm()
+            remove_form=RemoveForm(),
+            **self.navigation(organisation)
         )
         return
 
@@ -426,6 +683,7 @@ class ProjectsHandler(BaseHandler, OrganisationMixin):
     """
     @tornado.web.authenticated
     @tornado.web.addslash
+    @gen.coroutine
     def get(self, organisation_slug):
         """
         Projects under the current organisations
@@ -434,29 +692,37 @@ class ProjectsHandler(BaseHandler, OrganisationMixin):
         the exact organisation from 'organisation' collection.
 
         """
-        organisation = self.security_check(organisation_slug)
-        projects = self.find_projects(organisation)
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
         if self.is_xhr:
+            team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+            projects, cursor = yield self.paginate(
+                Project.visible_to(team_ids, organisation),
+                fields=['name', 'slug']
+            )
             self.write({
                 'result': [
                     {
-                        'id': project.id,
+                        'id': unicode(project.id),
                         'name': project.name,
+                        'slug': project.slug,
                     } for project in projects
-                ]
+                ],
+                'next': cursor,
             })
         else:
-            organisations = self.current_user.organisations
+            navigation = yield self.run_db(self.navigation, organisation)
+            teams = yield self.run_db(list, organisation.teams)
             form = ProjectForm()
             form.team.choices = [
-                (unicode(team.id), team.name) for team in organisation.teams
+                (unicode(team.id), team.name) for team in teams
             ]
             self.render(
                 'projects/projects.html',
-                projects=projects,
                 form=form,
                 organisation=organisation,
-                organisations=organisations
+                **navigation
             )
         return
 
@@ -471,14 +737,8 @@ class ProjectsHandler(BaseHandler, OrganisationMixin):
         """
         form = ProjectForm(TornadoMultiDict(self))
         current_user = User.objects.with_id(self.current_user.id)
-        for organisation in current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
-            raise tornado.web.HTTPError(404)
+        organisation = self.security_check(organisation_slug)
 
-        projects = self.find_projects(organisation)
-        organisations = self.current_user.organisations
         form.team.choices = [
             (unicode(team.id), team.name) for team in organisation.teams
         ]
@@ -503,7 +763,8 @@ class ProjectsHandler(BaseHandler, OrganisationMixin):
                 )
                 self.render(
                     "projects/projects.html", form=form,
-                    organisation=organisation, projects=projects
+                    organisation=organisation,
+                    **self.navigation(organisation)
                 )
                 return
             acl_admin = AccessControlList(team=admin_team, role="admin")
@@ -537,8 +798,7 @@ class ProjectsHandler(BaseHandler, OrganisationMixin):
             "projects/projects.html",
             form=form,
             organisation=organisation,
-            organisations=organisations,
-            projects=projects
+            **self.navigation(organisation)
         )
 
 
@@ -573,6 +833,7 @@ class ProjectHandler(BaseHandler, OrganisationMixin):
     Handle a particular project
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self, organisation_slug, project_slug):
         """
         Render project page, It includes the options for inviting another
@@ -584,31 +845,37 @@ class ProjectHandler(BaseHandler, OrganisationMixin):
         project from the 'project' collection.
 
         """
-        organisation = self.security_check(organisation_slug)
-        tasklists = self.find_tasklists(organisation, project_slug)
-        organisations = self.current_user.organisations
-        projects = self.find_projects(organisation)
-        project = Project.objects(
-            organisation=organisation, slug=project_slug
-        ).first()
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        project = yield self.run_db(
+            Project.objects(organisation=organisation, slug=project_slug).first
+        )
         if not project:
             raise tornado.web.HTTPError(404)
+        team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+        if self.not_modified(
+                organisation.version, project.version, sorted(team_ids)):
+            return
 
         # Response
         if self.is_xhr:
             self.write({
                 'id': project.id,
                 'name': project.name,
+                'status_counts': project.status_counts,
+                'hours': project.hours,
             })
         else:
+            navigation = yield self.run_db(
+                self.navigation, organisation, project
+            )
             self.render(
                 'projects/project.html',
                 project=project,
                 organisation=organisation,
-                tasklists=tasklists,
-                organisations=organisations,
-                projects=projects,
                 form=InvitationForm(),
+                **navigation
             )
         return
 
@@ -623,7 +890,8 @@ class ProjectHandler(BaseHandler, OrganisationMixin):
         project = Project.objects(
             organisation=organisation, slug=project_slug
         ).first()
-        tasklists = self.find_tasklists(organisation, project_slug)
+        if not project:
+            raise tornado.web.HTTPError(404)
         admin_team = Team.objects(
             organisation=organisation, name="Administrators"
         ).first()
@@ -677,7 +945,7 @@ class ProjectHandler(BaseHandler, OrganisationMixin):
             message['To'] = form.email.data
             for part in parts:
                 message.attach(part)
-            self.send_mail(
+            outbox.enqueue(
                 options.email_sender, form.email.data, message.as_string()
             )
             self.flash(_("Invitation sent"))
@@ -693,16 +961,12 @@ class ProjectHandler(BaseHandler, OrganisationMixin):
                     in to this project"
                 ),"info"
             )
-        organisations = self.current_user.organisations
-        projects = self.find_projects(organisation)
         self.render(
                 "projects/project.html",
                 form=form,
                 organisation=organisation,
                 project=project,
-                tasklists=tasklists,
-                organisations=organisations,
-                projects=projects
+                **self.navigation(organisation, project)
         )
         return
 
@@ -771,6 +1035,7 @@ class TaskListsHandler(BaseHandler, OrganisationMixin):
     Handle the task lists under the Project
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self, organisation_slug, project_slug):
         """
         Render Task lists under the current project, also provide the options
@@ -782,29 +1047,41 @@ class TaskListsHandler(BaseHandler, OrganisationMixin):
         :param project_slug: Slug of project. It is used to select the exact
         project from the 'project' collection.
         """
-        organisation = self.security_check(organisation_slug)
-        project = Project.objects(slug=project_slug).first()
-        tasklists = self.find_tasklists(organisation, project_slug)
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        project = yield self.run_db(
+            Project.objects(slug=project_slug, organisation=organisation).first
+        )
+        if project is None:
+            raise tornado.web.HTTPError(404)
         if self.is_xhr:
+            tasklists, cursor = yield self.paginate(
+                TaskList.objects(project=project), key='sequence',
+                fields=['name', 'sequence', 'status_counts', 'hours']
+            )
             self.write({
                 'result': [
                     {
-                        'id': tasklist.id,
+                        'id': unicode(tasklist.id),
                         'name': tasklist.name,
+                        'sequence': tasklist.sequence,
+                        'status_counts': tasklist.status_counts,
+                        'hours': tasklist.hours,
                     } for tasklist in tasklists
-                ]
+                ],
+                'next': cursor,
             })
         else:
-            organisations = self.current_user.organisations
-            projects = self.find_projects(organisation)
+            navigation = yield self.run_db(
+                self.navigation, organisation, project
+            )
             self.render(
                 "projects/task_lists.html",
-                tasklists=tasklists,
                 form=TaskListForm(),
                 organisation=organisation,
                 project=project,
-                organisations=organisations,
-                projects=projects
+                **navigation
             )
         return
 
@@ -821,7 +1098,9 @@ class TaskListsHandler(BaseHandler, OrganisationMixin):
         """
         organisation = self.security_check(organisation_slug)
         form = TaskListForm(TornadoMultiDict(self))
-        project = Project.objects(slug=project_slug).first()
+        project = Project.objects(
+            slug=project_slug, organisation=organisation
+        ).first()
 
         if form.validate() and project:
             tasklist = TaskList(name=form.name.data, project=project)
@@ -837,9 +1116,6 @@ class TaskListsHandler(BaseHandler, OrganisationMixin):
                 )
             )
             return
-        tasklists = self.find_tasklists(organisation, project_slug)
-        organisations = self.current_user.organisations
-        projects = self.find_projects(organisation)
 
         self.flash(
             _(
@@ -850,9 +1126,7 @@ class TaskListsHandler(BaseHandler, OrganisationMixin):
             form=form,
             organisation=organisation,
             project=project,
-            tasklists=tasklists,
-            organisations=organisations,
-            projects=projects
+            **self.navigation(organisation, project)
         )
 
 
@@ -876,6 +1150,7 @@ class TaskListHandler(BaseHandler, OrganisationMixin):
     Handles a particular tasklist
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self, organisation_slug, project_slug, tasklist_sequence):
         """
         Render tasklist page.
@@ -890,35 +1165,38 @@ class TaskListHandler(BaseHandler, OrganisationMixin):
         tasklist. This tasklist id used to select the exact tasklist from the
         'tasklist'  collection.
         """
-        organisation = self.security_check(organisation_slug)
-        project = Project.objects(
-            slug=project_slug,
-            organisation=organisation
-        ).first()
-        tasklist = TaskList.objects(
-            project=project,
-            sequence=tasklist_sequence
-        ).first()
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        project = yield self.run_db(
+            Project.objects(slug=project_slug, organisation=organisation).first
+        )
+        tasklist = yield self.run_db(
+            TaskList.objects(project=project, sequence=tasklist_sequence).first
+        )
         if not tasklist:
             raise tornado.web.HTTPError(403)
+        team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+        if self.not_modified(
+                organisation.version, project.version, tasklist.version,
+                sorted(team_ids)):
+            return
         if self.is_xhr:
             self.write({
                 'id': tasklist.id,
                 'name': tasklist.name,
             })
         else:
-            organisations = self.current_user.organisations
-            projects = self.find_projects(organisation)
-            tasklists = self.find_tasklists(organisation, project_slug)
+            navigation = yield self.run_db(
+                self.navigation, organisation, project
+            )
             self.render(
                 'projects/task_list.html',
                 tasklist=tasklist,
                 project=project,
                 organisation=organisation,
-                organisations=organisations,
-                projects=projects,
-                tasklists=tasklists,
-                form=TaskForm()
+                form=TaskForm(),
+                **navigation
             )
         return
 
@@ -940,6 +1218,9 @@ class CommentForm(Form):
         "Assigned to", [REQUIRED_VALIDATOR],
         choices=[]
     )
+    hours = FloatField(
+        "Hours", [validators.Optional(), validators.NumberRange(min=0)]
+    )
 
 
 class TasksHandler(BaseHandler, OrganisationMixin):
@@ -947,6 +1228,7 @@ class TasksHandler(BaseHandler, OrganisationMixin):
     Handle all tasks
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self, organisation_slug, project_slug, tasklist_sequence):
         """
         Display All tasks under the current tasklist.
@@ -961,25 +1243,47 @@ class TasksHandler(BaseHandler, OrganisationMixin):
         tasklist. This tasklist id used to select the exact tasklist from the
         'tasklist'  collection.
         """
-        organisation = self.security_check(organisation_slug)
-        project = Project.objects(
-            slug=project_slug,
-            organisation=organisation
-        ).first()
-        organisations = self.current_user.organisations
-        tasklist = TaskList.objects(
-            project=project, sequence=tasklist_sequence
-        ).first()
-        tasklists = self.find_tasklists(organisation, project_slug)
-        projects = self.find_projects(organisation)
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        project = yield self.run_db(
+            Project.objects(slug=project_slug, organisation=organisation).first
+        )
+        tasklist = yield self.run_db(
+            TaskList.objects(project=project, sequence=tasklist_sequence).first
+        )
+        if tasklist is None:
+            raise tornado.web.HTTPError(404)
+        team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+        if self.not_modified(
+                organisation.version, project.version, tasklist.version,
+                sorted(team_ids)):
+            return
+        if self.is_xhr:
+            tasks, cursor = yield self.paginate(
+                Task.objects(task_list=tasklist), key='sequence',
+                fields=['title', 'status', 'sequence', 'hours']
+            )
+            self.write({
+                'result': [
+                    {
+                        'id': unicode(task.id),
+                        'title': task.title,
+                        'status': task.status,
+                        'sequence': task.sequence,
+                        'hours': task.hours,
+                    } for task in tasks
+                ],
+                'next': cursor,
+            })
+            return
+        navigation = yield self.run_db(self.navigation, organisation, project)
         self.render(
             'projects/tasks.html',
             organisation=organisation,
             project=project,
             tasklist=tasklist,
-            tasklists=tasklists,
-            organisations=organisations,
-            projects=projects
+            **navigation
         )
         return
 
@@ -989,6 +1293,7 @@ class TaskHandler(BaseHandler, OrganisationMixin):
     Handle the tasks under the current task list
     """
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self, organisation_slug, project_slug, tasklist_sequence,
             task_sequence=None):
         """
@@ -1011,21 +1316,39 @@ class TaskHandler(BaseHandler, OrganisationMixin):
         If task_sequence=None, it returns create new task form, else it returns
         the corresponding task.
         """
-        organisation = self.security_check(organisation_slug)
-        project = Project.objects(
-            slug=project_slug, organisation=organisation
-        ).first()
-        tasklist = TaskList.objects(
-            project=project,
-            sequence=tasklist_sequence
-        ).first()
-        tasks = Task.objects(task_list=tasklist).all()
-        organisations = self.current_user.organisations
-        projects = self.find_projects(organisation)
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        project = yield self.run_db(
+            Project.objects(slug=project_slug, organisation=organisation).first
+        )
+        tasklist = yield self.run_db(
+            TaskList.objects(project=project, sequence=tasklist_sequence).first
+        )
+        if tasklist is None:
+            raise tornado.web.HTTPError(404)
+        task = None
         if task_sequence:
-            task = Task.objects(
-                task_list=tasklist, sequence=task_sequence
-            ).first()
+            task = yield self.run_db(
+                Task.objects(task_list=tasklist, sequence=task_sequence).first
+            )
+            if task is None:
+                raise tornado.web.HTTPError(404)
+        team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+        if self.not_modified(
+                organisation.version, project.version, tasklist.version,
+                task and task.version, sorted(team_ids)):
+            return
+        navigation = yield self.run_db(self.navigation, organisation, project)
+        if task:
+            # The follow ups are paged, the latest page is shown by default
+            try:
+                page = int(
+                    self.get_argument('page', max(task.follow_up_pages - 1, 0))
+                )
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            follow_ups = yield self.run_db(task.get_follow_ups, page)
             if self.is_xhr:
                 self.write({
                     'id': task.id,
@@ -1036,32 +1359,37 @@ class TaskHandler(BaseHandler, OrganisationMixin):
                     'due_date': task.due_date,
                     'watchers': task.watchers,
                     'task_list': task.task_list,
-                    'follow_ups': task.follow_ups,
-                    'sequence': task.sequence
+                    'follow_ups': follow_ups,
+                    'page': page,
+                    'pages': task.follow_up_pages,
+                    'sequence': task.sequence,
+                    'hours': task.hours,
                 })
             else:
                 comment_form = CommentForm()
-                team = [
-                    team.team if team.role == "admin" else ''\
-                        for team in project.acl
-                ][0]
-                comment_form.assigned_to.choices = [
-                    (unicode(user.id), user.name) for user in team.members
-                ]
+                comment_form.assigned_to.choices = yield self.run_db(
+                    self.assignee_choices, project
+                )
                 self.render(
                     'projects/task.html',
                     task=task,
+                    follow_ups=follow_ups,
+                    page=page,
                     organisation=organisation,
                     project=project,
                     tasklist=tasklist,
                     form=comment_form,
-                    organisations=organisations,
-                    projects=projects,
-                    tasks=tasks
+                    tasks=navigation['tasklists'].get(tasklist, []),
+                    **navigation
                 )
             return
         else:
             task_form = TaskForm()
+            tasks = yield self.run_db(
+                list, Task.objects(task_list=tasklist).only(
+                    'title', 'status', 'sequence'
+                ).order_by('sequence')
+            )
             self.render(
                 'projects/task_list.html',
                 form=task_form,
@@ -1069,8 +1397,7 @@ class TaskHandler(BaseHandler, OrganisationMixin):
                 project=project,
                 tasklist=tasklist,
                 tasks=tasks,
-                organisations=organisations,
-                projects=projects
+                **navigation
             )
         return
 
@@ -1105,9 +1432,12 @@ class TaskHandler(BaseHandler, OrganisationMixin):
                 title=form.title.data,
                 status=form.status.data,
                 task_list=tasklist,
-                follow_ups=[],
+                watchers=[User.objects.with_id(self.current_user.id)],
             )
             task.save()
+            events.publish(
+                task, 'task-created', author=self.current_user.name
+            )
             self.flash(
                 _("A new task has been created successfully."), "Info"
             )
@@ -1122,9 +1452,6 @@ class TaskHandler(BaseHandler, OrganisationMixin):
             )
             return
         else:
-            tasklists = self.find_tasklists(organisation, project_slug)
-            organisations = self.current_user.organisations
-            projects = self.find_projects(organisation)
             self.flash(
                 _(
                     "Something went wrong while creating a new task! Try Again"
@@ -1136,9 +1463,10 @@ class TaskHandler(BaseHandler, OrganisationMixin):
                 organisation=organisation,
                 project=project,
                 tasklist=tasklist,
-                tasklists=tasklists,
-                projects=projects,
-                organisations=organisations
+                tasks=Task.objects(task_list=tasklist).only(
+                    'title', 'status', 'sequence'
+                ).order_by('sequence'),
+                **self.navigation(organisation, project)
             )
             return
 
@@ -1176,93 +1504,43 @@ class CommentHandler(BaseHandler, OrganisationMixin):
             project=project, sequence=tasklist_sequence
         ).first()
         form = CommentForm(TornadoMultiDict(self))
-        team = [
-            team.team if team.role == "admin" else ''\
-            for team in project.acl
-        ][0]
-        form.assigned_to.choices = [
-            (unicode(user.id), user.name) for user in team.members
-        ]
+        form.assigned_to.choices = self.assignee_choices(project)
         task = Task.objects(task_list=tasklist, sequence=task_sequence).first()
+        if task is None:
+            raise tornado.web.HTTPError(404)
         if form.validate():
             assigned_user = User.objects().with_id(form.assigned_to.data)
             comment = FollowUp(
                 message=form.comment.data,
                 to_status=form.status.data,
-                to_assignee=assigned_user
+                to_assignee=assigned_user,
+                hours=form.hours.data
             )
-            if not task.follow_ups:
-                task.follow_ups = [comment]
-            else:
-                task.follow_ups.append(comment)
-                task.assigned_to = assigned_user
-            task.save()
-
-            parts = []
-            try:
-                parts.append(
-                    MIMEText(
-                        self.render_string(
-                            'emails/comment_mail-html.html',
-                            organisation_slug=organisation_slug,
-                            project_slug=project_slug,
-                            tasklist_sequence=tasklist_sequence,
-                            task_sequence=task_sequence,
-                            project=project,
-                            task=task,
-                            user=assigned_user,
-                            message=form.comment.data,
-                            assigner=self.current_user.name
-                        ), 'html'
-                    )
-                )
-            except IOError:
-                logging.warning(
-                    'No HTML template emails/comment_mail-html.html'
+            current_user = User.objects.with_id(self.current_user.id)
+            task.add_follow_up(
+                comment, watchers=[current_user, assigned_user]
+            )
+            events.publish(
+                task, 'comment-added', author=current_user.name,
+                message=comment.message,
+                assigned_to=assigned_user.name if assigned_user else None
+            )
+            if comment.from_status != task.status:
+                events.publish(
+                    task, 'status-changed', author=current_user.name,
+                    from_status=comment.from_status
                 )
 
-            try:
-                parts.append(
-                    MIMEText(
-                        self.render_string(
-                            "emails/comment_mail-text.html",
-                            organisation_slug=organisation_slug,
-                            project_slug=project_slug,
-                            tasklist_sequence=tasklist_sequence,
-                            task_sequence=task_sequence,
-                            project=project,
-                            task=task,
-                            user=assigned_user
-                        ), 'text'
-                    )
-                )
-            except IOError:
-                logging.warning(
-                    "No TEXT template emails/comment_mail-text.html"
-                )
-            if not parts:
-                # Fallback to simple string replace since no templates
-                # have been defined.
-                parts.append(
-                    MIMEText(
-                        'To view click: %s' %
-                        self.reverse_url(
-                            'projects.task.comment-email',
-                            organisation_slug=organisation_slug,
-                            project_slug=project_slug,
-                            tasklist_sequence=tasklist_sequence,
-                            task_sequence=task_sequence,
-                        ), 'text'
+            notifications.notify(
+                task, current_user, form.comment.data,
+                "%s://%s%s" % (
+                    self.request.protocol, self.request.host,
+                    self.reverse_url(
+                        'projects.task.comment-email', organisation_slug,
+                        project_slug, tasklist_sequence, task_sequence
                     )
-                )
-            message = MIMEMultipart('alternative')
-            message['Subject'] = _("Task Assigned to you")
-            message['From'] = options.email_sender
-            message['To'] = assigned_user.email
-            for part in parts:
-                message.attach(part)
-            self.send_mail(
-                options.email_sender, assigned_user.email, message.as_string()
+                ),
+                assigned_user
             )
             self.flash(
                 _(
@@ -1280,29 +1558,29 @@ class CommentHandler(BaseHandler, OrganisationMixin):
             )
             return
         else:
-            organisations = self.current_user.organisations
-            projects = self.find_projects(organisation)
-            tasks = Task.objects(task_list = tasklist).all()
+            navigation = self.navigation(organisation, project)
             self.flash(
                 _(
                     "Something went wrong while adding new comment! Try Again"
                 ), "warning"
             )
+            page = max(task.follow_up_pages - 1, 0)
             self.render(
                 'projects/task.html',
                 task=task,
+                follow_ups=task.get_follow_ups(page),
+                page=page,
                 organisation=organisation,
                 project=project,
                 tasklist=tasklist,
                 form=form,
-                organisations=organisations,
-                projects=projects,
-                tasks=tasks
+                tasks=navigation['tasklists'].get(tasklist, []),
+                **navigation
             )
             return
 
 
-class CommentMailHandler(BaseHandler):
+class CommentMailHandler(BaseHandler, OrganisationMixin):
     """
     Handles comment email link
     """
@@ -1313,11 +1591,7 @@ class CommentMailHandler(BaseHandler):
         Accept comment key and handle operations.
 
         """
-        for organisation in self.current_user.organisations:
-            if organisation.slug == organisation_slug:
-                break
-        else:
-            raise tornado.web.HTTPError(404)
+        organisation = self.security_check(organisation_slug)
         self.redirect(
             self.reverse_url(
                 "projects.task",
@@ -1328,3 +1602,706 @@ class CommentMailHandler(BaseHandler):
             )
         )
         return
+
+
+class NotificationSettingsForm(Form):
+    """
+    Form to choose how often the notifications are emailed
+    """
+    digest_interval = SelectField(
+        _("Email notifications"), coerce=int,
+        choices=User.digest_interval.choices
+    )
+
+
+class NotificationSettingsHandler(BaseHandler):
+    """
+    Handles the notification settings of the current user
+    """
+    @tornado.web.authenticated
+    def get(self):
+        """
+        Returns the notification settings
+        """
+        self.write({
+            'digest_interval': self.current_user.digest_interval,
+            'choices': NotificationSettingsForm().digest_interval.choices,
+        })
+
+    @tornado.web.authenticated
+    def post(self):
+        """
+        Update the notification settings
+        """
+        form = NotificationSettingsForm(TornadoMultiDict(self))
+        if not form.validate():
+            if self.is_xhr:
+                raise tornado.web.HTTPError(400)
+            self.flash(
+                _("Something went wrong while submitting the form."),
+                "warning"
+            )
+        else:
+            User.objects(id=self.current_user.id).update_one(
+                set__digest_interval=form.digest_interval.data
+            )
+            if self.is_xhr:
+                self.write({'digest_interval': form.digest_interval.data})
+                return
+            self.flash(_("Your notification settings have been saved."))
+        self.redirect(self.reverse_url('home'))
+
+
+class OrganisationExportHandler(BaseHandler, OrganisationMixin):
+    """
+    Export the projects of an organisation
+    """
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, organisation_slug):
+        """
+        Stream the projects of the organisation visible to the current user
+        along with their tasklists, tasks and follow ups as newline
+        delimited JSON, see :mod:`export`.
+
+        :param organisation_slug: Slug of organisation. It is used to select
+        the exact organisation from 'organisation' collection.
+        """
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+        chunks = export.ndjson(organisation, team_ids)
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.set_header(
+            'Content-Disposition',
+            'attachment; filename="%s.ndjson"' % organisation.slug
+        )
+        while True:
+            # The cursors are read on the database threads and the chunk
+            # is flushed to the client before the next one is read
+            chunk = yield self.run_db(next, chunks, None)
+            if chunk is None:
+                break
+            self.write(chunk)
+            yield self.flush()
+        self.finish()
+
+
+class TaskImportHandler(BaseHandler, OrganisationMixin):
+    """
+    Import tasks into a project
+    """
+    @tornado.web.authenticated
+    @gen.coroutine
+    def post(self, organisation_slug, project_slug):
+        """
+        Import the tasks in the request body, which is CSV or newline
+        delimited JSON as given by the `format` argument or the content
+        type, see :mod:`importer`. Returns the number of tasks and tasklists
+        created and the rows which could not be imported as JSON.
+
+        :param organisation_slug: Slug of organisation. It is used to select
+        the exact organisation from 'organisation' collection.
+
+        :param project_slug: Slug of project. It is used to select the exact
+        project from the 'project' collection.
+        """
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        project = yield self.run_db(
+            Project.objects(slug=project_slug, organisation=organisation).first
+        )
+        if project is None:
+            raise tornado.web.HTTPError(404)
+        team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+        if project.role_of(team_ids) not in ('admin', 'participant'):
+            raise tornado.web.HTTPError(403)
+
+        content_type = self.request.headers.get('Content-Type', '')
+        format = self.get_argument(
+            'format', 'csv' if 'csv' in content_type else 'ndjson'
+        )
+        if format not in importer.FORMATS:
+            raise tornado.web.HTTPError(400)
+        result = yield self.run_db(
+            importer.TaskImporter(project).run,
+            importer.read(self.request.body.splitlines(True), format)
+        )
+        self.write({
+            'created': result['created'],
+            'tasklists': result['tasklists'],
+            'errors': [
+                {'line': line, 'error': error} \
+                    for line, error in result['errors']
+            ],
+        })
+
+
+class ProjectEventsHandler(tornado.websocket.WebSocketHandler, BaseHandler,
+        OrganisationMixin):
+    """
+    Push the events of the tasks of a project over a websocket, see
+    :mod:`events`
+    """
+
+    #: The topic subscribed to, None until the connection is authorised
+    topic = None
+
+    #: The connections open on this process
+    connections = set()
+
+    #: The connection outlives the request, its commands would be recorded
+    #: until it is closed
+    record_queries = False
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close the connections open on this process, which the browsers
+        reopen to another process. Called when the process shuts down.
+        """
+        for connection in list(cls.connections):
+            connection.close()
+
+    @gen.coroutine
+    def get(self, organisation_slug, project_slug):
+        """
+        Check that the current user can see the project before the
+        connection is upgraded to a websocket, else fail with 403 or 404.
+        The checks are made on the database threads.
+
+        :param organisation_slug: Slug of organisation. It is used to select
+        the exact organisation from 'organisation' collection.
+
+        :param project_slug: Slug of project. It is used to select the exact
+        project from the 'project' collection.
+        """
+        current_user = yield self.run_db(lambda: self.current_user)
+        if not current_user:
+            raise tornado.web.HTTPError(403)
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        project = yield self.run_db(
+            Project.objects(organisation=organisation, slug=project_slug).first
+        )
+        if project is None:
+            raise tornado.web.HTTPError(404)
+        team_ids = yield self.run_db(lambda: current_user.team_ids)
+        if project.role_of(team_ids) is None:
+            raise tornado.web.HTTPError(404)
+        self.project = project
+        super(ProjectEventsHandler, self).get(organisation_slug, project_slug)
+
+    def open(self, organisation_slug, project_slug):
+        """
+        Subscribe to the events of the project checked by :meth:`get`
+        """
+        # The websocket outlives the request, it is closed on shutdown
+        # instead of being drained
+        server.REQUESTS.finished(self)
+        self.topic = ('project', self.project.id)
+        events.EVENTS.subscribe(self.topic, self.send_event)
+        self.connections.add(self)
+
+    def on_message(self, message):
+        """
+        The events only go to the browser, messages from it are ignored
+        """
+
+    def on_close(self):
+        """
+        Unsubscribe from the events of the project
+        """
+        self.connections.discard(self)
+        if self.topic is not None:
+            events.EVENTS.unsubscribe(self.topic, self.send_event)
+
+    def send_event(self, event):
+        """
+        Send an event to the browser
+        """
+        try:
+            self.write_message(event)
+        except tornado.websocket.WebSocketClosedError:
+            self.on_close()
+
+
+class MetricsHandler(BaseHandler):
+    """
+    The metrics of the process in the Prometheus text format, see
+    :mod:`metrics`. The scraper must send the `metrics_token` setting as a
+    bearer token. Without the setting, the metrics are only served to
+    scrapers on the same host which connect directly, not through a proxy
+    which forwards the requests of other hosts from the same host.
+    """
+
+    #: The addresses of the scrapers allowed without a token
+    LOOPBACK = ('127.0.0.1', '::1')
+
+    @gen.coroutine
+    def get(self):
+        """
+        Send the request latencies, the IOLoop lag and the outbox depth
+        """
+        token = self.settings.get('metrics_token')
+        if token:
+            if self.request.headers.get('Authorization') != \
+                    'Bearer %s' % token:
+                raise tornado.web.HTTPError(403)
+        elif self.request.remote_ip not in self.LOOPBACK or \
+                'X-Forwarded-For' in self.request.headers or \
+                'X-Real-Ip' in self.request.headers:
+            raise tornado.web.HTTPError(403)
+        try:
+            outbox_depth = yield self.run_db(outbox.queue_depth)
+        except Exception as exc:
+            # The process metrics are still worth sending without the
+            # database
+            logging.error("Could not count the outbox: %s", exc)
+            outbox_depth = None
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render(outbox=outbox_depth))
+
+
+class SearchHandler(BaseHandler, OrganisationMixin):
+    """
+    Search the tasks of the projects visible to the current user, see
+    :mod:`search`
+    """
+
+    #: Results on a page, unless a limit is given
+    page_size = 20
+
+    @tornado.web.authenticated
+    @tornado.web.addslash
+    @gen.coroutine
+    def get(self):
+        """
+        The tasks matching the `q` argument, best match first. A page
+        starts after the `after` argument, which is the `next` cursor of
+        the previous page, and has at most `limit` results.
+        """
+        query = self.get_argument('q', '')
+        try:
+            offset = int(self.get_argument('after', 0))
+            limit = int(self.get_argument('limit', self.page_size))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if offset < 0 or limit < 1:
+            raise tornado.web.HTTPError(400)
+        limit = min(limit, self.max_page_size)
+
+        team_ids = yield self.run_db(lambda: self.current_user.team_ids)
+        results, more = yield self.run_db(
+            search.search, query, team_ids, offset, limit
+        )
+        cursor = unicode(offset + limit) if more else None
+        if self.is_xhr:
+            self.write({
+                'result': [
+                    {
+                        'title': result['task']['title'],
+                        'status': result['task']['status'],
+                        'score': result['score'],
+                        'organisation': result['organisation'].slug,
+                        'project': result['project'].slug,
+                        'tasklist': result['tasklist'].sequence,
+                        'sequence': result['task']['sequence'],
+                        'url': self.reverse_url(
+                            'projects.task', result['organisation'].slug,
+                            result['project'].slug,
+                            result['tasklist'].sequence,
+                            result['task']['sequence']
+                        ),
+                    } for result in results
+                ],
+                'next': cursor,
+            })
+            return
+        navigation = yield self.run_db(self.navigation)
+        self.render(
+            'projects/search.html', query=query, results=results,
+            next=cursor, **navigation
+        )
+
+
+class FileHandler(BaseHandler, OrganisationMixin):
+    """
+    Base handler of the files stored in GridFS, see :mod:`attachments`.
+
+    A handler decorated with `stream_request_body` receives uploads to
+    the `upload_methods`: the body is written to GridFS and hashed as it
+    arrives, and :meth:`store` returns the file, deduplicated, once the
+    body is complete. A file which is stored but not kept, because the
+    request failed or was interrupted, is deleted or released.
+    """
+
+    #: The methods whose body is a file to store
+    upload_methods = ('POST', 'PUT')
+
+    #: The GridFS file the body is written to, None unless a body is
+    #: being uploaded
+    upload = None
+
+    #: The id of the file stored and referenced, see :meth:`store`
+    file_id = None
+
+    #: Set once the file is referenced by a document and must be kept
+    kept = False
+
+    def authorise_upload(self, *args):
+        """
+        Raise an HTTPError unless the current user can upload. Called with
+        the path arguments on the database threads before the body
+        arrives.
+        """
+        raise tornado.web.HTTPError(405)
+
+    @gen.coroutine
+    def prepare(self):
+        """
+        Authorise an upload before the body arrives and create its file,
+        unless the `sha256` argument is the hex SHA-256 of a file which is
+        already stored, which is then referenced without uploading it again.
+        """
+        super(FileHandler, self).prepare()
+        if self.request.method not in self.upload_methods:
+            return
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        self.request.connection.set_max_body_size(
+            self.settings.get('max_attachment_size', 1024 ** 3)
+        )
+        yield self.run_db(self.authorise_upload, *self.path_args)
+        sha256 = self.get_argument('sha256', None)
+        if sha256:
+            self.file_id = yield self.run_db(Blob.reference, sha256.lower())
+            if self.file_id is not None:
+                return
+        name = self.get_argument('name', None) or \
+            self.request.headers.get('X-File-Name')
+        if not name:
+            raise tornado.web.HTTPError(400)
+        content_type = self.request.headers.get(
+            'Content-Type', 'application/octet-stream'
+        )
+        self.digest = hashlib.sha256()
+        self.upload = yield self.run_db(
+            lambda: attachments.grid_fs().new_file(
+                filename=name, content_type=content_type,
+                uploaded_by=self.current_user.id
+            )
+        )
+
+    def data_received(self, chunk):
+        """
+        Write a chunk of the body to the file. The next chunk is not read
+        until this one is written. The body of an upload which references
+        a stored file is ignored.
+        """
+        if self.upload is not None:
+            return self.run_db(self._write, chunk)
+
+    def _write(self, chunk):
+        self.digest.update(chunk)
+        self.upload.write(chunk)
+
+    @gen.coroutine
+    def store(self):
+        """
+        Complete the upload and return the id of the file to reference,
+        which is the id of the stored file if the same content was
+        already stored. The handler must set :attr:`kept` once the file is
+        referenced.
+        """
+        if self.upload is not None:
+            upload, self.upload = self.upload, None
+            try:
+                yield self.run_db(upload.close)
+                self.file_id = yield self.run_db(
+                    Blob.acquire, self.digest.hexdigest(), upload._id,
+                    upload.length
+                )
+            finally:
+                if self.file_id != upload._id:
+                    self.run_db(attachments.delete, upload._id)
+        raise gen.Return(self.file_id)
+
+    def on_finish(self):
+        self.discard()
+        super(FileHandler, self).on_finish()
+
+    def on_connection_close(self):
+        self.discard()
+        super(FileHandler, self).on_connection_close()
+
+    def discard(self):
+        """
+        Delete the file of an upload which failed or was interrupted and
+        release the file referenced but not kept
+        """
+        if self.upload is not None:
+            self.run_db(attachments.delete, self.upload._id)
+            self.upload = None
+        if self.file_id is not None and not self.kept:
+            self.run_db(Blob.release, [self.file_id])
+            self.file_id = None
+
+    @gen.coroutine
+    def send_file(self, file_id, include_body=True):
+        """
+        Send a file from GridFS, a chunk at a time. Conditional requests are
+        answered with the md5 of the file as ETag, and single byte ranges
+        are supported.
+
+        :param file_id: The GridFS id of the file
+        :param include_body: False to only send the headers
+        """
+        try:
+            stored = yield self.run_db(
+                lambda: attachments.grid_fs().get(file_id)
+            )
+        except NoFile:
+            raise tornado.web.HTTPError(404)
+
+        etag = '"%s"' % stored.md5
+        self.set_header('Etag', etag)
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header(
+            'Content-Type', stored.content_type or 'application/octet-stream'
+        )
+        self.set_header(
+            'Content-Disposition', "attachment; filename*=UTF-8''%s" % \
+                urllib.quote((stored.filename or '').encode('utf-8'))
+        )
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        size = stored.length
+        if_range = self.request.headers.get('If-Range')
+        try:
+            byte_range = attachments.parse_range(
+                self.request.headers.get('Range'), size
+            )
+        except ValueError:
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */%d' % size)
+            return
+        if byte_range is not None and if_range in (None, etag):
+            first, last = byte_range
+            self.set_status(206)
+            self.set_header(
+                'Content-Range', 'bytes %d-%d/%d' % (first, last, size)
+            )
+        else:
+            first, last = 0, size - 1
+        remaining = last - first + 1
+        self.set_header('Content-Length', remaining)
+        if not include_body:
+            return
+
+        yield self.run_db(stored.seek, first)
+        while remaining > 0:
+            chunk = yield self.run_db(
+                stored.read, min(stored.chunk_size, remaining)
+            )
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            self.write(chunk)
+            yield self.flush()
+
+
+class AttachmentBaseHandler(FileHandler):
+    """
+    Base handler of the attachments of a task
+    """
+
+    def find_task(self, organisation_slug, project_slug, tasklist_sequence,
+            task_sequence, roles=ROLES):
+        """
+        Returns the task if the current user has one of the roles in its
+        project, else raises a 404 or 403 HTTPError
+        """
+        organisation = self.security_check(organisation_slug)
+        project = Project.objects(
+            slug=project_slug, organisation=organisation
+        ).first()
+        if project is None:
+            raise tornado.web.HTTPError(404)
+        if project.role_of(self.current_user.team_ids) not in roles:
+            raise tornado.web.HTTPError(403)
+        tasklist = TaskList.objects(
+            project=project, sequence=tasklist_sequence
+        ).first()
+        if tasklist is None:
+            raise tornado.web.HTTPError(404)
+        task = Task.objects(task_list=tasklist, sequence=task_sequence).first()
+        if task is None:
+            raise tornado.web.HTTPError(404)
+        return task
+
+
+@tornado.web.stream_request_body
+class AttachmentUploadHandler(AttachmentBaseHandler):
+    """
+    Attach a file to a task. The file is the body of the request, see
+    :class:`FileHandler`.
+    """
+
+    def authorise_upload(self, *args):
+        self.task = self.find_task(*args, roles=('admin', 'participant'))
+
+    @gen.coroutine
+    def post(self, organisation_slug, project_slug, tasklist_sequence,
+            task_sequence):
+        """
+        Attach the uploaded file to the task with a follow up and return
+        the file as JSON
+
+        :param organisation_slug: Slug of organisation. It is used to select
+        the exact organisation from 'organisation' collection.
+
+        :param project_slug: Slug of project. It is used to select the exact
+        project from the 'project' collection.
+
+        :param tasklist_sequence: The sequence of the tasklist in the project
+
+        :param task_sequence: The sequence of the task in the tasklist
+        """
+        file_id = yield self.store()
+        stored = yield self.run_db(
+            lambda: attachments.grid_fs().get(file_id)
+        )
+        name = self.get_argument('name', None) or stored.filename
+        current_user = yield self.run_db(
+            User.objects.with_id, self.current_user.id
+        )
+        follow_up = FollowUp(
+            message=_("Attached %(name)s") % {'name': name},
+            attachments=[attachments.proxy(file_id)]
+        )
+        yield self.run_db(
+            self.task.add_follow_up, follow_up, watchers=[current_user]
+        )
+        self.kept = True
+        yield self.publish_event(
+            self.task, 'comment-added', author=current_user.name,
+            message=follow_up.message, assigned_to=None
+        )
+        self.set_status(201)
+        self.write({
+            'id': unicode(file_id),
+            'name': name,
+            'length': stored.length,
+            'md5': stored.md5,
+            'url': self.reverse_url(
+                'projects.task.attachment', organisation_slug, project_slug,
+                tasklist_sequence, task_sequence, file_id
+            ),
+        })
+
+
+class AttachmentHandler(AttachmentBaseHandler):
+    """
+    Download an attachment of a task, see :meth:`FileHandler.send_file`
+    """
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, organisation_slug, project_slug, tasklist_sequence,
+            task_sequence, file_id, include_body=True):
+        """
+        Send the attachment
+
+        :param organisation_slug: Slug of organisation. It is used to select
+        the exact organisation from 'organisation' collection.
+
+        :param project_slug: Slug of project. It is used to select the exact
+        project from the 'project' collection.
+
+        :param tasklist_sequence: The sequence of the tasklist in the project
+
+        :param task_sequence: The sequence of the task in the tasklist
+
+        :param file_id: The GridFS id of the attachment
+        """
+        task = yield self.run_db(
+            self.find_task, organisation_slug, project_slug,
+            tasklist_sequence, task_sequence
+        )
+        file_id = ObjectId(file_id)
+        attached = yield self.run_db(
+            FollowUpBucket.objects(
+                task=task, follow_ups__attachments=file_id
+            ).count
+        )
+        if not attached:
+            raise tornado.web.HTTPError(404)
+        yield self.send_file(file_id, include_body)
+
+    def head(self, *args):
+        """
+        Send the headers of the attachment
+        """
+        return self.get(*args, include_body=False)
+
+
+@tornado.web.stream_request_body
+class OrganisationImageHandler(FileHandler):
+    """
+    The image of an organisation
+    """
+
+    upload_methods = ('PUT',)
+
+    def authorise_upload(self, organisation_slug):
+        self.organisation = self.security_check(organisation_slug)
+        administrators = Team.objects(
+            organisation=self.organisation, name="Administrators",
+            members=self.current_user.id
+        ).first()
+        if administrators is None:
+            raise tornado.web.HTTPError(403)
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, organisation_slug, include_body=True):
+        """
+        Send the image of the organisation
+
+        :param organisation_slug: Slug of organisation. It is used to select
+        the exact organisation from 'organisation' collection.
+        """
+        organisation = yield self.run_db(
+            self.security_check, organisation_slug
+        )
+        file_id = organisation.image.grid_id if organisation.image else None
+        if file_id is None:
+            raise tornado.web.HTTPError(404)
+        yield self.send_file(file_id, include_body)
+
+    def head(self, *args):
+        """
+        Send the headers of the image
+        """
+        return self.get(*args, include_body=False)
+
+    @gen.coroutine
+    def put(self, organisation_slug):
+        """
+        Replace the image of the organisation with the body of the request,
+        see :class:`FileHandler`. Only the administrators of the
+        organisation can change it.
+
+        :param organisation_slug: Slug of organisation. It is used to select
+        the exact organisation from 'organisation' collection.
+        """
+        file_id = yield self.store()
+        yield self.run_db(self.organisation.set_image, file_id)
+        self.kept = True
+        self.write({'id': unicode(file_id)})
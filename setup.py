@@ -27,9 +27,11 @@ setup(
     },
     install_requires = [
         'monstor',
+        'futures',
     ],
     scripts = [
         'bin/titand',
+        'bin/titan-admin',
     ],
     package_data = {
         "titan": [
@@ -0,0 +1,23 @@
+/*
+ * Live updates of the tasks of a project
+ *
+ * Connects to the events websocket of the project and calls the handler
+ * of the type of every event received. The connection is made again if
+ * it drops.
+ */
+function titanEvents(path, handlers) {
+  if (!window.WebSocket) {
+    return;
+  }
+  var scheme = window.location.protocol == 'https:' ? 'wss://' : 'ws://';
+  var socket = new WebSocket(scheme + window.location.host + path);
+  socket.onmessage = function (message) {
+    var event = JSON.parse(message.data);
+    if (handlers[event.type]) {
+      handlers[event.type](event);
+    }
+  };
+  socket.onclose = function () {
+    setTimeout(function () { titanEvents(path, handlers); }, 10000);
+  };
+}